@@ -0,0 +1,129 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from fastapi import Request
+from fastapi.responses import Response
+from instance import config
+from app.market_hours import MARKET_OPEN, MARKET_TIMEZONE, marketNow, marketToday, nextMarketClose
+
+# Conditional GETs of the portfolio series. The ETag is the portfolio's versions (snapshot_state.version, bumped by
+# every write, and price_version, bumped by every price refresh of its tickers) with everything else the body
+# depends on, so a client polling an unchanged portfolio gets a 304 without anything being computed.
+
+def requestKey(request: Request) -> str:
+    # the same parameters in another order are the same request
+    return repr((request.url.path, sorted(request.query_params.multi_items())))
+
+def todaysBarPeriod(now: datetime):
+    # without the refresher nothing bumps the price version: today's bar is downloaded again by the requests,
+    # so during the session a response is only valid for one refresh interval
+    if config.PRICE_REFRESHER or not config.PRICE_REFRESH_INTERVAL_MINUTES:
+        return None
+
+    close = nextMarketClose(now)
+    session_open = datetime.combine(close.date(), MARKET_OPEN, tzinfo=MARKET_TIMEZONE)
+    if now < session_open:
+        return None
+
+    return (now - session_open) // timedelta(minutes=config.PRICE_REFRESH_INTERVAL_MINUTES)
+
+def makeETag(request: Request, version: str) -> str:
+    # today's row appears without any write, and the histories that include today are read again after the close
+    # today is New York's, like the price store's and the refresher's
+    now = marketNow()
+    key = repr((requestKey(request), marketToday().isoformat(), nextMarketClose(now).isoformat(), todaysBarPeriod(now)))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    # weak, the body is the same json whether it is gzipped or not
+    return f'W/"{version}-{digest}"'
+
+def etagMatches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
+
+def cacheHeaders(etag: str) -> dict:
+    # the client may keep the response, but must ask again (with If-None-Match) before using it
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+def notModified(etag: str) -> Response:
+    return Response(status_code=304, headers=cacheHeaders(etag))
+
+class ResultCache:
+    """
+    Rendered responses of the series endpoints, keyed by request and valid for one ETag.
+
+    A request for the same series at a newer version replaces the entry, the least recently
+    used entries are evicted to keep the total size under max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # key -> (etag, body, media_type)
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        _, body, _ = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def get(self, key: str, etag: str) -> Response:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        _, body, media_type = entry
+        return Response(content=body, media_type=media_type, headers=cacheHeaders(etag))
+
+    def put(self, key: str, etag: str, response: Response):
+        body = response.body
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            # a body bigger than the whole cache is sent but not kept
+            if len(body) > self.max_bytes:
+                return
+
+            self._entries[key] = (etag, body, response.media_type)
+            self._bytes += len(body)
+
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+result_cache = ResultCache(config.RESULT_CACHE_MAX_BYTES)
@@ -0,0 +1,53 @@
+from sqlalchemy import text
+from sqlmodel import Session
+from instance import config
+from app.ticker_index import marketSuffix
+
+# Stocks are valued in the currency they trade in, then converted to the base currency of the portfolio's owner.
+# Exchange rates are daily series like any other ticker (e.g. CADUSD=X, in USD per CAD), so they go through
+# the price store and the history cache: downloaded once, then read locally.
+
+# Users.country_id, as set at registration (1 for Canada)
+COUNTRY_CURRENCIES = {1: "CAD", 2: "USD"}
+
+# the currency of a ticker when the price source can't tell, from its exchange suffix (none for the US)
+SUFFIX_CURRENCIES = {
+    "TO": "CAD", "V": "CAD", "NE": "CAD", "CN": "CAD",
+    "L": "GBp", "PA": "EUR", "DE": "EUR", "AS": "EUR", "MI": "EUR", "MC": "EUR",
+    "SW": "CHF", "T": "JPY", "HK": "HKD", "AX": "AUD",
+}
+
+# some exchanges quote in a fraction of the currency, e.g. London in pence
+MINOR_UNITS = {"GBp": ("GBP", 0.01), "ILA": ("ILS", 0.01), "ZAc": ("ZAR", 0.01)}
+
+class MissingExchangeRateError(LookupError):
+    """A currency held in the portfolio has no quote to convert it to the base currency."""
+
+    def __init__(self, currency: str, base_currency: str):
+        super().__init__(f"No exchange rate from {currency} to {base_currency}")
+        self.currency = currency
+        self.base_currency = base_currency
+
+def inferCurrency(ticker: str) -> str:
+    return SUFFIX_CURRENCIES.get(marketSuffix(ticker), "USD")
+
+def majorUnit(currency: str) -> tuple[str, float]:
+    # the currency an exchange rate is quoted for, and what one quoted unit is worth in it
+    return MINOR_UNITS.get(currency, (currency, 1.0))
+
+def fxTicker(currency: str, base_currency: str) -> str:
+    # yahoo's pair, its close is the price of one currency in base_currency
+    return f"{currency}{base_currency}=X"
+
+def getBaseCurrency(session: Session, portfolio_id: int) -> str:
+
+    # the currency of the portfolio's owner, BASE_CURRENCY without one (or without a country)
+    query = text("""
+        SELECT users.country_id
+        FROM portfolio
+        JOIN users ON CAST(users.user_id AS TEXT) = portfolio.user_id
+        WHERE portfolio.portfolio_id = :portfolio_id
+    """)
+    country_id = session.exec(query.params(portfolio_id=portfolio_id)).scalar()
+
+    return COUNTRY_CURRENCIES.get(country_id, config.BASE_CURRENCY)
@@ -0,0 +1,156 @@
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+import pandas as pd
+from app.market_hours import MARKET_TIMEZONE, marketNow, nextMarketClose
+
+def historySize(history_df: pd.DataFrame) -> int:
+    return int(history_df.memory_usage(index=True, deep=True).sum())
+
+class _Flight:
+    """A load in progress, the callers asking for the same key wait on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class HistoryCache:
+    """
+    Process-wide cache of the daily histories, keyed by (ticker, start, end).
+
+    A range ending before today is final and only leaves the cache when it is evicted or
+    when prices are saved for its days, a range that includes today expires at the next
+    market close, after today_ttl (without a refresher) or when its ticker is refreshed.
+    An empty history is never kept. The least recently used entries are evicted to keep
+    the total size under max_bytes, and concurrent misses for the same key wait on a
+    single load.
+    """
+
+    def __init__(self, max_bytes: int, today_ttl: timedelta = None):
+        self.max_bytes = max_bytes
+        # how long a range that includes today is kept at most, when nothing refreshes its ticker
+        self.today_ttl = today_ttl
+
+        self._lock = threading.Lock()
+        # key -> (history, size, expires_at or None)
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def expiresAt(self, end: date, now: datetime):
+        # end is exclusive, a range ending today or before holds closed days only
+        if end <= now.astimezone(MARKET_TIMEZONE).date():
+            return None
+        if self.today_ttl:
+            return min(nextMarketClose(now), now + self.today_ttl)
+        return nextMarketClose(now)
+
+    def _lookup(self, key, now: datetime):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        history_df, size, expires_at = entry
+        if expires_at is not None and now >= expires_at:
+            self._remove(key)
+            self.expirations += 1
+            return None
+
+        self._entries.move_to_end(key)
+        return history_df
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _store(self, key, history_df: pd.DataFrame, expires_at):
+        size = historySize(history_df)
+
+        # an entry bigger than the whole cache is returned but not kept, and so is an empty one (a failed download)
+        if size > self.max_bytes or history_df.empty:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (history_df, size, expires_at)
+        self._bytes += size
+
+        while self._bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def get(self, ticker: str, start: date, end: date, load) -> pd.DataFrame:
+        key = (ticker, start, end)
+
+        with self._lock:
+            history_df = self._lookup(key, marketNow())
+            if history_df is not None:
+                self.hits += 1
+                return history_df.copy()
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result.copy()
+
+        try:
+            flight.result = load()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None:
+                    self._store(key, flight.result, self.expiresAt(end, marketNow()))
+            flight.done.set()
+
+        return flight.result.copy()
+
+    def invalidate(self, ticker: str, from_day: date = None):
+        # drops the ranges of a ticker that still include today, e.g. once its latest bar was refreshed,
+        # or with from_day the ones that include a day from it on (prices were saved for them)
+        def isStale(key, entry) -> bool:
+            if from_day is not None:
+                return key[2] > from_day
+            return entry[2] is not None
+
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if key[0] == ticker and isStale(key, entry)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
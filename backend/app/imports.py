@@ -0,0 +1,223 @@
+import csv
+import io
+import json
+from collections import defaultdict
+from datetime import datetime
+from operator import itemgetter
+from sqlalchemy import text
+from sqlmodel import Session
+from app.ledger import rebuildLedger
+from app.snapshots import invalidateSnapshots
+from app.ticker_index import isUnknownTicker
+
+# Bulk import of stock and cash transactions, as CSV (with a header) or JSON lines, with the fields:
+#   type: stock or cash, action: add or remove, date: YYYY-MM-DD
+#   stock: ticker, quantity, price, fees (default 0), drip (default false)
+#   cash: name, amount, interest (default 0)
+
+IMPORT_ACTIONS = ("add", "remove")
+
+STOCK_COLUMNS = ("portfolio_id", "ticker", "amount", "price", "fees", "action", "drip", "date")
+CASH_COLUMNS = ("portfolio_id", "name", "amount", "interest", "action", "date")
+
+# errors returned at most, a file with a wrong column would otherwise return one per row
+MAX_IMPORT_ERRORS = 100
+
+class InvalidImportError(ValueError):
+    def __init__(self, errors: list[dict]):
+        super().__init__(f"{len(errors)} invalid rows")
+        self.errors = errors
+
+def parseRows(body: bytes, import_format: str):
+    # (line number, row) pairs, the line numbers are the ones of the file (the csv header is line 1)
+    content = body.decode("utf-8-sig")
+
+    if import_format == "csv":
+        reader = csv.DictReader(io.StringIO(content))
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(content.splitlines(), start=1):
+        if line.strip():
+            yield line_number, json.loads(line)
+
+def toFloat(row: dict, field: str, default=None) -> float:
+    value = row.get(field)
+
+    if value is None or value == "":
+        if default is None:
+            raise ValueError(f"missing {field}")
+        return default
+
+    return float(value)
+
+def toBool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+def validateRow(portfolio_id: int, row: dict, known_tickers: set) -> tuple[str, dict]:
+    asset_type = (row.get("type") or "").strip().lower()
+    action = (row.get("action") or "").strip().lower()
+
+    if action not in IMPORT_ACTIONS:
+        raise ValueError(f"action must be one of {', '.join(IMPORT_ACTIONS)}")
+
+    # fromisoformat is much faster than strptime, which shows on large files
+    date_str = (row.get("date") or "").strip()
+    if len(date_str) != 10:
+        raise ValueError("date must be YYYY-MM-DD")
+    datetime.fromisoformat(date_str)
+    # stored like the models store a datetime, so the imported rows sort and compare with the others
+    transaction_date = date_str + " 00:00:00.000000"
+
+    if asset_type == "stock":
+        ticker = (row.get("ticker") or "").strip()
+        if not ticker:
+            raise ValueError("missing ticker")
+        if ticker not in known_tickers and isUnknownTicker(ticker):
+            raise ValueError(f"{ticker} not found in Yahoo Finance")
+        known_tickers.add(ticker)
+
+        quantity = toFloat(row, "quantity")
+        price = toFloat(row, "price")
+        fees = toFloat(row, "fees", 0.0)
+        if quantity <= 0 or price < 0 or fees < 0:
+            raise ValueError("quantity must be positive, price and fees can't be negative")
+
+        return "stock", {
+            "portfolio_id": portfolio_id,
+            "ticker": ticker,
+            "amount": quantity,
+            "price": price,
+            "fees": fees,
+            "action": action,
+            "drip": int(toBool(row.get("drip", False))),
+            "date": transaction_date,
+        }
+
+    if asset_type == "cash":
+        amount = toFloat(row, "amount")
+        interest = toFloat(row, "interest", 0.0)
+        if amount <= 0:
+            raise ValueError("amount must be positive")
+
+        return "cash", {
+            "portfolio_id": portfolio_id,
+            "name": (row.get("name") or "").strip() or None,
+            "amount": amount,
+            "interest": interest,
+            "action": action,
+            "date": transaction_date,
+        }
+
+    raise ValueError("type must be stock or cash")
+
+def mergedTransactions(stored: list, imported_rows: list) -> list[tuple]:
+    # (day, order, line number or None for a stored one, row) in the order the ledger replays them: by day, the
+    # stored ones first on the same day (they have the lower transaction ids), then the imported ones as in the file
+    transactions = [(row.day, (0, row.transaction_id), None, row._mapping) for row in stored]
+    transactions += [(row["date"][:10], (1, position), line_number, row) for position, (line_number, row) in enumerate(imported_rows)]
+    return sorted(transactions, key=lambda transaction: transaction[:2])
+
+def replayBalances(transactions: list, key) -> list[tuple]:
+
+    # the (line number, balance key) of the imported rows that take a balance below 0, see mergedTransactions.
+    # A balance going negative on a stored remove is blamed on the last imported remove before it
+    errors = []
+    balances = defaultdict(float)
+    last_imported_remove = {}
+
+    for _, _, line_number, row in transactions:
+        balance_key = key(row)
+        balances[balance_key] += row["amount"] if row["action"] == "add" else -row["amount"]
+
+        if row["action"] == "remove" and line_number is not None:
+            last_imported_remove[balance_key] = line_number
+
+        if balances[balance_key] < -1e-9:
+            blamed_line = line_number if line_number is not None else last_imported_remove.get(balance_key)
+            if blamed_line is not None:
+                errors.append((blamed_line, balance_key))
+            balances[balance_key] = 0
+
+    return errors
+
+def checkBalances(session: Session, portfolio_id: int, stock_rows: list, cash_rows: list) -> list[dict]:
+
+    # like the single removes, a remove can't take more than what is held on its day: the imported rows are
+    # replayed with the stored transactions, so a backdated remove is checked against what was held then
+    errors = []
+
+    tickers = list({row["ticker"] for _, row in stock_rows})
+    if tickers:
+        stored = session.exec(text(f"""
+            SELECT transaction_id, ticker, date(date) AS day, action, amount
+            FROM stock_holdings
+            WHERE portfolio_id = :portfolio_id AND ticker IN ({', '.join(f':ticker_{number}' for number in range(len(tickers)))})
+        """).params(portfolio_id=portfolio_id, **{f"ticker_{number}": ticker for number, ticker in enumerate(tickers)})).all()
+
+        for line_number, ticker in replayBalances(mergedTransactions(stored, stock_rows), key=lambda row: row["ticker"]):
+            errors.append({"line": line_number, "error": f"removes more {ticker} shares than held"})
+
+    if cash_rows:
+        stored = session.exec(text("""
+            SELECT transaction_id, date(date) AS day, action, amount FROM cash WHERE portfolio_id = :portfolio_id
+        """).params(portfolio_id=portfolio_id)).all()
+
+        for line_number, _ in replayBalances(mergedTransactions(stored, cash_rows), key=lambda row: "cash"):
+            errors.append({"line": line_number, "error": "removes more cash than the portfolio holds"})
+
+    return sorted(errors, key=lambda error: error["line"])
+
+def importTransactions(session: Session, portfolio_id: int, body: bytes, import_format: str) -> dict:
+
+    # everything is validated before anything is written: the file is imported whole or not at all
+    stock_rows, cash_rows, errors = [], [], []
+    known_tickers = set()
+
+    try:
+        for line_number, row in parseRows(body, import_format):
+            try:
+                asset_type, values = validateRow(portfolio_id, row, known_tickers)
+            except (ValueError, TypeError, AttributeError) as e:
+                errors.append({"line": line_number, "error": str(e)})
+                if len(errors) >= MAX_IMPORT_ERRORS:
+                    break
+                continue
+
+            (stock_rows if asset_type == "stock" else cash_rows).append((line_number, values))
+    except (UnicodeDecodeError, json.JSONDecodeError, csv.Error) as e:
+        errors.append({"line": None, "error": f"could not read the file: {e}"})
+
+    if not errors:
+        errors = checkBalances(session, portfolio_id, stock_rows, cash_rows)
+
+    if errors:
+        raise InvalidImportError(errors[:MAX_IMPORT_ERRORS])
+
+    if not stock_rows and not cash_rows:
+        return {"stocks": 0, "cash": 0}
+
+    # one executemany per table, straight to the driver: binding 100k rows through text() costs more than inserting them
+    connection = session.connection()
+    for table, columns, rows in (("stock_holdings", STOCK_COLUMNS, stock_rows), ("cash", CASH_COLUMNS, cash_rows)):
+        if rows:
+            row_values = itemgetter(*columns)
+            connection.exec_driver_sql(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [row_values(values) for _, values in rows],
+            )
+
+    # the imported tickers are replayed in the cost basis ledger
+    if stock_rows:
+        rebuildLedger(session, portfolio_id, list({values["ticker"] for _, values in stock_rows}))
+
+    # a single recomputation, from the earliest imported day
+    first_date = datetime.fromisoformat(min(values["date"] for _, values in stock_rows + cash_rows)[:10]).date()
+    invalidateSnapshots(session, portfolio_id, first_date)
+
+    session.commit()
+
+    return {"stocks": len(stock_rows), "cash": len(cash_rows)}
@@ -0,0 +1,179 @@
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from starlette.datastructures import MutableHeaders
+from instance import config
+
+# Stages of a valuation request, timed everywhere they happen:
+#   sql: every statement (engine events), fetch: price downloads, fill: weekend fill,
+#   valuate: the series computations, serialize: the response encoding
+STAGES = ("sql", "fetch", "fill", "valuate", "serialize")
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """Prometheus style cumulative histogram of durations, safe to observe from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, label: str, seconds: float):
+        with self._lock:
+            counts = self.counts.setdefault(label, [0] * (len(BUCKETS) + 1))
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    counts[index] += 1
+            counts[-1] += 1
+            self.sums[label] = self.sums.get(label, 0.0) + seconds
+
+    def lines(self, name: str, label_name: str) -> list[str]:
+        with self._lock:
+            lines = []
+            for label, counts in sorted(self.counts.items()):
+                for bound, count in zip(BUCKETS, counts):
+                    lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {counts[-1]}')
+                lines.append(f'{name}_sum{{{label_name}="{label}"}} {self.sums[label]:.6f}')
+                lines.append(f'{name}_count{{{label_name}="{label}"}} {counts[-1]}')
+            return lines
+
+stage_durations = Histogram()
+request_durations = Histogram()
+
+class RequestTimings:
+    """Time spent per stage during one request, summed over the threads that worked on it."""
+
+    def __init__(self, profile: bool = False):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.profile = profile
+        self.profile_path = None
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def serverTiming(self, total: float) -> str:
+        with self._lock:
+            entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+# set by the middleware, copied into the worker threads along with the rest of the context
+request_timings: ContextVar = ContextVar("request_timings", default=None)
+
+def recordStage(stage: str, seconds: float):
+    stage_durations.observe(stage, seconds)
+
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+@contextmanager
+def timing(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recordStage(stage, time.perf_counter() - start)
+
+def instrumentEngine(engine):
+    # every statement's execution is timed as sql, whatever code path runs it
+    from sqlalchemy import event
+
+    # a connection runs one statement at a time, a failed one is simply never recorded
+    @event.listens_for(engine, "before_cursor_execute")
+    def startStatement(connection, cursor, statement, parameters, context, executemany):
+        connection.info["statement_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def endStatement(connection, cursor, statement, parameters, context, executemany):
+        start = connection.info.pop("statement_start", None)
+        if start is not None:
+            recordStage("sql", time.perf_counter() - start)
+
+def runProfiled(function, *args):
+
+    # with ?profile=true (and PROFILE_REQUESTS on), the valuation of the request is run under cProfile
+    # and dumped to PROFILE_DIR, open it with python -m pstats or snakeviz. Downloads run on the
+    # fetch pool and only show as waits.
+    timings = request_timings.get()
+    if timings is None or not timings.profile:
+        return function(*args)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        timings.profile_path = os.path.join(
+            config.PROFILE_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{function.__name__}.prof"
+        )
+        profiler.dump_stats(timings.profile_path)
+
+def wantsProfile(scope) -> bool:
+    if not config.PROFILE_REQUESTS:
+        return False
+    query = scope.get("query_string", b"").decode()
+    return "profile=true" in query.split("&") or "profile=1" in query.split("&")
+
+class TimingMiddleware:
+    """
+    Times every request and the stages it goes through, for /metrics.
+    With SERVER_TIMING on, the stages are also sent in a Server-Timing header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings(profile=wantsProfile(scope))
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+
+        async def sendWithTimings(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if config.SERVER_TIMING:
+                    headers.append("Server-Timing", timings.serverTiming(time.perf_counter() - start))
+                if timings.profile_path:
+                    headers.append("X-Profile-Dump", timings.profile_path)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, sendWithTimings)
+        finally:
+            request_timings.reset(token)
+            request_durations.observe(scope["method"], time.perf_counter() - start)
+
+def statsLines(prefix: str, stats: dict, counters: tuple = ()) -> list[str]:
+    # the numeric values of a stats() dict, the keys in counters only ever grow
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            metric_type = "counter" if key in counters else "gauge"
+            name = f"{prefix}_{key}_total" if key in counters else f"{prefix}_{key}"
+            lines += [f"# TYPE {name} {metric_type}", f"{name} {value}"]
+    return lines
+
+def metricsText(extra_lines: list[str] = ()) -> str:
+    lines = [
+        "# HELP kyw_stage_duration_seconds Time spent in each stage of the valuation pipeline.",
+        "# TYPE kyw_stage_duration_seconds histogram",
+        *stage_durations.lines("kyw_stage_duration_seconds", "stage"),
+        "# HELP kyw_request_duration_seconds Time to answer a request.",
+        "# TYPE kyw_request_duration_seconds histogram",
+        *request_durations.lines("kyw_request_duration_seconds", "method"),
+        *extra_lines,
+    ]
+    return "\n".join(lines) + "\n"
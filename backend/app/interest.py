@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+# TODO: we assume the interest is annual, but calculated on a daily basis
+DAYS_PER_YEAR = 365
+
+def toDailyRate(annual_rate_percent) -> np.ndarray:
+    return np.asarray(annual_rate_percent, dtype=float) / 100 / DAYS_PER_YEAR
+
+def accrueBalances(flows, daily_rates, resets=None) -> np.ndarray:
+    """
+    Daily balances of any number of accounts (one row per account, one column per day), where
+        balance[t] = balance[t - 1] * (1 + daily_rates[t]) + flows[t]
+    and, on the days where resets is True, balance[t] = flows[t].
+
+    With growth[t] the cumulative product of (1 + daily_rates) up to t, this is
+        balance[t] = growth[t] * sum(flows[k] / growth[k]) for k since the last reset
+    so every account and every piecewise rate change is handled in one pass of array operations.
+    """
+
+    flows = np.atleast_2d(np.asarray(flows, dtype=float))
+    daily_rates = np.broadcast_to(np.asarray(daily_rates, dtype=float), flows.shape)
+
+    growth = np.cumprod(1 + daily_rates, axis=1)
+    discounted_sum = np.cumsum(flows / growth, axis=1)
+
+    if resets is None:
+        return growth * discounted_sum
+
+    resets = np.broadcast_to(np.atleast_2d(np.asarray(resets, dtype=bool)), flows.shape)
+    days = np.arange(flows.shape[1])
+
+    # the discounted sum restarts at each account's last reset day
+    last_reset = np.maximum.accumulate(np.where(resets, days, 0), axis=1)
+    sum_before_reset = np.concatenate((np.zeros((flows.shape[0], 1)), discounted_sum), axis=1)
+    sum_before_reset = np.take_along_axis(sum_before_reset, last_reset, axis=1)
+
+    return growth * (discounted_sum - sum_before_reset)
+
+def getDailyAccountBalances(transactions_df: pd.DataFrame, all_days: pd.DatetimeIndex) -> pd.DataFrame:
+    """
+    Balances of every account (name) on every day of all_days, from a frame of transactions
+    with name, date, flow (signed amount) and interest (annual %) columns.
+    An account's rate is the one of its latest transaction, and applies from that day on.
+    """
+
+    by_account_day = transactions_df.groupby(["name", "date"])
+
+    flows = by_account_day["flow"].sum().unstack().reindex(columns=all_days, fill_value=0).fillna(0)
+    rates = by_account_day["interest"].last().unstack().reindex(index=flows.index, columns=all_days)
+    rates = rates.ffill(axis=1).fillna(0)
+
+    balances = accrueBalances(flows.to_numpy(), toDailyRate(rates.to_numpy()))
+
+    return pd.DataFrame(balances, index=flows.index, columns=all_days)
@@ -0,0 +1,279 @@
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from sqlmodel import Session
+from app import yfinance_utils
+from app.yfinance_utils import getStockHistories
+from app.valuation import PRICE_LOOKBACK_DAYS
+
+# The cost basis ledger: one lot per buy in stock_lots, the running totals per ticker in stock_positions.
+# Both are updated with each transaction, so a sale reads the few lots it sells (through the index of the
+# open lots) and a position is a single row, instead of aggregating every transaction of the ticker.
+# A transaction dated before the ticker's latest one changes what the later sales sold: the ticker is replayed.
+#
+# A sale sells the oldest open lots first. Its cost is theirs ("fifo") or the average cost of the shares held
+# ("average"), the method of the portfolio. Shares sold beyond those held have no cost.
+
+COST_BASIS_METHODS = ("fifo", "average")
+
+# below this a lot or a position is sold out, sums of fractional shares don't always come back to 0
+EPSILON = 1e-9
+
+@dataclass
+class Position:
+    shares: float = 0
+    cost: float = 0
+    realized_gain: float = 0
+    last_date: str = None
+    last_transaction_id: int = None
+
+def getCostBasisMethod(session: Session, portfolio_id: int) -> str:
+    query = text("SELECT cost_basis_method FROM portfolio WHERE portfolio_id = :portfolio_id")
+    method = session.exec(query.params(portfolio_id=portfolio_id)).scalar()
+    return method or "fifo"
+
+def costPerShare(price: float, amount: float, fees: float) -> float:
+    # as the series count it, the fees are part of what the shares cost
+    return price + (fees or 0) / amount if amount else price
+
+def buy(position: Position, amount: float, cost_per_share: float):
+    position.shares += amount
+    position.cost += amount * cost_per_share
+
+def sell(position: Position, open_lots, amount: float, proceeds: float, method: str) -> dict:
+
+    # open_lots: (transaction_id, remaining, cost_per_share) oldest first, only read as far as the sale goes
+    # returns what remains of each lot the sale sold from
+    left = amount
+    lots_cost = 0
+    remaining_by_lot = {}
+
+    for transaction_id, remaining, cost_per_share in open_lots:
+        if left <= EPSILON:
+            break
+
+        sold = min(remaining, left)
+        left -= sold
+        lots_cost += sold * cost_per_share
+        remaining_by_lot[transaction_id] = remaining - sold if remaining - sold > EPSILON else 0
+
+    sold = amount - left
+
+    if method == "average":
+        cost = position.cost * sold / position.shares if position.shares > EPSILON else 0
+    else:
+        cost = lots_cost
+
+    position.realized_gain += proceeds - cost
+    position.shares -= sold
+    position.cost -= cost
+
+    if position.shares <= EPSILON:
+        position.shares, position.cost = 0, 0
+
+    return remaining_by_lot
+
+def getPosition(session: Session, portfolio_id: int, ticker: str) -> Position:
+    query = text("""
+        SELECT shares, cost, realized_gain, last_date, last_transaction_id
+        FROM stock_positions
+        WHERE portfolio_id = :portfolio_id AND ticker = :ticker
+    """)
+    result = session.exec(query.params(portfolio_id=portfolio_id, ticker=ticker)).first()
+    return Position(*result) if result is not None else None
+
+def savePosition(session: Session, portfolio_id: int, ticker: str, position: Position):
+    session.exec(text("""
+        INSERT OR REPLACE INTO stock_positions (portfolio_id, ticker, shares, cost, realized_gain, last_date, last_transaction_id)
+        VALUES (:portfolio_id, :ticker, :shares, :cost, :realized_gain, :last_date, :last_transaction_id)
+    """).params(portfolio_id=portfolio_id, ticker=ticker, shares=position.shares, cost=position.cost,
+                realized_gain=position.realized_gain, last_date=position.last_date, last_transaction_id=position.last_transaction_id))
+
+def recordStockTransaction(session: Session, holding):
+
+    # called in the same transaction as the write, once the holding has its transaction_id (after a flush)
+    day = holding.date.strftime("%Y-%m-%d")
+    position = getPosition(session, holding.portfolio_id, holding.ticker)
+
+    if position is not None and day < position.last_date:
+        rebuildLedger(session, holding.portfolio_id, [holding.ticker])
+        return
+
+    position = position or Position()
+
+    if holding.action == "add":
+        cost_per_share = costPerShare(holding.price, holding.amount, holding.fees)
+        buy(position, holding.amount, cost_per_share)
+
+        session.exec(text("""
+            INSERT INTO stock_lots (transaction_id, portfolio_id, ticker, date, quantity, remaining, cost_per_share)
+            VALUES (:transaction_id, :portfolio_id, :ticker, :date, :amount, :amount, :cost_per_share)
+        """).params(transaction_id=holding.transaction_id, portfolio_id=holding.portfolio_id, ticker=holding.ticker,
+                    date=day, amount=holding.amount, cost_per_share=cost_per_share))
+    else:
+        open_lots = session.exec(text("""
+            SELECT transaction_id, remaining, cost_per_share
+            FROM stock_lots
+            WHERE portfolio_id = :portfolio_id AND ticker = :ticker AND remaining > 0
+            ORDER BY date, transaction_id
+        """).params(portfolio_id=holding.portfolio_id, ticker=holding.ticker))
+
+        proceeds = holding.amount * holding.price - (holding.fees or 0)
+        remaining_by_lot = sell(position, open_lots, holding.amount, proceeds, getCostBasisMethod(session, holding.portfolio_id))
+        open_lots.close()
+
+        if remaining_by_lot:
+            session.exec(text("UPDATE stock_lots SET remaining = :remaining WHERE transaction_id = :transaction_id"),
+                         params=[{"transaction_id": transaction_id, "remaining": remaining} for transaction_id, remaining in remaining_by_lot.items()])
+
+    position.last_date, position.last_transaction_id = day, holding.transaction_id
+    savePosition(session, holding.portfolio_id, holding.ticker, position)
+
+def rebuildLedger(session: Session, portfolio_id: int, tickers: list = None):
+
+    # replays the transactions of the tickers (all of them by default) in order, the caller commits
+    method = getCostBasisMethod(session, portfolio_id)
+
+    query = """
+        SELECT transaction_id, ticker, date(date) AS day, action, amount, price, fees
+        FROM stock_holdings
+        WHERE portfolio_id = :portfolio_id
+    """
+    params = {"portfolio_id": portfolio_id}
+    ticker_filter = ""
+
+    if tickers is not None:
+        ticker_filter = f" AND ticker IN ({', '.join(f':ticker_{number}' for number in range(len(tickers)))})"
+        params.update({f"ticker_{number}": ticker for number, ticker in enumerate(tickers)})
+
+    transactions = session.exec(text(query + ticker_filter + " ORDER BY day, transaction_id").params(**params)).all()
+
+    positions = {}
+    # the open lots of each ticker, as [transaction_id, remaining, cost_per_share] oldest first
+    open_lots = {}
+    lots = {}
+
+    for transaction_id, ticker, day, action, amount, price, fees in transactions:
+        position = positions.setdefault(ticker, Position())
+        ticker_lots = open_lots.setdefault(ticker, deque())
+
+        if action == "add":
+            cost_per_share = costPerShare(price, amount, fees)
+            buy(position, amount, cost_per_share)
+
+            lot = [transaction_id, amount, cost_per_share]
+            ticker_lots.append(lot)
+            lots[transaction_id] = {"ticker": ticker, "date": day, "quantity": amount, "lot": lot}
+        else:
+            remaining_by_lot = sell(position, ticker_lots, amount, amount * price - (fees or 0), method)
+
+            for lot in ticker_lots:
+                if lot[0] not in remaining_by_lot:
+                    break
+                lot[1] = remaining_by_lot[lot[0]]
+
+            while ticker_lots and ticker_lots[0][1] == 0:
+                ticker_lots.popleft()
+
+        position.last_date, position.last_transaction_id = day, transaction_id
+
+    session.exec(text(f"DELETE FROM stock_lots WHERE portfolio_id = :portfolio_id{ticker_filter}").params(**params))
+    session.exec(text(f"DELETE FROM stock_positions WHERE portfolio_id = :portfolio_id{ticker_filter}").params(**params))
+
+    if lots:
+        session.exec(text("""
+            INSERT INTO stock_lots (transaction_id, portfolio_id, ticker, date, quantity, remaining, cost_per_share)
+            VALUES (:transaction_id, :portfolio_id, :ticker, :date, :quantity, :remaining, :cost_per_share)
+        """), params=[
+            {"transaction_id": transaction_id, "portfolio_id": portfolio_id, "ticker": lot["ticker"], "date": lot["date"],
+             "quantity": lot["quantity"], "remaining": lot["lot"][1], "cost_per_share": lot["lot"][2]}
+            for transaction_id, lot in lots.items()
+        ])
+
+    for ticker, position in positions.items():
+        savePosition(session, portfolio_id, ticker, position)
+
+def buildMissingLedgers(session: Session) -> list[int]:
+
+    # the portfolios with a ticker that has transactions but no position, e.g. written before the ledger existed
+    portfolio_ids = session.exec(text("""
+        SELECT DISTINCT holdings.portfolio_id
+        FROM stock_holdings AS holdings
+        LEFT JOIN stock_positions AS positions
+            ON positions.portfolio_id = holdings.portfolio_id AND positions.ticker = holdings.ticker
+        WHERE positions.ticker IS NULL
+    """)).scalars().all()
+
+    for portfolio_id in portfolio_ids:
+        rebuildLedger(session, portfolio_id)
+
+    session.commit()
+
+    return portfolio_ids
+
+def getLatestCloses(tickers: list) -> dict:
+    # the last close of each ticker, carried over a weekend or holiday
+    now = datetime.now()
+    histories = getStockHistories(tickers, (now - timedelta(days=PRICE_LOOKBACK_DAYS)).date(), now)
+
+    latest_closes = {}
+    for ticker, history in histories.items():
+        closes = history["close"].dropna()
+        latest_closes[ticker] = float(closes.iloc[-1]) if not closes.empty else None
+
+    return latest_closes
+
+def getPositions(session: Session, portfolio_id: int, with_lots: bool = False) -> list[dict]:
+
+    # every ticker ever held (a sold out one still has its realized gain), valued at its last close
+    # the amounts are in the currency the ticker trades in, as the transactions were entered
+    results = session.exec(text("""
+        SELECT ticker, shares, cost, realized_gain
+        FROM stock_positions
+        WHERE portfolio_id = :portfolio_id
+        ORDER BY ticker
+    """).params(portfolio_id=portfolio_id)).all()
+
+    latest_closes = getLatestCloses([row.ticker for row in results if row.shares > 0])
+    currencies = yfinance_utils.getCurrencies([row.ticker for row in results])
+
+    positions = []
+    for row in results:
+        close = latest_closes.get(row.ticker)
+        market_value = row.shares * close if close is not None else None
+
+        positions.append({
+            "ticker": row.ticker,
+            "currency": currencies[row.ticker],
+            "shares": row.shares,
+            "cost_basis": row.cost,
+            "average_cost": row.cost / row.shares if row.shares > 0 else None,
+            "realized_gain": row.realized_gain,
+            "price": close,
+            "market_value": market_value,
+            "unrealized_gain": market_value - row.cost if market_value is not None else None,
+        })
+
+    if with_lots:
+        lots = session.exec(text("""
+            SELECT ticker, transaction_id, date, quantity, remaining, cost_per_share
+            FROM stock_lots
+            WHERE portfolio_id = :portfolio_id AND remaining > 0
+            ORDER BY ticker, date, transaction_id
+        """).params(portfolio_id=portfolio_id)).all()
+
+        lots_by_ticker = {}
+        for lot in lots:
+            lots_by_ticker.setdefault(lot.ticker, []).append({
+                "transaction_id": lot.transaction_id,
+                "date": lot.date,
+                "quantity": lot.quantity,
+                "remaining": lot.remaining,
+                "cost_per_share": lot.cost_per_share,
+            })
+
+        for position in positions:
+            position["lots"] = lots_by_ticker.get(position["ticker"], [])
+
+    return positions
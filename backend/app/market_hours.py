@@ -0,0 +1,25 @@
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+# the prices follow the US session, weekends are skipped but holidays are not
+MARKET_TIMEZONE = ZoneInfo("America/New_York")
+MARKET_OPEN = time(9, 30)
+MARKET_CLOSE = time(16, 0)
+
+def marketNow() -> datetime:
+    return datetime.now(MARKET_TIMEZONE)
+
+def marketToday() -> date:
+    # the day still being traded (or the last one, until midnight in New York), whatever the server's timezone
+    return marketNow().date()
+
+def nextMarketClose(now: datetime) -> datetime:
+    now = now.astimezone(MARKET_TIMEZONE)
+    close = datetime.combine(now.date(), MARKET_CLOSE, tzinfo=MARKET_TIMEZONE)
+
+    if now >= close:
+        close += timedelta(days=1)
+    while close.weekday() >= 5:
+        close += timedelta(days=1)
+
+    return close
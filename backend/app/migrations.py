@@ -0,0 +1,112 @@
+from sqlalchemy import inspect, text
+from sqlmodel import SQLModel, Session
+from app import models
+from app.ledger import buildMissingLedgers
+
+# create_all only creates what is missing at the table level: a table that already exists
+# keeps the indexes it was created with, even if new ones were declared on its model since.
+
+def createMissingIndexes(engine) -> list[str]:
+    inspector = inspect(engine)
+    created = []
+
+    # index names are unique in the whole database, not per table
+    existing = {
+        index["name"]: table_name
+        for table_name in inspector.get_table_names()
+        for index in inspector.get_indexes(table_name)
+    }
+
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                if existing.get(index.name) == table.name:
+                    continue
+
+                # declared on a table that was since renamed (e.g. realestate to real_estate)
+                if index.name in existing:
+                    connection.execute(text(f"DROP INDEX {index.name}"))
+
+                index.create(connection)
+                created.append(index.name)
+
+    return created
+
+def clearSnapshots(connection):
+    # the materialized series are rebuilt on their next read
+    connection.execute(text("DELETE FROM daily_snapshots"))
+    connection.execute(text("UPDATE snapshot_state SET valid_until = NULL, version = version + 1"))
+
+# the same goes for columns: a new nullable column is added to the existing table (sqlite can't add any other kind)
+
+def addMissingColumns(engine) -> list[str]:
+    inspector = inspect(engine)
+    added = []
+
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+                added.append(f"{table.name}.{column.name}")
+
+        # the materialized series don't have the new fields
+        if any(column.startswith("daily_snapshots.") for column in added):
+            clearSnapshots(connection)
+
+    return added
+
+# price_coverage used to hold a single range per ticker, merged over the days between two requests that were never
+# downloaded: it is dropped, and each ticker's prices are downloaded again (over the stored ones) on their next read
+
+def dropSingleRangeCoverage(engine) -> bool:
+    inspector = inspect(engine)
+
+    if "price_coverage" not in inspector.get_table_names():
+        return False
+    if inspector.get_pk_constraint("price_coverage")["constrained_columns"] != ["ticker"]:
+        return False
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE price_coverage"))
+
+    return True
+
+# the series materialized before the stocks were converted to the owner's currency (ticker_currencies came with it)
+# hold each stock in its own currency: a database without that table has them
+
+def hasUnconvertedSnapshots(engine) -> bool:
+    tables = inspect(engine).get_table_names()
+    return "daily_snapshots" in tables and "ticker_currencies" not in tables
+
+def migrate(engine):
+    if dropSingleRangeCoverage(engine):
+        print("Dropped the single range price coverage, prices are downloaded again on their next read")
+
+    unconverted = hasUnconvertedSnapshots(engine)
+
+    SQLModel.metadata.create_all(engine)
+
+    if unconverted:
+        with engine.begin() as connection:
+            clearSnapshots(connection)
+        print("Cleared the snapshots materialized before the currency conversion, they are rebuilt on their next read")
+
+    added = addMissingColumns(engine)
+    if added:
+        print(f"Added columns: {', '.join(added)}")
+
+    created = createMissingIndexes(engine)
+    if created:
+        print(f"Created indexes: {', '.join(created)}")
+
+    # the transactions written before the cost basis ledger existed
+    with Session(engine) as session:
+        built = buildMissingLedgers(session)
+    if built:
+        print(f"Built the cost basis ledger of {len(built)} portfolios")
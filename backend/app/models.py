@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field
+from sqlalchemy import Index, text
 from datetime import datetime, timezone
 from typing import Optional
 
@@ -19,6 +20,8 @@ class Portfolio(SQLModel, table=True):
     user_id: str = Field(nullable=False, max_length=255)
     name: Optional[str] = Field(default=None, max_length=255)
     date_created: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
+    # how a sale is matched against the lots it sells, "fifo" or "average" (see app/ledger.py)
+    cost_basis_method: Optional[str] = Field(default="fifo", max_length=16)
 
     def to_dict(self):
         return {
@@ -33,6 +36,8 @@ class Portfolio(SQLModel, table=True):
 
 class StockHoldings(SQLModel, table=True):
     __tablename__ = 'stock_holdings'  # Explicitly set the table name to 'stock_holdings'
+    # every query filters on the portfolio, then on the ticker and/or a date range
+    __table_args__ = (Index("ix_stock_holdings_portfolio_ticker_date", "portfolio_id", "ticker", "date"),)
 
     transaction_id: Optional[int] = Field(default=None, primary_key=True)
     portfolio_id: int = Field(nullable=False)
@@ -48,6 +53,9 @@ class StockHoldings(SQLModel, table=True):
         return f"<StockHoldings {self.transaction_id}>"
 
 class Cash(SQLModel, table=True):
+    # the name plays the part of the ticker for these assets
+    __table_args__ = (Index("ix_cash_portfolio_name_date", "portfolio_id", "name", "date"),)
+
     transaction_id: Optional[int] = Field(default=None, primary_key=True)
     portfolio_id: int = Field(nullable=False)
     name: str = Field(default=None, max_length=255)
@@ -60,6 +68,10 @@ class Cash(SQLModel, table=True):
         return f"<Cash {self.transaction_id}>"
 
 class RealEstate(SQLModel, table=True):
+    __tablename__ = 'real_estate'  # the name the queries use, the default would be 'realestate'
+    # the name plays the part of the ticker for these assets
+    __table_args__ = (Index("ix_real_estate_portfolio_name_date", "portfolio_id", "name", "date"),)
+
     transaction_id: Optional[int] = Field(default=None, primary_key=True)
     portfolio_id: int = Field(nullable=False)
     name: Optional[str] = Field(default=None, max_length=255)
@@ -71,6 +83,9 @@ class RealEstate(SQLModel, table=True):
         return f"<RealEstate {self.transaction_id}>"
 
 class Debt(SQLModel, table=True):
+    # the name plays the part of the ticker for these assets
+    __table_args__ = (Index("ix_debt_portfolio_name_date", "portfolio_id", "name", "date"),)
+
     transaction_id: Optional[int] = Field(default=None, primary_key=True)
     portfolio_id: int = Field(nullable=False)
     name: Optional[str] = Field(default=None, max_length=255)
@@ -81,3 +96,110 @@ class Debt(SQLModel, table=True):
 
     def __repr__(self):
         return f"<Debt {self.transaction_id}>"
+
+class StockPrice(SQLModel, table=True):
+    __tablename__ = 'stock_prices'
+    # the few days with a dividend, read over a whole history for the reinvested shares
+    __table_args__ = (Index("ix_stock_prices_dividends", "ticker", "date", sqlite_where=text("dividends != 0")),)
+
+    ticker: str = Field(primary_key=True, max_length=255)
+    date: str = Field(primary_key=True, max_length=10)
+    open: float = Field(nullable=False)
+    close: float = Field(nullable=False)
+    dividends: float = Field(nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<StockPrice {self.ticker} {self.date}>"
+
+class PriceCoverage(SQLModel, table=True):
+    __tablename__ = 'price_coverage'
+
+    # [start, end) ranges of days for which stock_prices holds final (closed) data, several per ticker
+    # when the requests left a gap between them (they never overlap, touching ones are merged)
+    ticker: str = Field(primary_key=True, max_length=255)
+    start: str = Field(primary_key=True, max_length=10)
+    end: str = Field(nullable=False, max_length=10)
+
+    def __repr__(self):
+        return f"<PriceCoverage {self.ticker} {self.start}:{self.end}>"
+
+class TickerCurrency(SQLModel, table=True):
+    __tablename__ = 'ticker_currencies'
+
+    # the currency a ticker trades in, as the price source reported it (e.g. CAD, or GBp for pence)
+    ticker: str = Field(primary_key=True, max_length=255)
+    currency: str = Field(nullable=False, max_length=8)
+
+    def __repr__(self):
+        return f"<TickerCurrency {self.ticker} {self.currency}>"
+
+class DailySnapshot(SQLModel, table=True):
+    __tablename__ = 'daily_snapshots'
+
+    # one materialized row per asset per day, ordered for a range scan of a portfolio's series
+    portfolio_id: int = Field(primary_key=True)
+    asset_type: str = Field(primary_key=True, max_length=255)
+    name: str = Field(primary_key=True, max_length=255)
+    date: str = Field(primary_key=True, max_length=10)
+    price: Optional[float] = Field(default=None)
+    quantity: Optional[float] = Field(default=None)
+    interest: Optional[float] = Field(default=None)
+    value: float = Field(nullable=False)
+    # stocks only: shares held with the reinvested dividends, dividends paid in cash so far,
+    # and their total return value (shares at the last close plus the cash dividends)
+    shares: Optional[float] = Field(default=None)
+    dividends: Optional[float] = Field(default=None)
+    total_return: Optional[float] = Field(default=None)
+
+    def __repr__(self):
+        return f"<DailySnapshot {self.portfolio_id} {self.name} {self.date}>"
+
+class StockLot(SQLModel, table=True):
+    __tablename__ = 'stock_lots'
+    # a sale reads the open lots of its ticker oldest first, the sold out ones are left out of the index
+    __table_args__ = (Index("ix_stock_lots_open", "portfolio_id", "ticker", "date", "transaction_id", sqlite_where=text("remaining > 0")),)
+
+    # one lot per buy, keyed by its transaction
+    transaction_id: int = Field(primary_key=True)
+    portfolio_id: int = Field(nullable=False)
+    ticker: str = Field(nullable=False, max_length=255)
+    date: str = Field(nullable=False, max_length=10)
+    quantity: float = Field(nullable=False)
+    remaining: float = Field(nullable=False)
+    # price paid per share, fees included
+    cost_per_share: float = Field(nullable=False)
+
+    def __repr__(self):
+        return f"<StockLot {self.transaction_id} {self.ticker} {self.remaining}/{self.quantity}>"
+
+class StockPosition(SQLModel, table=True):
+    __tablename__ = 'stock_positions'
+
+    # the running totals of a ticker's lots, updated with them
+    portfolio_id: int = Field(primary_key=True)
+    ticker: str = Field(primary_key=True, max_length=255)
+    shares: float = Field(nullable=False, default=0)
+    # cost basis of the shares still held
+    cost: float = Field(nullable=False, default=0)
+    realized_gain: float = Field(nullable=False, default=0)
+    # the latest transaction applied, an earlier one replays the ticker's transactions
+    last_date: str = Field(nullable=False, max_length=10)
+    last_transaction_id: int = Field(nullable=False)
+
+    def __repr__(self):
+        return f"<StockPosition {self.portfolio_id} {self.ticker} {self.shares}>"
+
+class SnapshotState(SQLModel, table=True):
+    __tablename__ = 'snapshot_state'
+
+    portfolio_id: int = Field(primary_key=True)
+    first_date: Optional[str] = Field(default=None, max_length=10)
+    # last day of the materialized series that is final, None when nothing is materialized
+    valid_until: Optional[str] = Field(default=None, max_length=10)
+    # bumped by every write to the portfolio (a materialized series is only saved at the version it was computed at)
+    version: int = Field(nullable=False, default=0)
+    # bumped by every price refresh of its tickers, only part of the ETag (the final days don't change)
+    price_version: Optional[int] = Field(default=0)
+
+    def __repr__(self):
+        return f"<SnapshotState {self.portfolio_id} v{self.version}>"
@@ -0,0 +1,290 @@
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+import pandas as pd
+import yfinance as yf
+from sqlalchemy import text
+from sqlmodel import SQLModel, Session
+from app.models import StockPrice, PriceCoverage, TickerCurrency
+from app.instrumentation import timing
+from app.market_hours import marketToday
+
+PRICE_COLUMNS = ["date", "open", "close", "Dividends", "Ticker"]
+
+# called as listener(session, ticker, first_day) in the transaction that saves new prices of a ticker,
+# with the earliest day saved (app/snapshots.py drops the materialized days from there on)
+price_write_listeners = []
+
+def toDate(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return pd.Timestamp(value).date()
+
+def toEndDate(value) -> date:
+    # end dates are exclusive, a datetime past midnight still includes its own day (like yfinance)
+    end = toDate(value)
+    if isinstance(value, datetime) and value.time() != datetime.min.time():
+        end += timedelta(days=1)
+    return end
+
+def emptyHistory(ticker: str) -> pd.DataFrame:
+    history_df = pd.DataFrame({
+        "date": pd.Series(dtype="datetime64[ns]"),
+        "open": pd.Series(dtype=float),
+        "close": pd.Series(dtype=float),
+        "Dividends": pd.Series(dtype=float),
+    })
+    history_df["Ticker"] = ticker
+    return history_df
+
+class YFinanceSource:
+    """Default price source, downloads daily bars from Yahoo Finance (end date exclusive)."""
+
+    def fetch(self, ticker: str, start: date, end: date) -> pd.DataFrame:
+        history_df = yf.Ticker(ticker).history(start=start, end=end, interval="1d")
+
+        if history_df.empty:
+            return emptyHistory(ticker)
+
+        history_df.reset_index(inplace=True)
+        history_df.rename(columns={"Date": "date", "Open": "open", "Close": "close"}, inplace=True)
+
+        # yahoo dates are tz-aware market timestamps, we only keep the trading day
+        history_df["date"] = pd.to_datetime(history_df["date"]).dt.tz_localize(None).dt.normalize()
+        history_df["Ticker"] = ticker
+
+        return history_df[PRICE_COLUMNS]
+
+    def fetchCurrency(self, ticker: str) -> str:
+        return yf.Ticker(ticker).fast_info["currency"]
+
+class PriceStore:
+    """
+    Persistent daily price history keyed by (ticker, date).
+
+    Every ticker has the ranges of days that were already downloaded and closed, only the
+    days outside of them (before, after or between two of them) are requested from the
+    source. A download that returns nothing is not marked as covered, and today's bar is
+    still moving, so it is saved but never marked as covered either.
+    """
+
+    def __init__(self, engine, source=None):
+        self.engine = engine
+        self.source = source if source is not None else YFinanceSource()
+        self._tables_created = False
+
+        self._write_lock = threading.Lock()
+
+        # one lock per ticker, so the same range is never downloaded twice at once
+        self._locks_guard = threading.Lock()
+        self._locks = defaultdict(threading.Lock)
+
+    def _ensureTables(self):
+        with self._write_lock:
+            if not self._tables_created:
+                SQLModel.metadata.create_all(self.engine, tables=[StockPrice.__table__, PriceCoverage.__table__, TickerCurrency.__table__])
+                self._tables_created = True
+
+    def getCoverage(self, session: Session, ticker: str) -> list[tuple[date, date]]:
+        query = text("SELECT start, \"end\" FROM price_coverage WHERE ticker = :ticker ORDER BY start")
+        results = session.exec(query.params(ticker=ticker)).all()
+
+        return [(toDate(result.start), toDate(result.end)) for result in results]
+
+    def missingRanges(self, coverage: list, start: date, end: date) -> list[tuple[date, date]]:
+        # the parts of [start, end) outside of every covered range, including the gaps between them
+        ranges = []
+
+        for covered_start, covered_end in coverage:
+            if start >= end:
+                break
+            if covered_end <= start:
+                continue
+            if covered_start >= end:
+                break
+
+            if start < covered_start:
+                ranges.append((start, covered_start))
+            start = max(start, covered_end)
+
+        if start < end:
+            ranges.append((start, end))
+
+        return ranges
+
+    def savePrices(self, session: Session, ticker: str, history_df: pd.DataFrame) -> int:
+        # returns the number of rows written, a day saved again with the same values isn't
+        if history_df.empty:
+            return 0
+
+        rows = [
+            {
+                "ticker": ticker,
+                "date": row_date.strftime("%Y-%m-%d"),
+                "open": float(row_open),
+                "close": float(row_close),
+                "dividends": float(row_dividends),
+            }
+            for row_date, row_open, row_close, row_dividends in zip(
+                history_df["date"], history_df["open"], history_df["close"], history_df["Dividends"].fillna(0)
+            )
+        ]
+
+        return session.exec(text("""
+            INSERT INTO stock_prices (ticker, date, open, close, dividends)
+            VALUES (:ticker, :date, :open, :close, :dividends)
+            ON CONFLICT (ticker, date) DO UPDATE SET open = excluded.open, close = excluded.close, dividends = excluded.dividends
+            WHERE open IS NOT excluded.open OR close IS NOT excluded.close OR dividends IS NOT excluded.dividends
+        """), params=rows).rowcount
+
+    def saveCoverage(self, session: Session, ticker: str, coverage: list, new_ranges: list):
+        # the new ranges are merged with the ones they overlap or touch, the others are kept as they are
+        merged = []
+        for range_start, range_end in sorted(coverage + new_ranges):
+            if merged and range_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+            else:
+                merged.append((range_start, range_end))
+
+        session.exec(text("DELETE FROM price_coverage WHERE ticker = :ticker").params(ticker=ticker))
+        session.exec(text("""
+            INSERT INTO price_coverage (ticker, start, "end") VALUES (:ticker, :start, :end)
+        """), params=[
+            {"ticker": ticker, "start": range_start.strftime("%Y-%m-%d"), "end": range_end.strftime("%Y-%m-%d")}
+            for range_start, range_end in merged
+        ])
+
+    def readPrices(self, session: Session, ticker: str, start: date, end: date) -> pd.DataFrame:
+        query = text("""
+            SELECT date, open, close, dividends
+            FROM stock_prices
+            WHERE ticker = :ticker AND date >= :start AND date < :end
+            ORDER BY date
+        """)
+
+        results = session.exec(query.params(
+            ticker=ticker, start=start.strftime("%Y-%m-%d"), end=end.strftime("%Y-%m-%d")
+        )).all()
+
+        if not results:
+            return emptyHistory(ticker)
+
+        dates, opens, closes, dividends = zip(*results)
+
+        history_df = pd.DataFrame({
+            "date": pd.to_datetime(dates, format="%Y-%m-%d"),
+            "open": opens,
+            "close": closes,
+            "Dividends": dividends,
+        })
+        history_df["Ticker"] = ticker
+
+        return history_df
+
+    def _tickerLock(self, ticker: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks[ticker]
+
+    def getHistory(self, ticker: str, start, end, fetch_today: bool = True) -> pd.DataFrame:
+        # with fetch_today=False, today's bar is read as last saved instead of downloaded again
+        start, end = toDate(start), toEndDate(end)
+
+        self.fillHistory(ticker, start, end, fetch_today)
+
+        with Session(self.engine) as session:
+            return self.readPrices(session, ticker, start, end)
+
+    def fillHistory(self, ticker: str, start, end, fetch_today: bool = True) -> tuple[list, int]:
+        # downloads and saves the days of [start, end) that aren't stored yet, without reading them
+        # returns the closed ranges that are still missing (their download came back empty), and the number of
+        # rows written: the listeners are only called when a row changed
+        start, end = toDate(start), toEndDate(end)
+
+        # days before today (in New York) are closed and can be cached for good
+        closed_end = max(min(end, marketToday()), start)
+
+        self._ensureTables()
+
+        with self._tickerLock(ticker):
+            with Session(self.engine) as session:
+                coverage = self.getCoverage(session, ticker)
+
+            # downloads happen outside of any transaction, so other tickers can be fetched meanwhile
+            missing_ranges = self.missingRanges(coverage, start, closed_end)
+            with timing("fetch"):
+                downloaded = [self.source.fetch(ticker, range_start, range_end) for range_start, range_end in missing_ranges]
+
+                if fetch_today and end > closed_end:
+                    downloaded.append(self.source.fetch(ticker, closed_end, end))
+
+            # a range that came back empty (a failed download, or only a weekend) is asked again next time
+            covered_ranges = [missing_range for missing_range, history_df in zip(missing_ranges, downloaded) if not history_df.empty]
+
+            written = 0
+            if any(not history_df.empty for history_df in downloaded):
+                # sqlite only has one writer at a time
+                with self._write_lock, Session(self.engine) as session:
+                    written_by_download = [self.savePrices(session, ticker, history_df) for history_df in downloaded]
+                    written = sum(written_by_download)
+
+                    if covered_ranges:
+                        self.saveCoverage(session, ticker, coverage, covered_ranges)
+
+                    if written:
+                        first_saved = min(history_df["date"].min() for history_df, rows in zip(downloaded, written_by_download) if rows)
+                        for listener in price_write_listeners:
+                            listener(session, ticker, toDate(first_saved))
+
+                    session.commit()
+
+        return [missing_range for missing_range, history_df in zip(missing_ranges, downloaded) if history_df.empty], written
+
+    def getDividends(self, tickers: list, start, end) -> pd.DataFrame:
+        # only the days with a dividend (with that day's close), as saved: nothing is downloaded here,
+        # fillHistory the range of each ticker first
+        start, end = toDate(start), toEndDate(end)
+
+        self._ensureTables()
+
+        query = text(f"""
+            SELECT ticker, date, dividends, close
+            FROM stock_prices
+            WHERE ticker IN ({", ".join(f":ticker_{number}" for number in range(len(tickers)))})
+                AND date >= :start AND date < :end AND dividends != 0
+        """)
+        params = {f"ticker_{number}": ticker for number, ticker in enumerate(tickers)}
+
+        with Session(self.engine) as session:
+            results = session.exec(query.params(
+                start=start.strftime("%Y-%m-%d"), end=end.strftime("%Y-%m-%d"), **params
+            )).all()
+
+        return pd.DataFrame(results, columns=["Ticker", "date", "Dividends", "close"])
+
+    def readCurrencies(self, tickers: list) -> dict:
+        # the saved currency of each ticker, the ones never asked to the source are left out (see yfinance_utils.getCurrencies)
+        self._ensureTables()
+
+        query = text(f"""
+            SELECT ticker, currency
+            FROM ticker_currencies
+            WHERE ticker IN ({", ".join(f":ticker_{number}" for number in range(len(tickers)))})
+        """)
+        params = {f"ticker_{number}": ticker for number, ticker in enumerate(tickers)}
+
+        with Session(self.engine) as session:
+            return dict(session.exec(query.params(**params)).all())
+
+    def saveCurrencies(self, currencies: dict):
+        if not currencies:
+            return
+
+        self._ensureTables()
+
+        with self._write_lock, Session(self.engine) as session:
+            session.exec(text("""
+                INSERT OR REPLACE INTO ticker_currencies (ticker, currency) VALUES (:ticker, :currency)
+            """), params=[{"ticker": ticker, "currency": currency} for ticker, currency in currencies.items()])
+            session.commit()
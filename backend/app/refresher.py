@@ -0,0 +1,172 @@
+import asyncio
+from datetime import date, datetime, timedelta
+import anyio
+from sqlalchemy import text
+from instance import config
+from app import yfinance_utils
+from app.market_hours import MARKET_OPEN, MARKET_TIMEZONE, marketNow, marketToday, nextMarketClose
+from app.snapshots import bumpTickerVersions
+
+def nextRefreshTime(now: datetime, interval: timedelta, delay: timedelta) -> datetime:
+
+    # the close whose final refresh (delay after it) is still ahead
+    close = nextMarketClose(now - delay)
+    final_refresh = close + delay
+    session_open = datetime.combine(close.date(), MARKET_OPEN, tzinfo=MARKET_TIMEZONE)
+
+    if not interval:
+        return final_refresh
+
+    # during the session today's bar is kept warm, outside of it nothing moves until the next open
+    if now < session_open:
+        return session_open
+
+    return min(now + interval, final_refresh)
+
+def isRateLimited(error: Exception) -> bool:
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+
+    message = str(error).lower()
+    return "too many requests" in message or "rate limit" in message
+
+def getHeldTickers() -> dict:
+    # every ticker with shares in a portfolio (from the cost basis ledger, a sold out one isn't refreshed anymore),
+    # and the first day its history is needed from
+    with config.getSession() as session:
+        results = session.exec(text("""
+            SELECT holdings.ticker, MIN(date(holdings.date)) AS first_date
+            FROM stock_positions AS positions
+            JOIN stock_holdings AS holdings
+                ON holdings.portfolio_id = positions.portfolio_id AND holdings.ticker = positions.ticker
+            WHERE positions.shares > 0
+            GROUP BY holdings.ticker
+        """)).all()
+
+    return {ticker: datetime.strptime(first_date, "%Y-%m-%d").date() for ticker, first_date in results}
+
+class MarketDataRefresher:
+    """
+    Keeps the price store up to date for every ticker held in a portfolio, so requests read
+    stored prices instead of waiting on Yahoo Finance.
+
+    Each run appends the days since the last one (and today's bar), and backfills the days
+    before a ticker's stored range when an earlier transaction was added. Runs happen on
+    startup, every interval during the session and once more delay after the close.
+    Tickers are downloaded one at a time, and a rate limited download is retried with an
+    exponential backoff.
+    """
+
+    def __init__(self, interval: timedelta, delay: timedelta, request_interval: float, max_backoff: float, max_retries: int):
+        self.interval = interval
+        self.delay = delay
+        self.request_interval = request_interval
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+
+        self._task = None
+        self._wake = None
+
+        self.last_run = None
+        self.refreshed = 0
+        self.failures = 0
+        self.rate_limited = 0
+
+    def refreshTicker(self, ticker: str, first_date: date):
+        # only the days missing from the store and today's bar are downloaded, nothing is read back
+        today = marketToday()
+        _, written = yfinance_utils.price_store.fillHistory(ticker, first_date, today + timedelta(days=1))
+
+        # nothing changed (e.g. after the close), the portfolios keep their ETag
+        if not written:
+            return
+
+        # the cached ranges from the first saved day on were dropped when it was saved,
+        # the portfolios holding the ticker get a new ETag
+        with config.getSession() as session:
+            bumpTickerVersions(session, ticker)
+            session.commit()
+
+    async def refreshWithBackoff(self, ticker: str, first_date: date) -> bool:
+        backoff = self.request_interval
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                await anyio.to_thread.run_sync(self.refreshTicker, ticker, first_date)
+                self.refreshed += 1
+                return True
+            except Exception as e:
+                if not isRateLimited(e):
+                    print(f"Could not refresh {ticker}: {e}")
+                    self.failures += 1
+                    return True
+
+                self.rate_limited += 1
+                backoff = min(max(backoff * 2, 1), self.max_backoff)
+                print(f"Rate limited while refreshing {ticker}, retrying in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+
+        # still rate limited, the remaining tickers wait for the next run
+        return False
+
+    async def refreshAll(self):
+        held_tickers = await anyio.to_thread.run_sync(getHeldTickers)
+
+        for ticker, first_date in held_tickers.items():
+            if not await self.refreshWithBackoff(ticker, first_date):
+                break
+            await asyncio.sleep(self.request_interval)
+
+        self.last_run = marketNow()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refreshAll()
+            except Exception as e:
+                print(f"Market data refresh failed: {e}")
+
+            sleep = (nextRefreshTime(marketNow(), self.interval, self.delay) - marketNow()).total_seconds()
+
+            # a new ticker (wake) does not wait for the next scheduled run
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(sleep, 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "refreshed": self.refreshed,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+        }
+
+market_data_refresher = MarketDataRefresher(
+    interval=timedelta(minutes=config.PRICE_REFRESH_INTERVAL_MINUTES),
+    delay=timedelta(minutes=config.PRICE_REFRESH_DELAY_MINUTES),
+    request_interval=config.PRICE_REFRESH_REQUEST_INTERVAL,
+    max_backoff=config.PRICE_REFRESH_MAX_BACKOFF,
+    max_retries=config.PRICE_REFRESH_MAX_RETRIES,
+)
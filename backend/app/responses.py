@@ -0,0 +1,92 @@
+import json
+from datetime import datetime
+from itertools import groupby
+import time
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.instrumentation import timing, recordStage
+
+SERIES_FIELDS = ("price", "quantity", "interest", "value", "shares", "dividends", "total_return")
+
+def assetType(record: dict) -> str:
+    # debt and real estate records carry their type, the stock and cash ones kept their original shape
+    if "type" in record:
+        return record["type"]
+    return "stock" if "quantity" in record else "cash"
+
+def dateFields(dates: list, delta_dates: bool = False) -> dict:
+    if not delta_dates:
+        return {"dates": dates}
+    
+    ordinals = [datetime.strptime(date_str, "%Y-%m-%d").toordinal() for date_str in dates]
+    return {"start": dates[0] if dates else None, "date_deltas": [current - previous for previous, current in zip(ordinals, ordinals[1:])]}
+
+def columnarAsset(asset_records: list, delta_dates: bool = False) -> dict:
+    
+    # one asset's records (its days in order) as an array per field
+    # with delta_dates, dates are sent as the first day and the number of days between each point
+    
+    dates = [record["date"] for record in asset_records]
+    
+    asset = {"name": asset_records[0]["name"], "type": assetType(asset_records[0])}
+    
+    asset.update(dateFields(dates, delta_dates))
+    
+    for field in SERIES_FIELDS:
+        if field in asset_records[0]:
+            asset[field] = [record[field] for record in asset_records]
+            
+    return asset
+
+def toColumnar(records: list, delta_dates: bool = False) -> dict:
+    
+    # one entry per asset with an array per field, instead of one object per asset per day
+    # records must be grouped by asset with their days in order (as the snapshot reads return them)
+    
+    assets = [
+        columnarAsset(list(asset_records), delta_dates)
+        for _, asset_records in groupby(records, key=lambda record: (record["name"], assetType(record)))
+    ]
+        
+    return {"format": "columnar", "assets": assets}
+
+@timing("serialize")
+def netWorthResponse(net_worth_df, breakdown: bool = False, dates: str = "full") -> JSONResponse:
+    
+    # one array of days for the whole portfolio, and the same array per asset type with breakdown
+    
+    body = dateFields(net_worth_df.index.tolist(), delta_dates=dates == "delta")
+    body["total"] = net_worth_df.sum(axis=1).round(2).tolist() if not net_worth_df.empty else []
+    
+    if breakdown:
+        body["breakdown"] = {asset_type: net_worth_df[asset_type].round(2).tolist() for asset_type in net_worth_df.columns}
+    
+    return JSONResponse(body)
+
+async def ndjsonAssets(assets, delta_dates: bool = False):
+    # one line per asset, written as soon as the asset is read (or computed)
+    # only the encoding is timed as serialize, reading the assets is sql
+    seconds = 0.0
+    async for asset_records in assets:
+        start = time.perf_counter()
+        line = json.dumps(columnarAsset(asset_records, delta_dates), separators=(",", ":")) + "\n"
+        seconds += time.perf_counter() - start
+        yield line
+    recordStage("serialize", seconds)
+
+@timing("serialize")
+def seriesResponse(records: list, response_format: str = "rows", dates: str = "full") -> JSONResponse:
+    
+    # records are already plain json types, so they skip FastAPI's per-object encoding
+    
+    if response_format == "columnar":
+        return JSONResponse(toColumnar(records, delta_dates=dates == "delta"))
+    
+    return JSONResponse(records)
+
+def streamingSeriesResponse(assets, dates: str = "full", headers: dict = None, background=None) -> StreamingResponse:
+    
+    # assets is an async generator of one asset's records at a time, only one asset is ever held in memory
+    # background runs once the whole stream was sent
+    
+    return StreamingResponse(ndjsonAssets(assets, delta_dates=dates == "delta"), media_type="application/x-ndjson", headers=headers,
+                             background=background)
@@ -1,15 +1,30 @@
 #app/routes.py
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import FastAPI, Request, HTTPException, Depends, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
-from typing import Annotated
+from anyio import to_thread
+from typing import Annotated, Literal, Optional
 import os
 import jwt
-from sqlmodel import Session, select
-from app.models import Users, Portfolio, StockHoldings, Cash, Debt, RealEstate
-from app.utils import getTop3Tickers, getStockFromPortfolio, getHistoricalCash, getRemainingCash, getRemainingShares, getHistoricalStocks, getHistoricalAssets
-from app.yfinance_utils import stockIsInYF
-from datetime import datetime, timedelta
-from instance.config import db
+from sqlmodel import Session
+from app.models import Portfolio, StockHoldings, Cash, Debt, RealEstate
+from app.utils import getTop3Tickers, getRemainingCash, getRemainingShares
+from app.snapshots import getSnapshotSeries, getNetWorthSeries, getPortfolioVersion, invalidateSnapshots, prepareSnapshotSeries, iterSnapshotAssets, \
+    isSnapshotWarm, iterValuatedAssets, materializeSnapshots
+from app.ticker_index import TickerLookupError, isUnknownTicker
+from app.workers import runValuation
+from app.imports import importTransactions, InvalidImportError
+from app.currency import MissingExchangeRateError
+from app.ledger import COST_BASIS_METHODS, getPositions, rebuildLedger, recordStockTransaction
+from app.responses import seriesResponse, streamingSeriesResponse, netWorthResponse
+from app.refresher import market_data_refresher
+from app.instrumentation import metricsText, statsLines
+from app.conditional import cacheHeaders, etagMatches, makeETag, notModified, requestKey, result_cache
+from app.yfinance_utils import history_cache
+from datetime import date, datetime, time, timedelta
+from instance.config import getSession
 
 from dotenv import load_dotenv
 
@@ -22,14 +37,42 @@ ALGORITHM = os.getenv('SECRET_KEY')
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 def get_session():
-    with db as session:
+    with getSession() as session:
         yield session
 
 SessionDep = Annotated[Session, Depends(get_session)]
 
+# ?format=columnar returns one array per field per asset, ?dates=delta sends the dates as day offsets
+# ?format=ndjson streams the same columnar assets, one per line
+FormatQuery = Annotated[Literal["rows", "columnar", "ndjson"], Query(alias="format")]
+
+# ?format= of an imported file, csv with a header row or one json object per line
+ImportFormatQuery = Annotated[Literal["csv", "jsonl"], Query(alias="format")]
+DatesQuery = Annotated[Literal["full", "delta"], Query()]
+
+# ?start=YYYY-MM-DD&end=YYYY-MM-DD limit the series to a window, ?resolution= keeps one point per week or month
+ResolutionQuery = Annotated[Literal["daily", "weekly", "monthly"], Query()]
+
+def getUntilDate(end: Optional[date]) -> datetime:
+    # the whole end day is included, but never past now
+    now = datetime.now()
+    if end is None or end >= now.date():
+        return now
+    return datetime.combine(end, time.max)
+
 # Create a FastAPI app instance
 app = FastAPI()
 
+# a series with a stock that can't be converted to the owner's currency isn't returned at all (see getExchangeRates)
+@app.exception_handler(MissingExchangeRateError)
+async def missing_exchange_rate(request: Request, exc: MissingExchangeRateError):
+    return JSONResponse(status_code=503, content={"detail": f"{exc}, could not value the portfolio in {exc.base_currency}."})
+
+# a symbol missing from the listing that Yahoo couldn't be asked about, the transaction can be sent again later
+@app.exception_handler(TickerLookupError)
+async def ticker_lookup_failed(request: Request, exc: TickerLookupError):
+    return JSONResponse(status_code=503, content={"detail": f"{exc}, try again later."})
+
 # JWT Authentication Helper Functions
 def create_access_token(data: dict, expires_delta: timedelta = timedelta(hours=1)):
     to_encode = data.copy()
@@ -48,10 +91,8 @@ def verify_token(token: str):
 @app.get("/tickers")
 async def get_tickers(q : str, request: Request, session: SessionDep):
     
-    print(f"Tickers, data : {q}")
-    
+    # searched in the local ticker index, fast enough to run on every keystroke
     top3 = getTop3Tickers(q)
-    top3 = []
     return top3
 
 # FastAPI Routes
@@ -67,8 +108,8 @@ async def add_stock(portfolio_id: int, request: Request, session: SessionDep):
 
     date = datetime.strptime(date,"%Y-%m-%d").date()
 
-    # if not stockIsInYF(ticker):
-    #     raise HTTPException(status_code=404, detail="Stock not found in Yahoo Finance")
+    if await to_thread.run_sync(isUnknownTicker, ticker):
+        raise HTTPException(status_code=404, detail="Stock not found in Yahoo Finance")
     
     new_holding = StockHoldings(portfolio_id=portfolio_id,
                                 ticker=ticker, price=price,
@@ -79,8 +120,14 @@ async def add_stock(portfolio_id: int, request: Request, session: SessionDep):
                                 drip = drip)
     
     session.add(new_holding)
+    session.flush()
+    recordStockTransaction(session, new_holding)
+    invalidateSnapshots(session, portfolio_id, date)
     session.commit()
     
+    # a new ticker (or an earlier date) is downloaded in the background right away
+    market_data_refresher.wake()
+    
     return {"message": f"Successfully added {quantity} of {ticker} @ {price} in {portfolio_id=} at {date}"}, 200
 
 @app.put("/stocks/remove/{portfolio_id}")
@@ -94,6 +141,9 @@ async def remove_stock(portfolio_id: int, request: Request, session: SessionDep)
     
     date = datetime.strptime(date,"%Y-%m-%d").date()
 
+    if await to_thread.run_sync(isUnknownTicker, ticker):
+        raise HTTPException(status_code=404, detail="Stock not found in Yahoo Finance")
+
     # TODO : check if stock is (and correct number of shares) in the portfolio before selling
     remaining_shares = getRemainingShares(session, portfolio_id, ticker)
     
@@ -103,12 +153,12 @@ async def remove_stock(portfolio_id: int, request: Request, session: SessionDep)
             detail=f"Only {remaining_shares} shares of {ticker} in the portfolio, but you tried to remove {quantity}. Could not remove shares."
         )
 
-    # if not stockIsInYF(ticker):
-    #     raise HTTPException(status_code=404, detail="Stock not found in Yahoo Finance")
-
-    new_holding = StockHoldings(portfolio_id=portfolio_id, ticker=ticker, price=price, amount=quantity, action="remove", fees = fees)
+    new_holding = StockHoldings(portfolio_id=portfolio_id, ticker=ticker, price=price, amount=quantity, date = date, action="remove", fees = fees)
     
     session.add(new_holding)
+    session.flush()
+    recordStockTransaction(session, new_holding)
+    invalidateSnapshots(session, portfolio_id, date)
     session.commit()
     
     return {"message": f"Successfully sold {quantity} of {ticker} @ {price} in {portfolio_id=} at {date}"}, 200
@@ -133,6 +183,7 @@ async def add_cash(portfolio_id: int, request: Request, session: SessionDep):
     )
 
     session.add(new_cash)
+    invalidateSnapshots(session, portfolio_id, date)
     session.commit()
 
     return {"message": f"Successfully added {amount} of cash in {portfolio_id=} at {date}"}, 200
@@ -143,7 +194,7 @@ async def remove_cash(portfolio_id: int, request: Request, session: SessionDep):
     name = data['name']
     amount = data['amount']
     date = data['date']
-    interest = date['interest'] #TODO : check if there's cash with that interest rate.
+    interest = data['interest'] #TODO : check if there's cash with that interest rate.
     
     date = datetime.strptime(date,"%Y-%m-%d").date()
 
@@ -160,38 +211,250 @@ async def remove_cash(portfolio_id: int, request: Request, session: SessionDep):
         name=name,
         amount=amount,
         interest=interest,
+        date=date,
         action='remove'
     )
 
     session.add(new_cash)
+    invalidateSnapshots(session, portfolio_id, date)
     session.commit()
     return {"message": f"Successfully removed {amount} of cash in {portfolio_id=} at {date}"}, 200
 
-@app.get('/assets/{portfolio_id}')
-async def get_assets(portfolio_id: int, session: SessionDep):
+@app.put("/debt/add/{portfolio_id}")
+async def add_debt(portfolio_id: int, request: Request, session: SessionDep):
+    data = await request.json()
+    name = data.get('name')
+    amount = data.get('amount')
+    date = data.get('date')
+    interest = data.get('interest', 0)
+
+    if not name or not amount or not date:
+        raise HTTPException(status_code=400, detail="Missing required fields")
+
+    date = datetime.strptime(date,"%Y-%m-%d").date()
+
+    new_debt = Debt(portfolio_id=portfolio_id, name=name, amount=amount, interest=interest, date=date, action='add')
+
+    session.add(new_debt)
+    invalidateSnapshots(session, portfolio_id, date)
+    session.commit()
+
+    return {"message": f"Successfully added {amount} of debt ({name}) in {portfolio_id=} at {date}"}, 200
+
+@app.put("/debt/remove/{portfolio_id}")
+async def remove_debt(portfolio_id: int, request: Request, session: SessionDep):
+    data = await request.json()
+    name = data.get('name')
+    amount = data.get('amount')
+    date = data.get('date')
+    interest = data.get('interest', 0)
+
+    if not name or not amount or not date:
+        raise HTTPException(status_code=400, detail="Missing required fields")
+
+    date = datetime.strptime(date,"%Y-%m-%d").date()
+
+    # a repayment, the interest rate it carries applies to the debt from that day on
+    new_debt = Debt(portfolio_id=portfolio_id, name=name, amount=amount, interest=interest, date=date, action='remove')
+
+    session.add(new_debt)
+    invalidateSnapshots(session, portfolio_id, date)
+    session.commit()
+
+    return {"message": f"Successfully repaid {amount} of debt ({name}) in {portfolio_id=} at {date}"}, 200
+
+@app.put("/real_estate/add/{portfolio_id}")
+async def add_real_estate(portfolio_id: int, request: Request, session: SessionDep):
+    data = await request.json()
+    name = data.get('name')
+    worth = data.get('worth')
+    date = data.get('date')
+
+    if not name or not worth or not date:
+        raise HTTPException(status_code=400, detail="Missing required fields")
+
+    date = datetime.strptime(date,"%Y-%m-%d").date()
+
+    new_real_estate = RealEstate(portfolio_id=portfolio_id, name=name, worth=worth, date=date, action='add')
+
+    session.add(new_real_estate)
+    invalidateSnapshots(session, portfolio_id, date)
+    session.commit()
+
+    return {"message": f"Successfully added {name} worth {worth} in {portfolio_id=} at {date}"}, 200
+
+@app.put("/real_estate/remove/{portfolio_id}")
+async def remove_real_estate(portfolio_id: int, request: Request, session: SessionDep):
+    data = await request.json()
+    name = data.get('name')
+    worth = data.get('worth')
+    date = data.get('date')
+
+    if not name or not worth or not date:
+        raise HTTPException(status_code=400, detail="Missing required fields")
+
+    date = datetime.strptime(date,"%Y-%m-%d").date()
+
+    new_real_estate = RealEstate(portfolio_id=portfolio_id, name=name, worth=worth, date=date, action='remove')
+
+    session.add(new_real_estate)
+    invalidateSnapshots(session, portfolio_id, date)
+    session.commit()
+
+    return {"message": f"Successfully removed {worth} of {name} in {portfolio_id=} at {date}"}, 200
+
+@app.put("/transactions/import/{portfolio_id}")
+async def import_transactions(portfolio_id: int, request: Request, session: SessionDep, import_format: ImportFormatQuery = "csv"):
+    body = await request.body()
+    
+    # parsing and validating a large file is cpu bound, it runs off the event loop
+    try:
+        imported = await to_thread.run_sync(importTransactions, session, portfolio_id, body, import_format)
+    except InvalidImportError as e:
+        raise HTTPException(status_code=422, detail={"message": "Could not import the transactions, nothing was added.", "errors": e.errors})
+    
+    if imported["stocks"]:
+        market_data_refresher.wake()
+    
+    return {"message": f"Successfully imported {imported['stocks']} stock and {imported['cash']} cash transactions in {portfolio_id=}"}, 200
+
+def cachedResponse(request: Request, session: Session, portfolio_id: int):
+    
+    # the portfolio's version is read before anything is computed: a write landing during the computation
+    # bumps it, so the next request computes again instead of matching a tag older than its data
+    etag = makeETag(request, getPortfolioVersion(session, portfolio_id))
+    
+    if etagMatches(request.headers.get("if-none-match"), etag):
+        return etag, notModified(etag)
     
-    current_date = datetime.now()
+    return etag, result_cache.get(requestKey(request), etag)
+
+def cacheResponse(request: Request, etag: str, response):
+    response.headers.update(cacheHeaders(etag))
+    result_cache.put(requestKey(request), etag, response)
+    return response
+
+async def valuatedAssets(assets, asset_records):
+    
+    # each asset is computed in the valuation pool, like any other valuation, after the first one (computed by the caller)
+    try:
+        while asset_records is not None:
+            yield asset_records
+            asset_records = await runValuation(next, assets, None)
+    finally:
+        assets.close()
+
+async def seriesEndpoint(request: Request, session: Session, portfolio_id: int, asset_type: Optional[str], start: Optional[date], end: Optional[date],
+                         resolution: str, response_format: str, dates: str):
+    
+    etag, response = cachedResponse(request, session, portfolio_id)
+    if response is not None:
+        return response
+    
+    until_date = getUntilDate(end)
     
-    all_assets = getHistoricalAssets(session, portfolio_id, current_date)
+    if response_format == "ndjson":
+        # a stream isn't kept by the result cache, but still answers If-None-Match
+        if not await runValuation(isSnapshotWarm, session, portfolio_id, until_date):
+            # nothing (or too much) is materialized: each asset is streamed as soon as it is valuated,
+            # and the series are materialized once the stream is sent, for the next requests
+            # the first asset is valuated before the response starts, so a failure (e.g. a missing exchange rate) still gets its status
+            assets = iterValuatedAssets(portfolio_id, until_date, asset_type, start, resolution)
+            assets = valuatedAssets(assets, await runValuation(next, assets, None))
+            background = BackgroundTask(runValuation, materializeSnapshots, portfolio_id, until_date)
+            return streamingSeriesResponse(assets, dates, headers=cacheHeaders(etag), background=background)
         
-    return all_assets
+        # the series are brought up to date first (today), then streamed one asset per line straight from the snapshots
+        from_day, unsaved_rows = await runValuation(prepareSnapshotSeries, session, portfolio_id, until_date, asset_type, start)
+        assets = iterSnapshotAssets(portfolio_id, until_date.date(), asset_type, from_day, resolution, unsaved_rows) if from_day is not False else iter(())
+        return streamingSeriesResponse(iterate_in_threadpool(assets), dates, headers=cacheHeaders(etag))
+    
+    series = await runValuation(getSnapshotSeries, session, portfolio_id, until_date, asset_type, start, resolution)
+        
+    return cacheResponse(request, etag, seriesResponse(series, response_format, dates))
+
+@app.get('/assets/{portfolio_id}')
+async def get_assets(portfolio_id: int, request: Request, session: SessionDep, start: Optional[date] = None, end: Optional[date] = None,
+                     resolution: ResolutionQuery = "daily", response_format: FormatQuery = "rows", dates: DatesQuery = "full"):
+    
+    return await seriesEndpoint(request, session, portfolio_id, None, start, end, resolution, response_format, dates)
     
 @app.get('/stocks/{portfolio_id}')
-async def get_stocks(portfolio_id: int, session: SessionDep):
+async def get_stocks(portfolio_id: int, request: Request, session: SessionDep, start: Optional[date] = None, end: Optional[date] = None,
+                     resolution: ResolutionQuery = "daily", response_format: FormatQuery = "rows", dates: DatesQuery = "full"):
         
-    current_date = datetime.now()
-    historical_stocks = getHistoricalStocks(session, portfolio_id, current_date)
-      
-    return historical_stocks
+    return await seriesEndpoint(request, session, portfolio_id, "stock", start, end, resolution, response_format, dates)
     
 @app.get('/cash/{portfolio_id}')
-async def get_cash(portfolio_id: int, session: SessionDep):
+async def get_cash(portfolio_id: int, request: Request, session: SessionDep, start: Optional[date] = None, end: Optional[date] = None,
+                   resolution: ResolutionQuery = "daily", response_format: FormatQuery = "rows", dates: DatesQuery = "full"):
     
-    current_date = datetime.now()
-    historical_cash = getHistoricalCash(session, portfolio_id, current_date)
-        
-    return historical_cash
+    return await seriesEndpoint(request, session, portfolio_id, "cash", start, end, resolution, response_format, dates)
+
+
+@app.get('/debt/{portfolio_id}')
+async def get_debt(portfolio_id: int, request: Request, session: SessionDep, start: Optional[date] = None, end: Optional[date] = None,
+                   resolution: ResolutionQuery = "daily", response_format: FormatQuery = "rows", dates: DatesQuery = "full"):
+    
+    return await seriesEndpoint(request, session, portfolio_id, "debt", start, end, resolution, response_format, dates)
+    
+@app.get('/real_estate/{portfolio_id}')
+async def get_real_estate(portfolio_id: int, request: Request, session: SessionDep, start: Optional[date] = None, end: Optional[date] = None,
+                          resolution: ResolutionQuery = "daily", response_format: FormatQuery = "rows", dates: DatesQuery = "full"):
+    
+    return await seriesEndpoint(request, session, portfolio_id, "real_estate", start, end, resolution, response_format, dates)
 
+@app.get('/networth/{portfolio_id}')
+async def get_net_worth(portfolio_id: int, request: Request, session: SessionDep, start: Optional[date] = None, end: Optional[date] = None,
+                        resolution: ResolutionQuery = "daily", breakdown: bool = False, dates: DatesQuery = "full"):
+    
+    etag, response = cachedResponse(request, session, portfolio_id)
+    if response is not None:
+        return response
+    
+    # the sum of every asset per day, so the client gets one array instead of one row per asset per day
+    until_date = getUntilDate(end)
+    net_worth_df = await runValuation(getNetWorthSeries, session, portfolio_id, until_date, start, resolution)
+    
+    return cacheResponse(request, etag, netWorthResponse(net_worth_df, breakdown, dates))
+
+@app.get('/positions/{portfolio_id}')
+async def get_positions(portfolio_id: int, session: SessionDep, lots: bool = False):
+    
+    # shares, cost basis and gains of every ticker from the ledger, valued at the last close
+    # ?lots=true adds the open lots of each ticker, oldest first
+    return await runValuation(getPositions, session, portfolio_id, lots)
+
+@app.put('/positions/method/{portfolio_id}')
+async def set_cost_basis_method(portfolio_id: int, request: Request, session: SessionDep):
+    data = await request.json()
+    method = data.get('method')
+    
+    if method not in COST_BASIS_METHODS:
+        raise HTTPException(status_code=400, detail=f"The cost basis method must be one of {', '.join(COST_BASIS_METHODS)}")
+    
+    portfolio = session.get(Portfolio, portfolio_id)
+    if portfolio is None:
+        raise HTTPException(status_code=404, detail="Portfolio not found")
+    
+    # the sales already recorded are matched again with the new method
+    portfolio.cost_basis_method = method
+    session.add(portfolio)
+    session.flush()
+    rebuildLedger(session, portfolio_id)
+    session.commit()
+    
+    return {"message": f"Cost basis of {portfolio_id=} is now computed with {method}"}, 200
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    
+    # prometheus text format: time per stage and per request, the history and result caches and the price refresher
+    extra_lines = statsLines("kyw_history_cache", history_cache.stats(), counters=("hits", "misses", "coalesced", "evictions", "expirations"))
+    extra_lines += statsLines("kyw_result_cache", result_cache.stats(), counters=("hits", "misses", "evictions"))
+    extra_lines += statsLines("kyw_price_refresher", market_data_refresher.stats(), counters=("refreshed", "failures", "rate_limited"))
+    
+    return PlainTextResponse(metricsText(extra_lines), media_type="text/plain; version=0.0.4")
 
 # @app.post("/login")
 # async def login(request: Request):
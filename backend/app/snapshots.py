@@ -0,0 +1,447 @@
+from datetime import date, datetime, timedelta
+from itertools import groupby
+import pandas as pd
+from sqlalchemy import text
+from sqlmodel import Session
+from app import yfinance_utils
+from app.currency import getBaseCurrency
+from app.valuation import ASSET_TYPES, getExchangeRates, getHistoricalPortfolio, loadTransactions, pricesStart, valuatePortfolio, valuationAxis
+from app.price_store import price_write_listeners
+from app.market_hours import marketToday
+from instance.config import getSession
+
+# The daily series of a portfolio are materialized in daily_snapshots.
+# snapshot_state.valid_until is the last materialized day that is final: a read only computes the days after it,
+# and a write only throws away the days from its transaction date on.
+# Today is never final (prices still move), so it is recomputed on every read, and neither is a day a held stock
+# has no price for. Prices saved later for a final day (a backfill, or a gap filled) throw away the days from it on.
+
+def getFirstTransactionDates(session: Session, portfolio_id: int, until_date: datetime) -> dict:
+
+    query = text("""
+        SELECT
+            (SELECT MIN(date(date)) FROM stock_holdings WHERE portfolio_id = :portfolio_id AND date < :until_date) AS stock,
+            (SELECT MIN(date(date)) FROM cash WHERE portfolio_id = :portfolio_id AND date < :until_date) AS cash,
+            (SELECT MIN(date(date)) FROM debt WHERE portfolio_id = :portfolio_id AND date < :until_date) AS debt,
+            (SELECT MIN(date(date)) FROM real_estate WHERE portfolio_id = :portfolio_id AND date < :until_date) AS real_estate
+    """)
+
+    result = session.exec(query.params(portfolio_id=portfolio_id, until_date=until_date)).first()
+
+    return dict(zip(ASSET_TYPES, result))
+
+def ensureSnapshotState(session: Session, portfolio_id: int):
+    session.exec(text("""
+        INSERT OR IGNORE INTO snapshot_state (portfolio_id, version) VALUES (:portfolio_id, 0)
+    """).params(portfolio_id=portfolio_id))
+
+def getSnapshotState(session: Session, portfolio_id: int):
+    query = text("SELECT first_date, valid_until, version FROM snapshot_state WHERE portfolio_id = :portfolio_id")
+    return session.exec(query.params(portfolio_id=portfolio_id)).first()
+
+def getPortfolioVersion(session: Session, portfolio_id: int) -> str:
+    # the version (bumped by every write to the portfolio) and the price version (bumped by every price refresh
+    # of its tickers), "0.0" before the first one
+    query = text("SELECT version, price_version FROM snapshot_state WHERE portfolio_id = :portfolio_id")
+    result = session.exec(query.params(portfolio_id=portfolio_id)).first()
+
+    if result is None:
+        return "0.0"
+    return f"{result.version}.{result.price_version or 0}"
+
+def bumpTickerVersions(session: Session, ticker: str):
+
+    # new prices change the series of every portfolio holding the ticker, but not their materialized days:
+    # only today is recomputed (the days before it are final), so only the price version moves. The version
+    # is left alone, a series being computed meanwhile is still saved
+    session.exec(text("""
+        INSERT OR IGNORE INTO snapshot_state (portfolio_id, version)
+        SELECT DISTINCT portfolio_id, 0 FROM stock_holdings WHERE ticker = :ticker
+    """).params(ticker=ticker))
+
+    session.exec(text("""
+        UPDATE snapshot_state
+        SET price_version = COALESCE(price_version, 0) + 1
+        WHERE portfolio_id IN (SELECT DISTINCT portfolio_id FROM stock_holdings WHERE ticker = :ticker)
+    """).params(ticker=ticker))
+
+def invalidateSnapshots(session: Session, portfolio_id: int, transaction_date: date):
+
+    # called in the same transaction as the write, the caller commits
+    ensureSnapshotState(session, portfolio_id)
+
+    day_before = (transaction_date - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    session.exec(text("""
+        UPDATE snapshot_state
+        SET version = version + 1,
+            valid_until = CASE WHEN valid_until IS NULL OR valid_until < :day_before THEN valid_until ELSE :day_before END
+        WHERE portfolio_id = :portfolio_id
+    """).params(portfolio_id=portfolio_id, day_before=day_before))
+
+    session.exec(text("""
+        DELETE FROM daily_snapshots WHERE portfolio_id = :portfolio_id AND date >= :from_date
+    """).params(portfolio_id=portfolio_id, from_date=transaction_date.strftime("%Y-%m-%d")))
+
+def invalidateTickerSnapshots(session: Session, ticker: str, first_day: date):
+
+    # new prices from first_day on, in the price store's transaction: only the portfolios holding the ticker
+    # with final days from there on are invalidated (a read computing its days saves them before they are final)
+    portfolio_ids = session.exec(text("""
+        SELECT portfolio_id FROM snapshot_state
+        WHERE valid_until >= :first_day
+            AND portfolio_id IN (SELECT DISTINCT portfolio_id FROM stock_holdings WHERE ticker = :ticker)
+    """).params(ticker=ticker, first_day=first_day.strftime("%Y-%m-%d"))).scalars().all()
+
+    for portfolio_id in portfolio_ids:
+        invalidateSnapshots(session, portfolio_id, first_day)
+
+price_write_listeners.append(invalidateTickerSnapshots)
+
+def snapshotRows(portfolio_id: int, asset_type: str, records: list) -> list[dict]:
+    return [
+        {
+            "portfolio_id": portfolio_id,
+            "asset_type": asset_type,
+            "name": record["name"],
+            "date": record["date"],
+            "price": record.get("price"),
+            "quantity": record.get("quantity"),
+            "interest": record.get("interest"),
+            "value": record["value"],
+            "shares": record.get("shares"),
+            "dividends": record.get("dividends"),
+            "total_return": record.get("total_return"),
+        }
+        for record in records
+    ]
+
+def computeSnapshotRows(session: Session, portfolio_id: int, until_date: datetime, from_day: date) -> tuple[list[dict], str]:
+    # every asset type from a single read of the transactions, on the portfolio's shared axis,
+    # and the first day a held stock has no price for (None when they all have one)
+    series = getHistoricalPortfolio(session, portfolio_id, until_date, from_day)
+    rows = [row for asset_type in ASSET_TYPES for row in snapshotRows(portfolio_id, asset_type, series[asset_type])]
+    return rows, series.get("unpriced_from")
+
+def refreshSnapshots(session: Session, portfolio_id: int, until_date: datetime) -> tuple[dict, list]:
+
+    # returns the first transaction date of each asset type, and the rows computed when they could not be saved
+    # (None once daily_snapshots holds the series)
+    first_dates = getFirstTransactionDates(session, portfolio_id, until_date)
+    known_first_dates = [first_date for first_date in first_dates.values() if first_date]
+
+    if not known_first_dates:
+        return first_dates, None
+
+    first_date = min(known_first_dates)
+    first_day = datetime.strptime(first_date, "%Y-%m-%d").date()
+    until_day = until_date.date()
+
+    ensureSnapshotState(session, portfolio_id)
+    session.commit()
+    state = getSnapshotState(session, portfolio_id)
+
+    # an earlier transaction moves the start of every series, everything is rebuilt
+    rebuild = state.first_date != first_date or state.valid_until is None
+
+    if rebuild:
+        from_day = first_day
+    else:
+        from_day = datetime.strptime(state.valid_until, "%Y-%m-%d").date() + timedelta(days=1)
+
+    if from_day > until_day:
+        return first_dates, None
+
+    rows, unpriced_from = computeSnapshotRows(session, portfolio_id, until_date, from_day)
+
+    # a new asset needs its rows since the first day of the portfolio too
+    if not rebuild:
+        known_assets = set(session.exec(text("""
+            SELECT DISTINCT asset_type, name FROM daily_snapshots WHERE portfolio_id = :portfolio_id
+        """).params(portfolio_id=portfolio_id)).all())
+
+        if any((row["asset_type"], row["name"]) not in known_assets for row in rows):
+            rebuild = True
+            from_day = first_day
+            rows, unpriced_from = computeSnapshotRows(session, portfolio_id, until_date, from_day)
+
+    valid_until = min(until_day, marketToday() - timedelta(days=1))
+
+    # the days from the first one without a price are saved but not final, the next read computes them again
+    if unpriced_from:
+        valid_until = min(valid_until, datetime.strptime(unpriced_from, "%Y-%m-%d").date() - timedelta(days=1))
+
+    # only saved if no write happened to the portfolio while we were computing
+    updated = session.exec(text("""
+        UPDATE snapshot_state
+        SET first_date = :first_date, valid_until = :valid_until
+        WHERE portfolio_id = :portfolio_id AND version = :version
+    """).params(portfolio_id=portfolio_id, first_date=first_date, version=state.version,
+                valid_until=valid_until.strftime("%Y-%m-%d") if valid_until >= first_day else None))
+
+    if updated.rowcount != 1:
+        # nothing is saved (the next read computes again), but this read still gets its series: the whole of it,
+        # since the write may have dropped the saved days before from_day
+        session.rollback()
+        if not rebuild:
+            rows, _ = computeSnapshotRows(session, portfolio_id, until_date, first_day)
+        return first_dates, rows
+
+    # a rebuild drops everything, otherwise only today's unfinished rows are replaced
+    stale_from = "0000-00-00" if rebuild else from_day.strftime("%Y-%m-%d")
+    session.exec(text("""
+        DELETE FROM daily_snapshots WHERE portfolio_id = :portfolio_id AND date >= :from_date
+    """).params(portfolio_id=portfolio_id, from_date=stale_from))
+
+    if rows:
+        session.exec(text("""
+            INSERT OR REPLACE INTO daily_snapshots (portfolio_id, asset_type, name, date, price, quantity, interest, value,
+                shares, dividends, total_return)
+            VALUES (:portfolio_id, :asset_type, :name, :date, :price, :quantity, :interest, :value,
+                :shares, :dividends, :total_return)
+        """), params=rows)
+
+    session.commit()
+
+    return first_dates, None
+
+# points kept for each resolution: the last day of each week (sunday) or month, and always the last day of the range
+RESOLUTION_FILTERS = {
+    "daily": "",
+    "weekly": " AND (strftime('%w', date) = '0' OR date = :until_day)",
+    "monthly": " AND (date = date(date, 'start of month', '+1 month', '-1 day') OR date = :until_day)",
+}
+
+def isKeptAtResolution(day: str, until_day: str, resolution: str) -> bool:
+    # RESOLUTION_FILTERS, for rows that are not in daily_snapshots
+    if resolution == "daily" or day == until_day:
+        return True
+
+    row_day = datetime.strptime(day, "%Y-%m-%d").date()
+    if resolution == "weekly":
+        return row_day.weekday() == 6
+    return (row_day + timedelta(days=1)).day == 1
+
+def selectRows(rows: list, until_day: date, asset_type: str = None, from_day: str = None, resolution: str = "daily") -> list:
+
+    # what snapshotQuery reads, from the rows of a series that could not be saved
+    until_str = until_day.strftime("%Y-%m-%d")
+
+    selected = [
+        row for row in rows
+        if row["date"] <= until_str
+            and (not asset_type or row["asset_type"] == asset_type)
+            and (not from_day or row["date"] >= from_day)
+            and isKeptAtResolution(row["date"], until_str, resolution)
+    ]
+
+    # the same order: stocks first, then cash, each asset's days in order
+    selected.sort(key=lambda row: (row["name"], row["date"]))
+    selected.sort(key=lambda row: row["asset_type"], reverse=True)
+
+    return selected
+
+def snapshotQuery(portfolio_id: int, until_day: date, asset_type: str = None, from_day: str = None, resolution: str = "daily"):
+
+    query = """
+        SELECT asset_type, name, date, price, quantity, interest, value, shares, dividends, total_return
+        FROM daily_snapshots
+        WHERE portfolio_id = :portfolio_id AND date <= :until_day
+    """
+    params = {"portfolio_id": portfolio_id, "until_day": until_day.strftime("%Y-%m-%d")}
+
+    if asset_type:
+        query += " AND asset_type = :asset_type"
+        params.update(asset_type=asset_type)
+
+    if from_day:
+        query += " AND date >= :from_day"
+        params.update(from_day=from_day)
+
+    query += RESOLUTION_FILTERS[resolution]
+
+    # stocks first, then cash, each asset's days in order
+    query += " ORDER BY asset_type DESC, name, date"
+
+    return text(query).params(**params)
+
+def snapshotRecord(row) -> dict:
+    # row is a mapping, a daily_snapshots row's or one of snapshotRows
+    if row["asset_type"] == "stock":
+        return {"name": row["name"], "date": row["date"], "price": row["price"], "quantity": row["quantity"], "value": row["value"],
+                "shares": row["shares"], "dividends": row["dividends"], "total_return": row["total_return"]}
+    if row["asset_type"] == "real_estate":
+        return {"name": row["name"], "value": row["value"], "date": row["date"], "type": row["asset_type"]}
+    if row["asset_type"] == "debt":
+        return {"name": row["name"], "value": row["value"], "interest": row["interest"], "date": row["date"], "type": row["asset_type"]}
+    return {"name": row["name"], "value": row["value"], "interest": row["interest"], "date": row["date"]}
+
+def readSnapshots(session: Session, portfolio_id: int, until_day: date, asset_type: str = None, from_day: str = None, resolution: str = "daily") -> list:
+    results = session.exec(snapshotQuery(portfolio_id, until_day, asset_type, from_day, resolution)).mappings().all()
+    return [snapshotRecord(row) for row in results]
+
+def iterSnapshotAssets(portfolio_id: int, until_day: date, asset_type: str = None, from_day: str = None, resolution: str = "daily",
+                       unsaved_rows: list = None):
+
+    # one asset's records at a time, read from the cursor as they are consumed (or from the unsaved rows)
+    # the generator outlives the request's session (it is consumed while the response streams), so it has its own
+    if unsaved_rows is not None:
+        rows = selectRows(unsaved_rows, until_day, asset_type, from_day, resolution)
+        for _, asset_rows in groupby(rows, key=lambda row: (row["asset_type"], row["name"])):
+            yield [snapshotRecord(row) for row in asset_rows]
+        return
+
+    with getSession() as session:
+        results = session.exec(snapshotQuery(portfolio_id, until_day, asset_type, from_day, resolution)).mappings()
+
+        for _, rows in groupby(results, key=lambda row: (row["asset_type"], row["name"])):
+            yield [snapshotRecord(row) for row in rows]
+
+def prepareSnapshotSeries(session: Session, portfolio_id: int, until_date: datetime, asset_type: str = None, start_date: date = None):
+
+    # only the days up to until_date are materialized, and only the window from start_date is read
+    # returns the first day to read (False when there is nothing to read), and the rows to read instead of
+    # daily_snapshots when they could not be saved (None otherwise)
+    first_dates, unsaved_rows = refreshSnapshots(session, portfolio_id, until_date)
+
+    from_day = start_date.strftime("%Y-%m-%d") if start_date else None
+
+    if asset_type:
+        # a single asset type starts at its own first transaction
+        if not first_dates[asset_type]:
+            return False, None
+        from_day = max(from_day or first_dates[asset_type], first_dates[asset_type])
+
+    return from_day, unsaved_rows
+
+def isSnapshotWarm(session: Session, portfolio_id: int, until_date: datetime) -> bool:
+
+    # whether the materialized series only miss their days from today on (or none), as refreshSnapshots would find them
+    first_dates = getFirstTransactionDates(session, portfolio_id, until_date)
+    known_first_dates = [first_date for first_date in first_dates.values() if first_date]
+
+    if not known_first_dates:
+        return True
+
+    state = getSnapshotState(session, portfolio_id)
+    if state is None or state.valid_until is None or state.first_date != min(known_first_dates):
+        return False
+
+    last_final_day = min(until_date.date(), marketToday() - timedelta(days=1))
+    return datetime.strptime(state.valid_until, "%Y-%m-%d").date() >= last_final_day
+
+def materializeSnapshots(portfolio_id: int, until_date: datetime):
+    # with its own session, e.g. once a response computed from the valuation was sent
+    with getSession() as session:
+        refreshSnapshots(session, portfolio_id, until_date)
+
+def iterValuatedAssets(portfolio_id: int, until_date: datetime, asset_type: str = None, start_date: date = None, resolution: str = "daily"):
+
+    # the records of prepareSnapshotSeries and iterSnapshotAssets, computed one asset at a time instead of read:
+    # a portfolio whose series aren't materialized yet starts streaming once its first ticker is valuated,
+    # and only holds one asset's matrices (the histories of every ticker are loaded meanwhile on the fetch pool)
+    # nothing is saved, see materializeSnapshots
+    with getSession() as session:
+        asset_types = (asset_type,) if asset_type else ASSET_TYPES
+        transactions_df, first_transaction_date = loadTransactions(session, portfolio_id, until_date, asset_types)
+
+        if transactions_df.empty:
+            return
+
+        base_currency = getBaseCurrency(session, portfolio_id)
+
+    until_day = until_date.date()
+    first_date = datetime.strptime(first_transaction_date, "%Y-%m-%d").date()
+    from_date = start_date
+
+    if asset_type:
+        # a single asset type starts at its own first transaction
+        first_type_date = transactions_df["date"].min().date()
+        from_date = max(from_date or first_type_date, first_type_date)
+
+    from_day = from_date.strftime("%Y-%m-%d") if from_date else None
+
+    def assetRecords(asset_type: str, records: list):
+        rows = selectRows(snapshotRows(portfolio_id, asset_type, records), until_day, None, from_day, resolution)
+        for _, asset_rows in groupby(rows, key=lambda row: row["name"]):
+            yield [snapshotRecord(row) for row in asset_rows]
+
+    # stocks first, one ticker at a time
+    stock_df = transactions_df[transactions_df["asset_type"] == "stock"]
+    if not stock_df.empty:
+        tickers = sorted(stock_df["name"].unique())
+        all_days, first_output = valuationAxis(first_date, until_date, from_date)
+        yfinance_utils.prefetchHistories(tickers, pricesStart(all_days, first_output), until_date)
+
+        # every currency is checked before the first ticker is sent: a missing exchange rate fails the whole series
+        if base_currency:
+            getExchangeRates(tickers, base_currency, all_days, until_date)
+
+        for ticker in tickers:
+            series = valuatePortfolio(stock_df[stock_df["name"] == ticker], first_date, until_date, from_date, ("stock",), base_currency)
+            yield from assetRecords("stock", series["stock"])
+
+    # then every account at once, they don't download anything
+    accounts_df = transactions_df[transactions_df["asset_type"] != "stock"]
+    if not accounts_df.empty:
+        account_types = tuple(sorted(set(accounts_df["asset_type"]), reverse=True))
+        series = valuatePortfolio(accounts_df, first_date, until_date, from_date, account_types, base_currency)
+        for account_type in account_types:
+            yield from assetRecords(account_type, series[account_type])
+
+def getSnapshotSeries(session: Session, portfolio_id: int, until_date: datetime, asset_type: str = None, start_date: date = None, resolution: str = "daily") -> list:
+
+    from_day, unsaved_rows = prepareSnapshotSeries(session, portfolio_id, until_date, asset_type, start_date)
+
+    if from_day is False:
+        return []
+
+    if unsaved_rows is not None:
+        return [snapshotRecord(row) for row in selectRows(unsaved_rows, until_date.date(), asset_type, from_day, resolution)]
+
+    return readSnapshots(session, portfolio_id, until_date.date(), asset_type, from_day, resolution)
+
+def readNetWorth(session: Session, portfolio_id: int, until_day: date, from_day: str = None, resolution: str = "daily") -> pd.DataFrame:
+
+    # summed per day and asset type by sqlite, then aligned as one column per asset type
+    query = """
+        SELECT date, asset_type, SUM(value) AS value
+        FROM daily_snapshots
+        WHERE portfolio_id = :portfolio_id AND date <= :until_day
+    """
+    params = {"portfolio_id": portfolio_id, "until_day": until_day.strftime("%Y-%m-%d")}
+
+    if from_day:
+        query += " AND date >= :from_day"
+        params.update(from_day=from_day)
+
+    query += RESOLUTION_FILTERS[resolution]
+    query += " GROUP BY date, asset_type"
+
+    results = session.exec(text(query).params(**params)).all()
+
+    if not results:
+        return pd.DataFrame()
+
+    values_df = pd.DataFrame(results, columns=["date", "asset_type", "value"])
+
+    return values_df.pivot(index="date", columns="asset_type", values="value").fillna(0).sort_index()
+
+def netWorthOfRows(rows: list) -> pd.DataFrame:
+    # readNetWorth, from the rows of a series that could not be saved
+    if not rows:
+        return pd.DataFrame()
+
+    values_df = pd.DataFrame(rows, columns=["date", "asset_type", "value"])
+
+    return values_df.groupby(["date", "asset_type"])["value"].sum().unstack().fillna(0).sort_index()
+
+def getNetWorthSeries(session: Session, portfolio_id: int, until_date: datetime, start_date: date = None, resolution: str = "daily") -> pd.DataFrame:
+
+    # one row per day, one column per asset type, the net worth is their sum
+    from_day, unsaved_rows = prepareSnapshotSeries(session, portfolio_id, until_date, None, start_date)
+
+    if unsaved_rows is not None:
+        return netWorthOfRows(selectRows(unsaved_rows, until_date.date(), None, from_day, resolution))
+
+    return readNetWorth(session, portfolio_id, until_date.date(), from_day, resolution)
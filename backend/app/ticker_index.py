@@ -0,0 +1,256 @@
+import csv
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+import requests
+import yfinance as yf
+from yfinance.exceptions import YFTickerMissingError
+from sqlalchemy import text
+from instance import config
+
+# US listings published daily by Nasdaq Trader, pipe separated with a header and a "File Creation Time" footer
+NASDAQ_LISTINGS = {
+    "https://www.nasdaqtrader.com/dynamic/SymDir/nasdaqlisted.txt": "Symbol",
+    "https://www.nasdaqtrader.com/dynamic/SymDir/otherlisted.txt": "ACT Symbol",
+}
+
+def prefixRange(sorted_keys: list, prefix: str) -> tuple[int, int]:
+    return bisect_left(sorted_keys, prefix), bisect_left(sorted_keys, prefix + "\uffff")
+
+def marketSuffix(symbol: str) -> str:
+    # yahoo suffixes the symbols listed outside of the US with their exchange, e.g. VFV.TO
+    _, dot, suffix = symbol.rpartition(".")
+    return suffix if dot else ""
+
+# the kinds of symbols in the Nasdaq Trader files: stocks and ETFs, with their share classes, preferreds and
+# warrants (BRK-B, ACHR-WS). Not indices (^GSPC), currencies or futures (CADUSD=X), crypto (BTC-USD),
+# mutual funds (VFIAX, fifth letter X) nor foreign shares and ADRs traded over the counter (NSRGF, NSRGY)
+LISTED_SYMBOL = re.compile(r"[A-Z]{1,5}([-$][A-Z]{1,2})?")
+UNLISTED_FIFTH_LETTERS = "XFY"
+
+def isListedKind(symbol: str) -> bool:
+    base = symbol.rpartition(".")[0] if marketSuffix(symbol) else symbol
+    if not LISTED_SYMBOL.fullmatch(base):
+        return False
+
+    root = re.split(r"[-$]", base)[0]
+    return not (len(root) == 5 and root[-1] in UNLISTED_FIFTH_LETTERS)
+
+def withinOneEdit(a: str, b: str) -> bool:
+    # one insertion, deletion or substitution at most
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
+
+class TickerIndex:
+    """
+    Symbols and names of the listed securities, searched without any network call.
+
+    The symbols are kept in a sorted array and every word of the names in another one,
+    so a prefix is two binary searches. Fuzzy matches (one typo in the symbol) are only
+    looked for when the prefixes don't fill the results. Never modified once built.
+    """
+
+    def __init__(self, listing: dict[str, str], held_symbols: list[str] = ()):
+        # only the markets of the listing are covered, a held symbol doesn't make its whole market known
+        self.markets = {marketSuffix(symbol.upper()) for symbol in listing}
+
+        self.names = {symbol.upper(): name for symbol, name in listing.items()}
+        for symbol in held_symbols:
+            self.names.setdefault(symbol.upper(), "")
+        self.symbols = sorted(self.names)
+
+        self.words = sorted(
+            (word, symbol)
+            for symbol, name in self.names.items()
+            for word in set((name or "").upper().split())
+        )
+        self.word_keys = [word for word, _ in self.words]
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __contains__(self, symbol: str):
+        return symbol.upper() in self.names
+
+    def covers(self, symbol: str) -> bool:
+        # only the markets that are part of the listing can tell a symbol doesn't exist, and only for the kinds
+        # of symbols it lists
+        symbol = symbol.upper()
+        return marketSuffix(symbol) in self.markets and isListedKind(symbol)
+
+    def search(self, query: str, limit: int = 3) -> list[str]:
+        query = query.strip().upper()
+        if not query or not self.symbols:
+            return []
+
+        results = {}
+
+        # symbols starting with the query, the exact match first since it sorts first
+        start, end = prefixRange(self.symbols, query)
+        for symbol in self.symbols[start:min(end, start + limit)]:
+            results[symbol] = None
+
+        # then names with a word starting with the query
+        if len(results) < limit:
+            start, end = prefixRange(self.word_keys, query)
+            for _, symbol in self.words[start:end]:
+                results[symbol] = None
+                if len(results) >= limit:
+                    break
+
+        # then symbols one typo away, among the ones with the same first letter
+        if len(results) < limit and len(query) > 1:
+            start, end = prefixRange(self.symbols, query[0])
+            for symbol in self.symbols[start:end]:
+                if withinOneEdit(query, symbol):
+                    results[symbol] = None
+                    if len(results) >= limit:
+                        break
+
+        return list(results)[:limit]
+
+def readListing(path: str) -> dict[str, str]:
+    with open(path, newline="", encoding="utf-8") as listing_file:
+        return {row["symbol"]: row["name"] for row in csv.DictReader(listing_file) if row.get("symbol")}
+
+def writeListing(path: str, listing: dict[str, str]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", newline="", encoding="utf-8") as listing_file:
+        writer = csv.writer(listing_file)
+        writer.writerow(["symbol", "name"])
+        writer.writerows(sorted(listing.items()))
+
+    os.replace(temporary_path, path)
+
+def downloadNasdaqListing() -> dict[str, str]:
+    listing = {}
+
+    for url, symbol_column in NASDAQ_LISTINGS.items():
+        response = requests.get(url, timeout=30)
+        response.raise_for_status()
+
+        lines = [line for line in response.text.splitlines() if line and not line.startswith("File Creation Time")]
+        for row in csv.DictReader(lines, delimiter="|"):
+            if row.get("Test Issue") == "Y" or not row.get(symbol_column):
+                continue
+            # share classes are BRK.B on the exchanges, BRK-B on yahoo
+            listing[row[symbol_column].replace(".", "-")] = row["Security Name"]
+
+    return listing
+
+def getHeldSymbols() -> list[str]:
+    with config.getSession() as session:
+        return session.exec(text("SELECT DISTINCT ticker FROM stock_holdings")).scalars().all()
+
+def loadListing(path: str, max_age_days: int) -> dict[str, str]:
+    listing = {}
+
+    if os.path.exists(path):
+        listing = readListing(path)
+
+    is_stale = not listing or time.time() - os.path.getmtime(path) > max_age_days * 86400
+
+    if is_stale:
+        try:
+            downloaded = downloadNasdaqListing()
+            # the symbols added by hand (e.g. TSX ones) are kept across downloads
+            listing.update(downloaded)
+            writeListing(path, listing)
+        except Exception as e:
+            print(f"Could not download the ticker listing: {e}")
+
+    return listing
+
+ticker_index = TickerIndex({})
+_load_lock = threading.Lock()
+
+def loadTickerIndex():
+    global ticker_index
+
+    with _load_lock:
+        listing = loadListing(config.TICKER_LISTING_PATH, config.TICKER_LISTING_MAX_AGE_DAYS)
+
+        # tickers already held are searchable even when their market isn't in the listing
+        ticker_index = TickerIndex(listing, getHeldSymbols())
+
+def loadTickerIndexInBackground():
+    threading.Thread(target=loadTickerIndex, name="ticker-index", daemon=True).start()
+
+def searchTickers(query: str, limit: int = 3) -> list[str]:
+    return ticker_index.search(query, limit)
+
+class TickerLookupError(Exception):
+    """Yahoo Finance could not be asked about a symbol (network, throttled), the request can be retried later."""
+
+# Yahoo's answers for the symbols missing from the listing, so a file repeating one asks once:
+# symbol -> (quoted, expires_at or None), the least recently asked are dropped past MAX_YAHOO_ANSWERS
+MAX_YAHOO_ANSWERS = 10_000
+_quoted_on_yahoo = OrderedDict()
+_quoted_lock = threading.Lock()
+
+def cachedYahooAnswer(symbol: str):
+    with _quoted_lock:
+        answer = _quoted_on_yahoo.get(symbol)
+        if answer is None:
+            return None
+
+        quoted, expires_at = answer
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del _quoted_on_yahoo[symbol]
+            return None
+
+        _quoted_on_yahoo.move_to_end(symbol)
+        return quoted
+
+def saveYahooAnswer(symbol: str, quoted: bool, ttl_seconds: float = None):
+    with _quoted_lock:
+        _quoted_on_yahoo[symbol] = (quoted, time.monotonic() + ttl_seconds if ttl_seconds is not None else None)
+        _quoted_on_yahoo.move_to_end(symbol)
+
+        while len(_quoted_on_yahoo) > MAX_YAHOO_ANSWERS:
+            _quoted_on_yahoo.popitem(last=False)
+
+def isQuotedOnYahoo(symbol: str) -> bool:
+    # raises TickerLookupError when Yahoo can't answer, nothing is kept then: the next request asks again
+    quoted = cachedYahooAnswer(symbol)
+    if quoted is not None:
+        return quoted
+
+    try:
+        yf.Ticker(symbol).history(period="5d", raise_errors=True)
+    except YFTickerMissingError:
+        # no prices, possibly delisted. yfinance raises the same (no timezone found) when its first request was
+        # throttled, so the answer is only kept for a while
+        saveYahooAnswer(symbol, False, config.TICKER_UNKNOWN_TTL_MINUTES * 60)
+        return False
+    except Exception as e:
+        raise TickerLookupError(f"Could not look {symbol} up on Yahoo Finance: {e}") from e
+
+    saveYahooAnswer(symbol, True)
+    return True
+
+def isUnknownTicker(symbol: str) -> bool:
+    # False when the listing can't tell (not loaded yet, another market or a kind of symbol it doesn't list),
+    # the request then goes through. A symbol it should list but doesn't (listed since the download, or moved
+    # over the counter) is only unknown once Yahoo confirms it, which makes a request: call it off the event loop
+    # (and it raises TickerLookupError when Yahoo can't be reached)
+    index = ticker_index
+    if not index.covers(symbol) or symbol in index:
+        return False
+
+    return not isQuotedOnYahoo(symbol)
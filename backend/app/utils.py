@@ -1,12 +1,18 @@
 from instance import config
 from sqlmodel import SQLModel, Field, create_engine, Session
 from sqlalchemy import text
-from datetime import datetime, timedelta
-from dateutil.rrule import rrule, DAILY
-from .yfinance_utils import getDailyValue, getStockHistory
+from datetime import date, datetime, timedelta
+import numpy as np
+import pandas as pd
+from .yfinance_utils import getDailyValue, fetchConcurrently
+from .interest import getDailyAccountBalances
+from .valuation import ASSET_TYPES, getHistoricalPortfolio
+from .ticker_index import searchTickers
+from .instrumentation import timing
 
 from collections import defaultdict
 
+
 def getRemainingCash(session: Session, portfolio_id: int) -> float:
     query = text("""
         WITH adjusted_cash AS (
@@ -33,483 +39,133 @@ def getRemainingCash(session: Session, portfolio_id: int) -> float:
 
 def getRemainingShares(session : Session, portfolio_id : int, ticker = str) -> float:
     
+    # the ticker's position in the cost basis ledger, kept up to date by every transaction (see app/ledger.py)
     query = text("""
-        WITH adjusted_shares AS (
-            SELECT ticker,
-                CASE
-                    WHEN action = 'remove' THEN -amount
-                    ELSE amount
-                END AS adjusted_amount
-            FROM stock_holdings
-            WHERE portfolio_id=:portfolio_id AND ticker=:ticker
-        )
-        SELECT ticker, SUM(adjusted_amount) AS amount
-        FROM adjusted_shares
-        GROUP BY ticker
+        SELECT shares
+        FROM stock_positions
+        WHERE portfolio_id=:portfolio_id AND ticker=:ticker
     """)
 
     result = session.exec(query.params(portfolio_id=portfolio_id, ticker=ticker)).first()
     
     if result is None:
-        print("No results found.")
         return 0.0
     
-    return result.amount
+    return result.shares
 
-def getFirstTransactionDate(session: Session, portfolio_id: int, until_date: datetime) -> datetime:
+def getHistoricalAssets(session : Session, portfolio_id : int, until_date : datetime, from_date : date = None) -> list:
+    # every series of the portfolio, all on the axis starting at its first transaction
+    series = getHistoricalPortfolio(session, portfolio_id, until_date, from_date)
     
-    query = text("""
-                 SELECT MIN(date(date)) as first_transaction_date
-                 FROM stock_holdings sh
-                 WHERE sh.portfolio_id = :portfolio_id AND sh.date < :until_date
-                 UNION
-                 SELECT MIN(date(date)) as first_transaction_date
-                 FROM cash c
-                 WHERE c.portfolio_id = :portfolio_id AND c.date < :until_date
-                 """)
-    
-    result = session.exec(query.params(portfolio_id=portfolio_id, until_date=until_date)).first()
-    
-    if result and result.first_transaction_date:
-        return result.first_transaction_date
-    else:
-        # Return None if no results found or if the date is invalid
-        return None
-    
-def getHistoricalAssets(session : Session, portfolio_id : int, until_date : datetime) -> list:
-    allStocks = getHistoricalStocks(session, portfolio_id, until_date, True)
-    allCash = getHistoricalCash(session, portfolio_id, until_date, True)
-    
-    return(allStocks + allCash)
-
-def getHistoricalStocks(session : Session, portfolio_id : int, until_date : datetime, consider_all_assets : bool = False) -> list:
-
-    query = text("""
-        WITH calculated_basis AS (
-            SELECT 
-                ticker,
-                CASE
-                    WHEN action = 'add' THEN amount
-                    ELSE -amount
-                END AS adjusted_amount,
-                CASE
-                    WHEN action = 'add' THEN (amount * (price + COALESCE(fees, 0) / NULLIF(amount, 0)))
-                    ELSE 0
-                END AS adjusted_cost,
-                date(date) AS transaction_date,
-                drip,
-                fees
-            FROM stock_holdings
-            WHERE portfolio_id = :portfolio_id AND date < :until_date
-        )
-        SELECT 
-            ticker,
-            transaction_date,
-            SUM(adjusted_cost) / NULLIF(SUM(CASE WHEN adjusted_amount > 0 THEN adjusted_amount ELSE 0 END), 0) AS avg_cost_basis,
-            SUM(adjusted_amount) AS total_shares,
-            drip,
-            fees
-        FROM calculated_basis
-        GROUP BY ticker, transaction_date
-        HAVING SUM(adjusted_amount) > 0;
-    """)
+    return [record for asset_type in ASSET_TYPES for record in series[asset_type]]
 
-    results = session.exec(query.params(portfolio_id=portfolio_id, until_date=until_date)).all()
-    
-    if results is None:
-        print("No results found.")
-        return 0.0
-    
-    current_stocks = [
-        {
-            'name' : result.ticker,
-            'quantity' : result.total_shares,
-            'price' : result.avg_cost_basis,
-            'date' : result.transaction_date,
-            'drip' : result.drip,
-            'fees' : result.fees,
-        }
-    for result in results]
-        
-    first_date = None
-    
-    if consider_all_assets:
-        first_date = getFirstTransactionDate(session, portfolio_id, until_date)
-    
-    
-    historical_stocks = populateDailyStocks(until_date, current_stocks, first_date)
+def getHistoricalStocks(session : Session, portfolio_id : int, until_date : datetime, consider_all_assets : bool = False, from_date : date = None) -> list:
+    return getHistoricalPortfolio(session, portfolio_id, until_date, from_date, ("stock",), consider_all_assets)["stock"]
 
+def getHistoricalCash(session : Session, portfolio_id : int, until_date : datetime, consider_all_assets : bool = False, from_date : date = None) -> list:
+    return getHistoricalPortfolio(session, portfolio_id, until_date, from_date, ("cash",), consider_all_assets)["cash"]
 
-    return historical_stocks
+def getHistoricalDebt(session : Session, portfolio_id : int, until_date : datetime, consider_all_assets : bool = False, from_date : date = None) -> list:
+    return getHistoricalPortfolio(session, portfolio_id, until_date, from_date, ("debt",), consider_all_assets)["debt"]
 
-def populateDailyStocks(until_date: datetime, historical_stocks: list, first_transaction_date: datetime = None) -> list:
-    if not historical_stocks:
-        return []
+def getHistoricalRealEstate(session : Session, portfolio_id : int, until_date : datetime, consider_all_assets : bool = False, from_date : date = None) -> list:
+    return getHistoricalPortfolio(session, portfolio_id, until_date, from_date, ("real_estate",), consider_all_assets)["real_estate"]
 
-    historical_dict = defaultdict(lambda: defaultdict(lambda: 0))  # Default value of 0 for missing data
-    for entry in historical_stocks:
-        key = (entry["name"], entry["date"])
-        historical_dict[key] = {
-            "price": entry["price"],
-            "amount": entry["quantity"],
-        }
+def getTop3Tickers(substring : str) -> list[str]:
+    return searchTickers(substring, 3)
 
-    first_date = datetime.strptime(historical_stocks[0]["date"], "%Y-%m-%d").date()
-    
-    #tickers = {entry["name"] for entry in historical_stocks}
-    
-    tickers = {}
-    for entry in historical_stocks:
-        tickers[entry['name']] = entry["drip"]
-        
-        date = datetime.strptime(entry["date"], "%Y-%m-%d").date()
-        if date < first_date:
-            first_date = date
+def getDailyValueRealEstate(real_estate_transactions:list[tuple], until_date) -> dict:
+    # (name, worth, date, action) rows: every property's worth adds up (without interest), summed over the properties
+    transactions = [(name, worth, 0, transaction_date, action) for name, worth, transaction_date, action in real_estate_transactions]
+    return getDailyBalances(transactions, until_date, 1)
 
+@timing("valuate")
+def getDailyBalances(transactions: list[tuple], until_date, sign: int) -> dict:
     
-    if first_transaction_date:
-        first_date = datetime.strptime(first_transaction_date, "%Y-%m-%d").date()
+    # transactions are (name, amount, interest, date, action) rows, every name is its own account
+    # with the rate of its latest transaction, balances are summed over the accounts
     
-    last_date = until_date.date()
+    if not transactions:
+        return {}
     
-    populated_stocks = {ticker: [] for ticker in tickers}
-
-    for ticker, drip in tickers.items():
-        
-        # get stock price change via yfinance
-        stock_history = getStockHistory(ticker, first_date, until_date)
-        
-        last_known_price = 0
-        last_known_amount = 0
-        stock_purchased = False  # Track if any stock has been purchased
-
-        current_date = first_date
-        while current_date <= last_date:
-            date_str = current_date.strftime("%Y-%m-%d")
-            key = (ticker, date_str)
-            
-            price_change = 0
-            price_today = 0
-            price_yesterday = 0
-            
-            price_today_series = stock_history[stock_history['date'] == date_str]['close']
-            
-            #TODO: check if dividend
-            
-            
-            if len(price_today_series.values) > 0:
-                price_today = price_today_series.values[0]
-                
-            if (current_date - timedelta(days=1)) > first_date and price_today != 0:
-                price_yesterday_series = stock_history[stock_history['date'] == (current_date - timedelta(days=1)).strftime("%Y-%m-%d")]['close']
-
-                if len(price_yesterday_series.values) > 0:
-                    price_yesterday = price_yesterday_series.values[0]
-                
-            
-            if price_yesterday:
-                price_change = price_today - price_yesterday
-                
-            if key in historical_dict:
-                data = historical_dict[key]
-                last_known_price = data["price"]
-                last_known_amount = data["amount"]
-                stock_purchased = True
-                value = (data["price"] + price_change) * data['amount']
-            else:
-                if stock_purchased:
-                    value = (last_known_price + price_change) * last_known_amount
-                else:
-                    value = 0  # If no stock purchased yet, set value to 0
-
-            populated_stocks[ticker].append({
-                "name": ticker,
-                "date": date_str,
-                "price": last_known_price,
-                "quantity": last_known_amount,
-                "value": value
-            })
-
-            current_date += timedelta(days=1)
-
-    result = []
-    for records in populated_stocks.values():
-        result.extend(records)
-
-    return result
-
-def getHistoricalCash(session : Session, portfolio_id : int, until_date : datetime, consider_all_assets : bool = False) -> list:
-        
-    query = text("""
-    SELECT 
-        date(date) AS transaction_date,
-        SUM(CASE WHEN action = 'add' THEN amount ELSE -amount END) AS daily_net_change,
-        interest,
-        name
-    FROM cash
-    WHERE portfolio_id = :portfolio_id AND date < :until_date
-    GROUP BY transaction_date, portfolio_id
-    ORDER BY transaction_date;
-    """)
-
-    results = session.exec(query.params(portfolio_id=portfolio_id, until_date=until_date)).all()
+    transactions_df = pd.DataFrame(transactions, columns=["name", "amount", "interest", "date", "action"])
+    transactions_df["name"] = transactions_df["name"].fillna("")
+    transactions_df["date"] = pd.to_datetime(transactions_df["date"], format="ISO8601").dt.normalize()
+    transactions_df["interest"] = transactions_df["interest"].fillna(0)
     
-    historical_cash = [{"value": row[1], "date": row[0], "interest" : row[2], "name" : row[3] if row[3] else "Cash"} for row in results]
+    withdrawn = transactions_df["action"].isin(["remove", "sell"])
+    transactions_df["flow"] = sign * np.where(withdrawn, -transactions_df["amount"], transactions_df["amount"])
     
-    first_date = None
+    all_days = pd.date_range(transactions_df["date"].min(), pd.Timestamp(until_date).normalize(), freq="D")
     
-    if consider_all_assets:
-        first_date = getFirstTransactionDate(session, portfolio_id, until_date)
-            
-    historical_cash = populateDailyCash(until_date, historical_cash, first_date)
-      
-    return historical_cash
-
-def populateDailyCash(until_date: datetime, historical_cash: list, first_transaction_date: datetime = None):
-    if not historical_cash:
-        return []
-
-    historical_cash_dict = {entry["date"]: entry["value"] for entry in historical_cash}
-    historical_cash_dict = defaultdict(lambda: defaultdict(lambda: 0))  # Default value of 0 for missing data
-    for entry in historical_cash:
-        key = (entry["name"], entry["date"])
-        historical_cash_dict[key] = {
-            "value": entry["value"],
-            "interest": entry["interest"],
-        }
-        
-    cash_names = {entry["name"] for entry in historical_cash}
-
-    first_date = datetime.strptime(historical_cash[0]["date"], "%Y-%m-%d").date()
+    balances = getDailyAccountBalances(transactions_df, all_days).sum(axis=0).round(2)
     
-    if first_transaction_date:
-        first_date = datetime.strptime(first_transaction_date, "%Y-%m-%d").date()
+    return dict(zip(all_days.strftime("%Y-%m-%d"), balances.tolist()))
 
-    last_date = until_date.date()
-    
-    populated_cash = {ticker: [] for ticker in cash_names}
-    
-    for cash_name in cash_names:
-    
-        last_known_value = 0
-        last_known_interest_rate = 0.0  # Default interest rate if none is provided
-        
-        historical_cash_idx = 0
-
-        current_date = first_date
-        while current_date <= last_date:
-            date_str = current_date.strftime("%Y-%m-%d")
-            key = (cash_name, date_str)
-
-            daily_interest_rate = last_known_interest_rate / 100 / 365
-
-            if current_date != first_date:
-                last_known_value += last_known_value * daily_interest_rate
-                
-            if key in historical_cash_dict:
-                last_known_value = historical_cash[historical_cash_idx]["value"]
-                last_known_interest_rate = historical_cash[historical_cash_idx]["interest"]
-                historical_cash_idx += 1
-                
-            value = historical_cash_dict.get(date_str, last_known_value)
-
-            populated_cash[cash_name].append({
-                "name": cash_name,
-                "value": value,
-                "interest" : last_known_interest_rate,
-                "date": date_str
-            })
-
-            if date_str in historical_cash_dict:
-                last_known_value = historical_cash_dict[date_str]
-
-            current_date += timedelta(days=1)
-    result = []
-    for records in populated_cash.values():
-        result.extend(records)
-
-    return result
-
-def getTop3Tickers(substring : str):
-    pass
+def calculateAccruedInterestCash(cash_transactions:list[tuple], until_date) -> dict:
+    return getDailyBalances(cash_transactions, until_date, 1)
 
-def getDailyValueRealEstate(real_estate_transactions:list[tuple], until_date) -> dict:
-    
-    first_buy = real_estate_transactions[0]
-    
-    transactions_daily_historical_data = {}
-    
-    transaction_index = 0
-    
-    for date in rrule(DAILY, dtstart=datetime.strptime(first_buy[2], "%Y-%m-%d %H:%M:%S.%f"), until=until_date):
-        date_str = date.strftime("%Y-%m-%d")
-        
-        change_in_cash = 0
-        
-        transaction_date_at_index = str(datetime.strptime(real_estate_transactions[transaction_index][2], "%Y-%m-%d %H:%M:%S.%f").date())
-
-        # check for transaction on this date
-        while(date_str == transaction_date_at_index):
-            
-            if (real_estate_transactions[transaction_index][3] == 'add'):
-                change_in_cash += real_estate_transactions[transaction_index][1]
-            elif (real_estate_transactions[transaction_index][3] == 'sell'):
-                change_in_cash -= real_estate_transactions[transaction_index][1]
-
-            if (transaction_index + 1 >= len(real_estate_transactions)):
-                break
-            transaction_date_at_index = str(datetime.strptime(real_estate_transactions[transaction_index][2], "%Y-%m-%d %H:%M:%S.%f").date())
-            transaction_index += 1
-            
-        if (transactions_daily_historical_data != {}):
-            # add interest to the cash
-            change_in_cash += transactions_daily_historical_data[str(date.date() - timedelta(1))]
-            transactions_daily_historical_data[date_str] = round(transactions_daily_historical_data[str(date.date() - timedelta(1))] + change_in_cash, 2)
+def calculateAccruedInterestDebt(debt_transactions:list[tuple], until_date) -> dict:
+    # debt is a negative balance, its interest makes it grow further below 0
+    return getDailyBalances(debt_transactions, until_date, -1)
+
+def loadPortfolioTransactions(session: Session, portfolio_id: int) -> dict:
+    
+    # every transaction of the portfolio in two queries, whatever the number of holdings,
+    # grouped in memory in the shapes the valuation functions expect
+    
+    stock_results = session.exec(text("""
+        SELECT ticker, action, DATE(date) AS transaction_date, amount, price
+        FROM stock_holdings
+        WHERE portfolio_id = :portfolio_id
+        ORDER BY date ASC
+    """).params(portfolio_id=portfolio_id)).all()
+    
+    other_results = session.exec(text("""
+        SELECT 'cash' AS asset_type, name, amount, interest, date, action FROM cash WHERE portfolio_id = :portfolio_id
+        UNION ALL
+        SELECT 'debt' AS asset_type, name, amount, interest, date, action FROM debt WHERE portfolio_id = :portfolio_id
+        UNION ALL
+        SELECT 'real_estate' AS asset_type, name, worth AS amount, NULL AS interest, date, action FROM real_estate WHERE portfolio_id = :portfolio_id
+        ORDER BY date ASC
+    """).params(portfolio_id=portfolio_id)).all()
+    
+    # tickers in the order of their first transaction
+    ticker_transactions = defaultdict(list)
+    for ticker, action, transaction_date, amount, price in stock_results:
+        ticker_transactions[ticker].append((action, transaction_date, amount, price))
+    
+    transactions = {"stocks": dict(ticker_transactions), "cash": [], "debt": [], "real_estate": []}
+    for asset_type, name, amount, interest, transaction_date, action in other_results:
+        if asset_type == "real_estate":
+            transactions[asset_type].append((name, amount, transaction_date, action))
         else:
-            transactions_daily_historical_data[date_str] = round(change_in_cash,2)
-    
-    return transactions_daily_historical_data
-    
-def getAverageInterestRate(currentCash, currentInterestRate, newCash, newInterestRate) -> float:
-    return (currentCash * currentInterestRate + newCash * newInterestRate) / (currentCash + newCash)
-
-def calculateAccruedInterestCash(cash_transactions:list[tuple], until_date) -> dict:
-    
-    # TODO: we assume the interest is annual, but calculated on a daily basis
-    
-    # get first transaction (we assume it's an addition of cash)
-    first_buy = cash_transactions[0]
+            transactions[asset_type].append((name, amount, interest, transaction_date, action))
     
-    transactions_daily_historical_data = {}
-    transaction_index = 0
-    average_daily_interest = 0
-    
-    for date in rrule(DAILY, dtstart=datetime.strptime(first_buy[3], "%Y-%m-%d %H:%M:%S.%f"), until=until_date):
-        date_str = date.strftime("%Y-%m-%d")
-        
-        change_in_cash = 0
-
-        # check for transaction on this date
-        transaction_date_at_index = str(datetime.strptime(cash_transactions[transaction_index][3], "%Y-%m-%d %H:%M:%S.%f").date())
-        
-        while(date_str == transaction_date_at_index):
-            
-            if (cash_transactions[transaction_index][4] == 'add'):
-                change_in_cash += cash_transactions[transaction_index][1]
-                if (transactions_daily_historical_data == {}):
-                    average_daily_interest = (cash_transactions[transaction_index][2]/ 100 )/ 365
-                else:
-                    average_daily_interest = (getAverageInterestRate(transactions_daily_historical_data[str(date.date() - timedelta(1))], average_daily_interest, cash_transactions[transaction_index][1], cash_transactions[transaction_index][2]) / 100 )/ 365
-            elif (cash_transactions[transaction_index][4] == 'sell'):
-                change_in_cash -= cash_transactions[transaction_index][1]
-                # this cannot be the first date, so no if statement
-                average_daily_interest = (cash_transactions[transaction_index][2]/ 100 )/ 365
-
-            if (transaction_index + 1 >= len(cash_transactions)):
-                break
-            transaction_date_at_index = str(datetime.strptime(cash_transactions[transaction_index][3], "%Y-%m-%d %H:%M:%S.%f").date())
-            transaction_index += 1
-            
-        if (transactions_daily_historical_data != {}):
-            # add interest to the cash
-            change_in_cash += transactions_daily_historical_data[str(date.date() - timedelta(1))] * average_daily_interest
-            transactions_daily_historical_data[date_str] = round(transactions_daily_historical_data[str(date.date() - timedelta(1))] + change_in_cash, 2)
-        else:
-            transactions_daily_historical_data[date_str] = round(change_in_cash,2)
+    return transactions
 
-    
-    return transactions_daily_historical_data
+# Function to fetch historical data
+def getPortfolioHistoricalData(portfolioid: int, present_date: datetime) -> dict:
+    with config.getSession() as session:
+        transactions = loadPortfolioTransactions(session, portfolioid)
 
-def calculateAccruedInterestDebt(debt_transactions:list[tuple], until_date) -> dict:
-        
-    # TODO: we assume the interest is annual, but calculated on a daily basis
+    allHistoricalData = {}
     
-    # get first transaction (we assume it's an addition of cash)
-    first_buy = debt_transactions[0]
+    ticker_transactions = transactions["stocks"]
     
-    transactions_daily_historical_data = {}
-    transaction_index = 0
-    average_daily_interest = 0
+    # histories are downloaded concurrently, a failing ticker is None instead of failing the portfolio
+    stocks_historical_daily_data = fetchConcurrently(
+        lambda ticker: getDailyValue(ticker, ticker_transactions[ticker], present_date.date()),
+        ticker_transactions
+    )
     
-    for date in rrule(DAILY, dtstart=datetime.strptime(first_buy[3], "%Y-%m-%d %H:%M:%S.%f"), until=until_date):
-        date_str = date.strftime("%Y-%m-%d")
-        
-        change_in_cash = 0
-
-        # check for transaction on this date
-        transaction_date_at_index = str(datetime.strptime(debt_transactions[transaction_index][3], "%Y-%m-%d %H:%M:%S.%f").date())
-        
-        while(date_str == transaction_date_at_index):
-            
-            if (debt_transactions[transaction_index][4] == 'add'):
-                change_in_cash -= debt_transactions[transaction_index][1]
-                if (transactions_daily_historical_data == {}):
-                    average_daily_interest = (debt_transactions[transaction_index][2]/ 100 )/ 365
-                else:
-                    average_daily_interest = (getAverageInterestRate(transactions_daily_historical_data[str(date.date() - timedelta(1))], average_daily_interest, debt_transactions[transaction_index][1], debt_transactions[transaction_index][2]) / 100 )/ 365
-            elif (debt_transactions[transaction_index][4] == 'sell'):
-                change_in_cash += debt_transactions[transaction_index][1]
-                # this cannot be the first date, so no if statement
-                average_daily_interest = (debt_transactions[transaction_index][2]/ 100 )/ 365
-
-            if (transaction_index + 1 >= len(debt_transactions)):
-                break
-            transaction_date_at_index = str(datetime.strptime(debt_transactions[transaction_index][3], "%Y-%m-%d %H:%M:%S.%f").date())
-            transaction_index += 1
-            
-        if (transactions_daily_historical_data != {}):
-            # add interest to the cash
-            change_in_cash += transactions_daily_historical_data[str(date.date() - timedelta(1))] * average_daily_interest
-            transactions_daily_historical_data[date_str] = round(transactions_daily_historical_data[str(date.date() - timedelta(1))] + change_in_cash, 2)
-        else:
-            transactions_daily_historical_data[date_str] = round(change_in_cash,2)
+    allHistoricalData['stocks'] = stocks_historical_daily_data
 
-    
-    return transactions_daily_historical_data
+    allHistoricalData['cash'] = calculateAccruedInterestCash(transactions["cash"], present_date.date())
 
-# Function to fetch historical data
-def getPortfolioHistoricalData(portfolioid: int, present_date: datetime) -> dict:
-    with Session(engine) as session:
-        allHistoricalData = {}
-
-        # Fetch unique tickers
-        unique_tickers_list = session.exec(text(
-            f"SELECT DISTINCT(ticker) FROM stock_holdings WHERE portfolio_id = {portfolioid} ORDER BY date ASC"
-        )).all()
-
-        stocks_historical_daily_data = {}
-        for ticker in unique_tickers_list:
-            ticker_transactions = session.exec(text(
-                f"SELECT action, DATE(date), amount, price FROM stock_holdings WHERE ticker = '{ticker}' ORDER BY date ASC"
-            )).all()
-            ticker_daily_value = getDailyValue(ticker, ticker_transactions, present_date.date())
-            stocks_historical_daily_data[ticker] = ticker_daily_value
-        
-        allHistoricalData['stocks'] = stocks_historical_daily_data
-
-        # Fetch and process cash data
-        cash_transactions = session.exec(text(
-            f"SELECT name, amount, interest, date, action FROM cash WHERE portfolio_id = {portfolioid} ORDER BY date ASC"
-        )).all()
-
-        cash_historical_daily_data = calculateAccruedInterestCash(cash_transactions, present_date.date())
-        allHistoricalData['cash'] = cash_historical_daily_data
-
-        # Fetch and process debt data
-        debt_transactions = session.exec(text(
-            f"SELECT name, amount, interest, date, action FROM debt WHERE portfolio_id = {portfolioid} ORDER BY date ASC"
-        )).all()
-
-        debt_historical_daily_data = calculateAccruedInterestDebt(debt_transactions, present_date.date())
-        allHistoricalData['debt'] = debt_historical_daily_data
-
-        # Fetch and process real estate data
-        real_estate_transactions = session.exec(text(
-            f"SELECT name, worth, date, action FROM real_estate WHERE portfolio_id = {portfolioid} ORDER BY date ASC"
-        )).all()
-
-        real_estate_historical_daily_data = getDailyValueRealEstate(real_estate_transactions, present_date.date())
-        allHistoricalData['real_estate'] = real_estate_historical_daily_data
+    allHistoricalData['debt'] = calculateAccruedInterestDebt(transactions["debt"], present_date.date())
+
+    allHistoricalData['real_estate'] = getDailyValueRealEstate(transactions["real_estate"], present_date.date())
 
     return allHistoricalData
 
@@ -622,7 +278,7 @@ def getPortfolioInformation(session, portfolioid: int) -> dict:
     return result.name if result else None
 
 def getAllHoldingsFromPortfolio(portfolioid: int) -> dict[str, list]:
-    with Session(engine) as session:
+    with config.getSession() as session:
         holdings = {}
         holdings['name'] = getPortfolioInformation(session, portfolioid)
         holdings['stocks'] = getStockFromPortfolio(session, portfolioid)
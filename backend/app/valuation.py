@@ -0,0 +1,383 @@
+import time
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlmodel import Session
+from app import yfinance_utils
+from app.yfinance_utils import fetchConcurrently, getStockHistories
+from app.interest import accrueBalances, toDailyRate
+from app.instrumentation import recordStage
+from app.currency import MissingExchangeRateError, fxTicker, getBaseCurrency, majorUnit
+
+# The daily series of every asset type of a portfolio, from one read of its transactions.
+# Every series is valuated on the same daily axis (from the portfolio's first transaction to until_date):
+# the stocks as a tickers x days matrix, and cash, debt and real estate as the rows of a single accounts x days matrix.
+
+ASSET_TYPES = ("stock", "cash", "debt", "real_estate")
+
+# days of prices fetched before the first returned day, enough to carry a close over weekends and holidays
+PRICE_LOOKBACK_DAYS = 7
+
+# the fields of a stock's daily record, after its name and date
+STOCK_FIELDS = ("price", "quantity", "value", "shares", "dividends", "total_return")
+
+# one row per asset per day with a transaction: asset_type, name, date, price, amount, interest, drip
+# the stocks as the average cost basis and net shares of the day, and whether that day's buys reinvest
+# their dividends (NULL without a buy, the previous day's choice holds),
+# the accounts as the net flow of the day with the interest rate of its latest transaction
+# (with MAX(transaction_id) as their only min/max aggregate, sqlite takes the other columns from that row)
+TRANSACTION_QUERIES = {
+    "stock": """
+        SELECT 'stock' AS asset_type, ticker AS name, transaction_date,
+            SUM(adjusted_cost) / NULLIF(SUM(CASE WHEN adjusted_amount > 0 THEN adjusted_amount ELSE 0 END), 0) AS price,
+            SUM(adjusted_amount) AS amount,
+            NULL AS interest,
+            MAX(CASE WHEN action = 'add' THEN drip END) AS drip,
+            MAX(transaction_id) AS last_transaction
+        FROM (
+            SELECT transaction_id, ticker, action, drip, date(date) AS transaction_date,
+                CASE WHEN action = 'add' THEN amount ELSE -amount END AS adjusted_amount,
+                CASE WHEN action = 'add' THEN (amount * (price + COALESCE(fees, 0) / NULLIF(amount, 0))) ELSE 0 END AS adjusted_cost
+            FROM stock_holdings
+            WHERE portfolio_id = :portfolio_id AND date < :until_date
+        )
+        GROUP BY ticker, transaction_date
+    """,
+    "cash": """
+        SELECT 'cash', COALESCE(NULLIF(name, ''), 'Cash') AS account, date(date) AS transaction_date, NULL,
+            SUM(CASE WHEN action = 'add' THEN amount ELSE -amount END), interest, NULL, MAX(transaction_id)
+        FROM cash
+        WHERE portfolio_id = :portfolio_id AND date < :until_date
+        GROUP BY account, transaction_date
+    """,
+    "debt": """
+        SELECT 'debt', COALESCE(NULLIF(name, ''), 'Debt') AS account, date(date) AS transaction_date, NULL,
+            SUM(CASE WHEN action IN ('remove', 'sell') THEN -amount ELSE amount END), interest, NULL, MAX(transaction_id)
+        FROM debt
+        WHERE portfolio_id = :portfolio_id AND date < :until_date
+        GROUP BY account, transaction_date
+    """,
+    "real_estate": """
+        SELECT 'real_estate', COALESCE(NULLIF(name, ''), 'Real estate') AS account, date(date) AS transaction_date, NULL,
+            SUM(CASE WHEN action IN ('remove', 'sell') THEN -worth ELSE worth END), NULL, NULL, MAX(transaction_id)
+        FROM real_estate
+        WHERE portfolio_id = :portfolio_id AND date < :until_date
+        GROUP BY account, transaction_date
+    """,
+}
+
+# first day with a transaction of any type, the start of the shared axis
+FIRST_TRANSACTION_DATE = """
+    (SELECT MIN(first_date) FROM (
+        SELECT MIN(date(date)) AS first_date FROM stock_holdings WHERE portfolio_id = :portfolio_id AND date < :until_date
+        UNION ALL
+        SELECT MIN(date(date)) FROM cash WHERE portfolio_id = :portfolio_id AND date < :until_date
+        UNION ALL
+        SELECT MIN(date(date)) FROM debt WHERE portfolio_id = :portfolio_id AND date < :until_date
+        UNION ALL
+        SELECT MIN(date(date)) FROM real_estate WHERE portfolio_id = :portfolio_id AND date < :until_date
+    )) AS first_transaction_date
+"""
+
+TRANSACTION_COLUMNS = ["asset_type", "name", "date", "price", "amount", "interest", "drip"]
+
+def loadTransactions(session: Session, portfolio_id: int, until_date: datetime, asset_types: tuple = ASSET_TYPES) -> tuple[pd.DataFrame, str]:
+
+    # a single statement for every asset type and the first transaction date
+    query = text(f"""
+        SELECT transactions.*, {FIRST_TRANSACTION_DATE}
+        FROM ({" UNION ALL ".join(TRANSACTION_QUERIES[asset_type] for asset_type in asset_types)}) AS transactions
+    """)
+
+    results = session.exec(query.params(portfolio_id=portfolio_id, until_date=until_date)).all()
+
+    if not results:
+        return pd.DataFrame(columns=TRANSACTION_COLUMNS), None
+
+    # built column by column, a frame from the rows costs more than the statement on a small portfolio
+    asset_types, names, dates, prices, amounts, interests, drips, _, first_dates = zip(*results)
+
+    transactions_df = pd.DataFrame({
+        "asset_type": asset_types,
+        "name": names,
+        "date": pd.to_datetime(dates, format="%Y-%m-%d"),
+        # the NULLs become nan, a missing interest rate is 0
+        "price": np.array(prices, dtype=float),
+        "amount": np.array(amounts, dtype=float),
+        "interest": np.nan_to_num(np.array(interests, dtype=float)),
+        "drip": np.array(drips, dtype=float),
+    })
+
+    return transactions_df, first_dates[0]
+
+def previousDay(values: np.ndarray) -> np.ndarray:
+    shifted = np.zeros_like(values)
+    shifted[:, 1:] = values[:, :-1]
+    return shifted
+
+def carriedForward(values: pd.Series, index, all_days: pd.DatetimeIndex) -> np.ndarray:
+    # the value of each asset's latest transaction day on every day, 0 before its first one
+    return values.unstack().reindex(index=index, columns=all_days).ffill(axis=1).fillna(0).to_numpy(dtype=float)
+
+def lastNonZero(values: np.ndarray) -> np.ndarray:
+    # each row's latest non-zero value on every day (a close carried over a weekend), 0 before the first one
+    days = np.arange(values.shape[1])
+    last_day = np.maximum.accumulate(np.where(values != 0, days, 0), axis=1)
+    return np.take_along_axis(values, last_day, axis=1)
+
+def daysOnAxis(history_df: pd.DataFrame, all_days: pd.DatetimeIndex) -> tuple[np.ndarray, np.ndarray]:
+    # the columns of the history's days on the axis, and which of its rows they are
+    # (outside of the axis, or the second row of a day that appears twice, are left out)
+    columns = all_days.get_indexer(history_df["date"].dt.normalize())
+    on_axis = (columns >= 0) & ~pd.Series(columns).duplicated().to_numpy()
+    return columns[on_axis], on_axis
+
+def getExchangeRates(tickers: list, base_currency: str, all_days: pd.DatetimeIndex, until_date: datetime) -> np.ndarray:
+
+    # the price of one unit of each ticker's currency in base_currency on each day (tickers x days)
+    # one series per currency held, each ticker takes its currency's row: the conversion is a single multiplication
+    ticker_currencies = yfinance_utils.getCurrencies(tickers)
+    units = [majorUnit(ticker_currencies[ticker]) for ticker in tickers]
+    currencies = sorted({currency for currency, _ in units} - {base_currency})
+
+    rates = np.ones((len(currencies) + 1, len(all_days)))
+
+    if currencies:
+        pairs = [fxTicker(currency, base_currency) for currency in currencies]
+        fx_histories = getStockHistories(pairs, all_days[0].date(), until_date)
+
+        fx_closes = np.zeros((len(currencies), len(all_days)))
+        for row, pair in enumerate(pairs):
+            columns, on_axis = daysOnAxis(fx_histories[pair], all_days)
+            fx_closes[row, columns] = fx_histories[pair]["close"].to_numpy(dtype=float)[on_axis]
+
+        # a rate is carried over the days without a quote, and the first one back to the start of the axis
+        fx_closes = lastNonZero(fx_closes)
+        first_quote = np.argmax(fx_closes != 0, axis=1)
+        fx_closes = np.where(np.arange(len(all_days)) < first_quote[:, None], fx_closes[np.arange(len(currencies)), first_quote][:, None], fx_closes)
+
+        # amounts left in another currency would be summed with the converted ones: nothing is valuated
+        for row, (currency, currency_rates) in enumerate(zip(currencies, fx_closes)):
+            if not currency_rates.any():
+                raise MissingExchangeRateError(currency, base_currency)
+            rates[row] = currency_rates
+
+    # the last row is base_currency itself
+    currency_rows = [currencies.index(currency) if currency in currencies else len(currencies) for currency, _ in units]
+    factors = np.array([factor for _, factor in units])
+
+    return rates[currency_rows] * factors[:, None]
+
+def readEarlierDividends(tickers: list, all_days: pd.DatetimeIndex, prices_start: date) -> tuple[np.ndarray, ...]:
+
+    # the dividends paid before the price window, with the close they are reinvested at, as the
+    # (row, column) positions of their days in the valuation matrices: only the days with a dividend are read
+    # the days of that range that aren't stored yet (never read, or a gap) are downloaded first, a ticker
+    # whose download failed or still misses business days is returned as incomplete
+    price_store = yfinance_utils.price_store
+    still_missing = fetchConcurrently(lambda ticker: price_store.fillHistory(ticker, all_days[0].date(), prices_start, fetch_today=False)[0], tickers)
+    incomplete = np.array([
+        still_missing[ticker] is None or any(np.busday_count(range_start, range_end) > 0 for range_start, range_end in still_missing[ticker])
+        for ticker in tickers
+    ], dtype=bool)
+
+    earlier_df = price_store.getDividends(tickers, all_days[0].date(), prices_start)
+
+    ticker_rows = {ticker: row for row, ticker in enumerate(tickers)}
+    rows = earlier_df["Ticker"].map(ticker_rows).to_numpy(dtype=int)
+    columns = all_days.get_indexer(pd.to_datetime(earlier_df["date"], format="%Y-%m-%d"))
+
+    return rows, columns, earlier_df["Dividends"].to_numpy(dtype=float), earlier_df["close"].to_numpy(dtype=float), incomplete
+
+def valuationAxis(first_date: date, until_date: datetime, from_date: date = None) -> tuple[pd.DatetimeIndex, int]:
+    # every day from the first transaction to until_date, and the position of the first returned one
+    all_days = pd.date_range(first_date, until_date.date(), freq="D")
+    first_output = max((from_date - first_date).days, 0) if from_date else 0
+    return all_days, first_output
+
+def pricesStart(all_days: pd.DatetimeIndex, first_output: int) -> date:
+    # days before the first returned one are valuated (transactions are carried forward), but their prices are only
+    # needed a few days back, for the close carried over a weekend or holiday
+    return all_days[max(first_output - PRICE_LOOKBACK_DAYS, 0)].date()
+
+def valuateStocks(stock_df: pd.DataFrame, all_days: pd.DatetimeIndex, first_output: int, until_date: datetime,
+                  base_currency: str = None) -> tuple[list, dict, np.ndarray]:
+
+    # the days with a positive net of shares set the cost basis and quantity, as they always did
+    bought_df = stock_df[stock_df["amount"] > 0]
+    tickers = list(dict.fromkeys(bought_df["name"]))
+
+    prices_start = pricesStart(all_days, first_output)
+    stock_histories = getStockHistories(tickers, prices_start, until_date)
+
+    # the reinvested shares need every dividend since the first transaction
+    incomplete = np.zeros(len(tickers), dtype=bool)
+    if prices_start > all_days[0].date():
+        earlier_rows, earlier_columns, earlier_dividends, earlier_closes, incomplete = readEarlierDividends(tickers, all_days, prices_start)
+
+    # the amounts are in each ticker's currency, converted at each day's rate (every dividend since the first day too)
+    exchange_rates = getExchangeRates(tickers, base_currency, all_days, until_date) if base_currency else 1.0
+
+    # only the computation counts as valuate, the histories above are timed as sql, fetch and fill
+    valuation_start = time.perf_counter()
+
+    # close and dividend per share of each ticker on each day, 0 when there is no price for that day
+    price_today = np.zeros((len(tickers), len(all_days)))
+    dividends = np.zeros_like(price_today)
+    for row, ticker in enumerate(tickers):
+        stock_history = stock_histories[ticker]
+        columns, on_axis = daysOnAxis(stock_history, all_days)
+
+        price_today[row, columns] = stock_history["close"].to_numpy(dtype=float)[on_axis]
+        dividends[row, columns] = np.nan_to_num(stock_history["Dividends"].to_numpy(dtype=float)[on_axis])
+
+    price_yesterday = previousDay(price_today)
+
+    # yesterday's price only counts from the third day on, and only if both days have a price
+    has_change = (price_today != 0) & (price_yesterday != 0)
+    has_change[:, :2] = False
+    price_change = np.where(has_change, price_today - price_yesterday, 0)
+
+    # the last transaction's cost basis and amount are carried until the next one
+    by_ticker_day = bought_df.set_index(["name", "date"])
+    last_known_price = carriedForward(by_ticker_day["price"], tickers, all_days)
+    last_known_amount = carriedForward(by_ticker_day["amount"], tickers, all_days)
+
+    values = (last_known_price + price_change) * last_known_amount * exchange_rates
+
+    # shares actually held: every day's net flow, plus the dividends of the DRIP holdings bought back as shares
+    # on their ex-date, which is an account earning dividend / close on those days:
+    #   shares[t] = shares[t - 1] * (1 + reinvested[t]) + flows[t]
+    # the other holdings are paid dividend * shares[t - 1] in cash
+    all_by_ticker_day = stock_df.set_index(["name", "date"])
+    flows = all_by_ticker_day["amount"].unstack().reindex(index=tickers, columns=all_days).fillna(0).to_numpy(dtype=float)
+    is_drip = carriedForward(all_by_ticker_day["drip"], tickers, all_days) > 0
+
+    dividend_closes = price_today.copy()
+    if prices_start > all_days[0].date():
+        dividends[earlier_rows, earlier_columns] = earlier_dividends
+        dividend_closes[earlier_rows, earlier_columns] = earlier_closes
+
+    reinvested = np.divide(dividends, dividend_closes, out=np.zeros_like(dividends), where=is_drip & (dividend_closes > 0))
+    shares = accrueBalances(flows, reinvested)
+    cash_dividends = np.cumsum(np.where(is_drip, 0, dividends * previousDay(shares)) * exchange_rates, axis=1)
+
+    # total return: the shares at the last known close, with the dividends paid in cash
+    total_return = shares * lastNonZero(price_today) * exchange_rates + cash_dividends
+
+    # the days a ticker is held without a single price in the window (its download failed, or came back empty),
+    # the days before a ticker's first close are only a weekend or a holiday when it has some
+    # and every day of a ticker whose earlier dividends couldn't be downloaded
+    has_prices = price_today.any(axis=1) & ~incomplete
+    is_unpriced = ((np.abs(shares[:, first_output:]) > 1e-9) & ~has_prices[:, None]).any(axis=0)
+
+    recordStage("valuate", time.perf_counter() - valuation_start)
+
+    fields = {
+        "price": last_known_price * exchange_rates,
+        "quantity": last_known_amount,
+        "value": values,
+        "shares": shares,
+        "dividends": cash_dividends,
+        "total_return": total_return,
+    }
+
+    return tickers, {field: matrix[:, first_output:] for field, matrix in fields.items()}, is_unpriced
+
+def valuateAccounts(accounts_df: pd.DataFrame, all_days: pd.DatetimeIndex, first_output: int) -> tuple[pd.MultiIndex, np.ndarray, np.ndarray]:
+
+    # every cash, debt and real estate account is a row of the same matrix, computed in one accrueBalances call:
+    #   cash: a transaction day sets the balance to that day's net flow, and the rate it earns from the next day on
+    #   debt: the flows add up to a negative balance, growing with its rate from the day it is set
+    #   real estate: the flows add up, without interest
+    by_account_day = accounts_df.set_index(["asset_type", "name", "date"])
+
+    flows = by_account_day["amount"].unstack().reindex(columns=all_days)
+    accounts = flows.index
+    is_transaction_day = flows.notna().to_numpy()
+
+    interest_rates = carriedForward(by_account_day["interest"], accounts, all_days)
+
+    asset_types = accounts.get_level_values("asset_type").to_numpy()[:, None]
+    is_cash = asset_types == "cash"
+    signs = np.where(asset_types == "debt", -1.0, 1.0)
+
+    accrual_rates = np.where(is_cash, previousDay(interest_rates), interest_rates)
+    balances = accrueBalances(flows.fillna(0).to_numpy(dtype=float) * signs, toDailyRate(accrual_rates), is_transaction_day & is_cash)
+
+    return accounts, balances[:, first_output:], interest_rates[:, first_output:]
+
+def valuatePortfolio(transactions_df: pd.DataFrame, first_date: date, until_date: datetime, from_date: date = None, asset_types: tuple = ASSET_TYPES,
+                     base_currency: str = None) -> dict[str, list]:
+
+    # with a base_currency, the stocks are converted to it (cash, debt and real estate are entered in it)
+    # without one, each stays in the currency it trades in
+    # when a held stock has no price on some of the returned days, unpriced_from is the first of them
+
+    series = {asset_type: [] for asset_type in asset_types}
+
+    # days before from_date are still valuated (transactions and interest are carried forward) but not returned
+    all_days, first_output = valuationAxis(first_date, until_date, from_date)
+    date_strs = all_days.strftime("%Y-%m-%d").tolist()[first_output:]
+
+    if not date_strs:
+        return series
+
+    stock_df = transactions_df[transactions_df["asset_type"] == "stock"]
+    accounts_df = transactions_df[transactions_df["asset_type"] != "stock"]
+
+    if not stock_df.empty:
+        tickers, fields, is_unpriced = valuateStocks(stock_df, all_days, first_output, until_date, base_currency)
+
+        if is_unpriced.any():
+            series["unpriced_from"] = date_strs[int(np.argmax(is_unpriced))]
+
+        for ticker, ticker_fields in zip(tickers, zip(*(fields[field].tolist() for field in STOCK_FIELDS))):
+            series["stock"].extend(
+                {"name": ticker, "date": date_str, "price": price, "quantity": quantity, "value": value,
+                 "shares": shares, "dividends": dividends, "total_return": total_return}
+                for date_str, price, quantity, value, shares, dividends, total_return in zip(date_strs, *ticker_fields)
+            )
+
+    if not accounts_df.empty:
+        valuation_start = time.perf_counter()
+        accounts, balances, interest_rates = valuateAccounts(accounts_df, all_days, first_output)
+        recordStage("valuate", time.perf_counter() - valuation_start)
+
+        for (asset_type, name), account_balances, account_rates in zip(accounts, balances.tolist(), interest_rates.tolist()):
+            if asset_type == "real_estate":
+                series[asset_type].extend(
+                    {"name": name, "value": value, "date": date_str}
+                    for date_str, value in zip(date_strs, account_balances)
+                )
+            else:
+                series[asset_type].extend(
+                    {"name": name, "value": value, "interest": interest, "date": date_str}
+                    for date_str, value, interest in zip(date_strs, account_balances, account_rates)
+                )
+
+    return series
+
+def getHistoricalPortfolio(session: Session, portfolio_id: int, until_date: datetime, from_date: date = None,
+                           asset_types: tuple = ASSET_TYPES, shared_axis: bool = True) -> dict[str, list]:
+
+    # the series of each asset type, from the first transaction of the portfolio (shared_axis)
+    # or from the first transaction of that type, with unpriced_from when some days lack a price (see valuatePortfolio)
+    transactions_df, first_transaction_date = loadTransactions(session, portfolio_id, until_date, asset_types)
+
+    if transactions_df.empty:
+        return {asset_type: [] for asset_type in asset_types}
+
+    # every amount in the currency of the portfolio's owner
+    base_currency = getBaseCurrency(session, portfolio_id)
+
+    if shared_axis:
+        first_date = datetime.strptime(first_transaction_date, "%Y-%m-%d").date()
+        return valuatePortfolio(transactions_df, first_date, until_date, from_date, asset_types, base_currency)
+
+    series = {asset_type: [] for asset_type in asset_types}
+    for asset_type, type_df in transactions_df.groupby("asset_type"):
+        series.update(valuatePortfolio(type_df, type_df["date"].min().date(), until_date, from_date, (asset_type,), base_currency))
+
+    return series
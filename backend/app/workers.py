@@ -0,0 +1,16 @@
+import anyio
+from anyio import to_thread
+from instance import config
+from app.instrumentation import runProfiled
+
+# valuations running at the same time, the other requests wait for a slot without blocking the event loop
+valuation_limiter = anyio.CapacityLimiter(config.VALUATION_WORKERS)
+
+async def runValuation(function, *args):
+    
+    # the valuation pipeline is synchronous (sql, yfinance downloads, pandas)
+    # so it runs in a worker thread while the event loop keeps serving other clients
+    
+    # runProfiled only profiles when the request asked for it, see app/instrumentation.py
+    
+    return await to_thread.run_sync(runProfiled, function, *args, limiter=valuation_limiter)
@@ -1,6 +1,29 @@
 import yfinance as yf
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pandas as pd
+from instance import config
+from app.currency import inferCurrency
+from app.price_store import PriceStore, emptyHistory, price_write_listeners, toDate, toEndDate
+from app.history_cache import HistoryCache
+from app.instrumentation import timing
+
+# swap the source (or the whole store) to run offline, e.g. PriceStore(engine, source=StubSource())
+price_store = PriceStore(config.engine)
+
+# shared by every request, so the number of downloads in flight stays bounded
+fetch_pool = ThreadPoolExecutor(max_workers=config.PRICE_FETCH_WORKERS, thread_name_prefix="price-fetch")
+
+# users holding the same ticker share its histories instead of each reading (or downloading) their own
+# without the refresher, the requests download today's bar again once per refresh interval
+history_cache = HistoryCache(
+    config.HISTORY_CACHE_MAX_BYTES,
+    today_ttl=None if config.PRICE_REFRESHER or not config.PRICE_REFRESH_INTERVAL_MINUTES else timedelta(minutes=config.PRICE_REFRESH_INTERVAL_MINUTES),
+)
+
+# the histories that include days saved again are read again
+price_write_listeners.append(lambda session, ticker, first_day: history_cache.invalidate(ticker, first_day))
 
 def stockIsInYF(ticker: str):
     try:
@@ -22,33 +45,28 @@ def getStockFromYF(ticker: str):
 
 def insertWeekends(ticker_history_df: pd.DataFrame) -> pd.DataFrame:
     
-    # we will iterate over the dataframe and check if the next date is not the next day
-    # if it isn't, we will insert a row with the next date and the same values as the previous date
-    # we will do this until we reach the last date, where we will order the dataframe by date ascending, and rerun the function until no new dates are added
+    # yahoo only gives trading days, so we reindex the history on every calendar day in one pass
+    # a filled day copies the last trading day before it, with the open column set to that day's close
+    # and no dividend (it was paid once, on its trading day)
     
     ticker_history_df = ticker_history_df.sort_values(by="date")
-    ticker_history_df.reset_index(drop=True, inplace=True)
+    ticker_history_df = ticker_history_df.drop_duplicates(subset="date", keep="last")
     
-    for index, row in ticker_history_df.iterrows():
-        if index == len(ticker_history_df) - 1:
-            break
-        
-        if (ticker_history_df.loc[index + 1, "date"] - row["date"]).days > 1:
-            # copy the row but change the date to the next day and open column to the close column of the previous row
-            new_row = row.copy()
-            new_row["date"] = row["date"] + timedelta(days=1)
-            new_row["open"] = row["close"]
-            ticker_history_df = ticker_history_df._append(new_row, ignore_index=True)
-            
-    ticker_history_df = ticker_history_df.sort_values(by="date")
-    ticker_history_df.reset_index(drop=True, inplace=True)
+    if ticker_history_df.empty:
+        return ticker_history_df.reset_index(drop=True)
     
-    for index, row in ticker_history_df.iterrows():
-        if index == len(ticker_history_df) - 1:
-            break
-        
-        if (ticker_history_df.loc[index + 1, "date"] - row["date"]).days > 1:
-            return insertWeekends(ticker_history_df)
+    all_days = pd.date_range(ticker_history_df["date"].iloc[0], ticker_history_df["date"].iloc[-1], freq="D")
+    
+    ticker_history_df = ticker_history_df.set_index("date")
+    is_filled_day = ~all_days.isin(ticker_history_df.index)
+    
+    ticker_history_df = ticker_history_df.reindex(all_days).ffill()
+    ticker_history_df.loc[is_filled_day, "open"] = ticker_history_df.loc[is_filled_day, "close"]
+    if "Dividends" in ticker_history_df:
+        ticker_history_df.loc[is_filled_day, "Dividends"] = 0
+    
+    ticker_history_df.index.name = "date"
+    ticker_history_df.reset_index(inplace=True)
         
     return ticker_history_df
     
@@ -56,18 +74,73 @@ def insertWeekends(ticker_history_df: pd.DataFrame) -> pd.DataFrame:
 #Data cleaning in this step
 def getStockHistory(ticker: str, date1 : str, date2: str) -> pd.DataFrame:
     
-    ticker_history_df = yf.Ticker(ticker).history(start=date1, end=date2, interval="1d")
-    ticker_history_df.drop(["Stock Splits", "High", "Low", "Volume"], axis=1, inplace=True)
-    ticker_history_df.reset_index(inplace=True)
-    ticker_history_df["Ticker"] = ticker
-    ticker_history_df.rename(columns={"Date": "date", "Open": "open", "Close": "close", "Adj Close": "adj_close"}, inplace=True)
+    start, end = toDate(date1), toEndDate(date2)
+    
+    def load() -> pd.DataFrame:
+        # only the days missing from the local price store are downloaded,
+        # and today's bar is left to the background refresher when it runs
+        ticker_history_df = price_store.getHistory(ticker, start, end, fetch_today=not config.PRICE_REFRESHER)
+        
+        # yahoo doesn't give weekend data, we we will populate it ourselves.
+        with timing("fill"):
+            return insertWeekends(ticker_history_df)
+    
+    return history_cache.get(ticker, start, end, load)
+
+
+def fetchConcurrently(fetch, tickers) -> dict:
+    
+    # runs fetch(ticker) for every ticker on the fetch pool
+    # a ticker that fails is reported and gets None, without failing the others
+    # each runs in a copy of the caller's context, so its timings count towards the caller's request
+    
+    futures = {ticker: fetch_pool.submit(contextvars.copy_context().run, fetch, ticker) for ticker in tickers}
+    
+    results = {}
+    for ticker, future in futures.items():
+        try:
+            results[ticker] = future.result()
+        except Exception as e:
+            print(f"Could not fetch {ticker}: {e}")
+            results[ticker] = None
+            
+    return results
+
+def prefetchHistories(tickers: list, date1: str, date2: str):
+    
+    # starts loading the histories on the fetch pool without waiting for them: a getStockHistory of the same
+    # range then waits on that load (or reads it from the cache) instead of starting its own
+    
+    for ticker in tickers:
+        fetch_pool.submit(contextvars.copy_context().run, getStockHistory, ticker, date1, date2)
+
+def getStockHistories(tickers: list, date1 : str, date2: str) -> dict[str, pd.DataFrame]:
+    
+    histories = fetchConcurrently(lambda ticker: getStockHistory(ticker, date1, date2), tickers)
+    
+    return {
+        ticker: history if history is not None else emptyHistory(ticker)
+        for ticker, history in histories.items()
+    }
+
+def getCurrencies(tickers: list) -> dict:
+    
+    # the currency each ticker trades in: asked to the source once per ticker (all of them at once), then read
+    # a source without an answer (or without fetchCurrency) gets the guess from the exchange suffix saved,
+    # but a failed request (offline, throttled) is only guessed for now and asked again next time
+    
+    currencies = price_store.readCurrencies(tickers)
+    missing = [ticker for ticker in tickers if ticker not in currencies]
     
-    # yahoo doesn't give weekend data, we we will populate it ourselves.
-    ticker_history_with_weekends_df = insertWeekends(ticker_history_df)
+    if not missing:
+        return currencies
     
-    print(f"{ticker_history_with_weekends_df=}")
+    fetchCurrency = getattr(price_store.source, "fetchCurrency", lambda ticker: None)
+    fetched = fetchConcurrently(lambda ticker: fetchCurrency(ticker) or inferCurrency(ticker), missing)
+    price_store.saveCurrencies({ticker: currency for ticker, currency in fetched.items() if currency is not None})
     
-    return ticker_history_with_weekends_df
+    currencies.update({ticker: currency or inferCurrency(ticker) for ticker, currency in fetched.items()})
+    return currencies
 
 
 # returns a dict of portfolio worth of that ticker over the first transaction date to present date
@@ -0,0 +1,89 @@
+# Benchmark of the bulk transaction import on 100k-row CSV and JSON lines files
+# run from the backend folder: python -m benchmarks.imports
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from sqlmodel import SQLModel, Session, create_engine
+from app import models
+from app.models import StockHoldings
+from app.imports import importTransactions
+
+TICKERS = ["AAPL", "MSFT", "GOOG", "AMZN", "NVDA", "VFV.TO", "XEQT.TO", "SHOP.TO", "RY.TO", "TD.TO"]
+FIELDS = ["type", "action", "date", "ticker", "quantity", "price", "fees", "drip", "name", "amount", "interest"]
+
+def makeRows(count: int, seed: int = 0) -> list[dict]:
+    # only adds, so the balance checks never reject a row
+    rng = random.Random(seed)
+    first_day = date(2005, 1, 1)
+    rows = []
+
+    for _ in range(count):
+        transaction_date = (first_day + timedelta(days=rng.randrange(20 * 365))).isoformat()
+
+        if rng.random() < 0.9:
+            rows.append({"type": "stock", "action": "add", "date": transaction_date, "ticker": rng.choice(TICKERS),
+                         "quantity": rng.randint(1, 100), "price": round(rng.uniform(10, 500), 2), "fees": 0, "drip": False})
+        else:
+            rows.append({"type": "cash", "action": "add", "date": transaction_date, "name": "Savings",
+                         "amount": round(rng.uniform(100, 5000), 2), "interest": 2.5})
+
+    return rows
+
+def toCsv(rows: list[dict]) -> bytes:
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue().encode()
+
+def toJsonLines(rows: list[dict]) -> bytes:
+    return "\n".join(json.dumps(row) for row in rows).encode()
+
+def addOneByOne(engine, portfolio_id: int, rows: list[dict]):
+    # what the single PUT /stocks/add did per row: one ORM insert and one commit
+    with Session(engine) as session:
+        for row in rows:
+            session.add(StockHoldings(portfolio_id=portfolio_id, ticker=row["ticker"], price=row["price"], amount=row["quantity"],
+                                      date=datetime.strptime(row["date"], "%Y-%m-%d"), action="add", fees=0, drip=False))
+            session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Import throughput in rows per second")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--one-by-one-rows", type=int, default=1000, help="rows added one at a time for comparison")
+    args = parser.parse_args()
+
+    rows = makeRows(args.rows)
+    files = {"csv": toCsv(rows), "jsonl": toJsonLines(rows)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        SQLModel.metadata.create_all(engine)
+
+        print(f"{'format':>12} {'rows':>8} {'seconds':>9} {'rows/sec':>10}")
+
+        for portfolio_id, (import_format, body) in enumerate(files.items(), start=1):
+            with Session(engine) as session:
+                start = time.perf_counter()
+                imported = importTransactions(session, portfolio_id, body, import_format)
+                elapsed = time.perf_counter() - start
+
+            assert imported["stocks"] + imported["cash"] == len(rows)
+            print(f"{import_format:>12} {len(rows):>8} {elapsed:>9.2f} {len(rows) / elapsed:>10.0f}")
+
+        stock_rows = [row for row in rows if row["type"] == "stock"][:args.one_by_one_rows]
+        start = time.perf_counter()
+        addOneByOne(engine, len(files) + 1, stock_rows)
+        elapsed = time.perf_counter() - start
+        print(f"{'one by one':>12} {len(stock_rows):>8} {elapsed:>9.2f} {len(stock_rows) / elapsed:>10.0f}")
+
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
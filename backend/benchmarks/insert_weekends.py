@@ -0,0 +1,90 @@
+# Benchmark of the calendar fill (insertWeekends) from 1 month to 20 years of daily history
+# run from the backend folder: python -m benchmarks.insert_weekends
+import argparse
+import time
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from app.yfinance_utils import insertWeekends
+
+HISTORY_LENGTHS = {
+    "1 month": 30,
+    "1 year": 365,
+    "5 years": 5 * 365,
+    "10 years": 10 * 365,
+    "20 years": 20 * 365,
+}
+
+def makeTradingHistory(days: int, seed: int = 0) -> pd.DataFrame:
+    # business days only, like yahoo
+    dates = pd.bdate_range(end=pd.Timestamp("2024-12-31"), periods=int(days * 5 / 7))
+    closes = 100 * np.cumprod(1 + np.random.default_rng(seed).normal(0, 0.01, len(dates)))
+
+    return pd.DataFrame({
+        "date": dates,
+        "open": np.concatenate(([100.0], closes[:-1])),
+        "close": closes,
+        "Dividends": 0.0,
+        "Ticker": "BENCH",
+    })
+
+def legacyInsertWeekends(ticker_history_df: pd.DataFrame) -> pd.DataFrame:
+    # row by row implementation that insertWeekends replaced, kept to compare results and timings
+    ticker_history_df = ticker_history_df.sort_values(by="date")
+    ticker_history_df.reset_index(drop=True, inplace=True)
+
+    for index, row in ticker_history_df.iterrows():
+        if index == len(ticker_history_df) - 1:
+            break
+
+        if (ticker_history_df.loc[index + 1, "date"] - row["date"]).days > 1:
+            new_row = row.copy()
+            new_row["date"] = row["date"] + timedelta(days=1)
+            new_row["open"] = row["close"]
+            ticker_history_df = ticker_history_df._append(new_row, ignore_index=True)
+
+    ticker_history_df = ticker_history_df.sort_values(by="date")
+    ticker_history_df.reset_index(drop=True, inplace=True)
+
+    for index, row in ticker_history_df.iterrows():
+        if index == len(ticker_history_df) - 1:
+            break
+
+        if (ticker_history_df.loc[index + 1, "date"] - row["date"]).days > 1:
+            return legacyInsertWeekends(ticker_history_df)
+
+    return ticker_history_df
+
+def timeIt(function, *args, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Time insertWeekends on growing histories")
+    parser.add_argument("--legacy-max-days", type=int, default=365,
+                        help="longest history the legacy implementation is timed on (it is quadratic)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'history':>10} {'rows':>6} {'filled':>7} {'vectorized':>12} {'legacy':>12}")
+
+    for label, days in HISTORY_LENGTHS.items():
+        history_df = makeTradingHistory(days)
+        filled_df = insertWeekends(history_df)
+
+        vectorized_time = timeIt(insertWeekends, history_df, repeat=args.repeat)
+        legacy_time = "skipped"
+
+        if days <= args.legacy_max_days:
+            legacy_df = legacyInsertWeekends(history_df)
+            pd.testing.assert_frame_equal(filled_df, legacy_df, check_dtype=False)
+            legacy_time = f"{timeIt(legacyInsertWeekends, history_df, repeat=1) * 1000:.2f} ms"
+
+        print(f"{label:>10} {len(history_df):>6} {len(filled_df):>7} {vectorized_time * 1000:>9.2f} ms {legacy_time:>12}")
+
+if __name__ == "__main__":
+    main()
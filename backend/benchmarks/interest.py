@@ -0,0 +1,97 @@
+# Benchmark of the compound interest engine on 30 year mortgages and many savings accounts
+# run from the backend folder: python -m benchmarks.interest
+import argparse
+import numpy as np
+import pandas as pd
+from app.interest import accrueBalances, toDailyRate
+from app.utils import calculateAccruedInterestDebt
+from benchmarks.insert_weekends import timeIt
+
+MORTGAGE_YEARS = 30
+
+def makeMortgage(years: int = MORTGAGE_YEARS, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    # 300k borrowed on day 0, a payment every 30 days, the rate renewed every 5 years
+    days = years * 365
+    rng = np.random.default_rng(seed)
+
+    flows = np.zeros(days)
+    flows[0] = -300000.0
+    flows[30::30] = 1600.0
+
+    rates = np.repeat(rng.uniform(2, 7, years // 5 + 1), 5 * 365)[:days]
+
+    return flows, toDailyRate(rates)
+
+def makeSavingsAccounts(accounts: int, days: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    # random deposits and withdrawals, each account at its own rate which changes a few times
+    rng = np.random.default_rng(seed)
+
+    flows = np.where(rng.random((accounts, days)) < 0.05, rng.normal(200, 300, (accounts, days)), 0.0)
+    flows[:, 0] = rng.uniform(1000, 10000, accounts)
+
+    change_days = rng.random((accounts, days)) < 0.002
+    change_days[:, 0] = True
+    rates = pd.DataFrame(np.where(change_days, rng.uniform(0, 5, (accounts, days)), np.nan)).ffill(axis=1).to_numpy()
+
+    return flows, toDailyRate(rates)
+
+def loopBalances(flows: np.ndarray, daily_rates: np.ndarray) -> np.ndarray:
+    # day by day recurrence, what accrueBalances computes in one pass
+    flows = np.atleast_2d(flows)
+    daily_rates = np.broadcast_to(daily_rates, flows.shape)
+    balances = np.zeros(flows.shape)
+
+    for account in range(flows.shape[0]):
+        balance = 0.0
+        for day in range(flows.shape[1]):
+            balance = balance * (1 + daily_rates[account, day]) + flows[account, day]
+            balances[account, day] = balance
+
+    return balances
+
+def makeMortgageTransactions(years: int = MORTGAGE_YEARS) -> list[tuple]:
+    # the same kind of mortgage, as rows of the debt table
+    first_day = pd.Timestamp("1995-01-01")
+    transactions = [("Mortgage", 300000.0, 5.0, first_day.strftime("%Y-%m-%d %H:%M:%S.%f"), "add")]
+
+    for day in range(30, years * 365, 30):
+        payment_date = first_day + pd.Timedelta(days=day)
+        transactions.append(("Mortgage", 1600.0, 5.0, payment_date.strftime("%Y-%m-%d %H:%M:%S.%f"), "remove"))
+
+    return transactions
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the compound interest engine against a daily loop")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=10 * 365)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cases = {
+        f"mortgage {MORTGAGE_YEARS}y": makeMortgage(),
+        f"{args.accounts} savings {args.days}d": makeSavingsAccounts(args.accounts, args.days),
+    }
+
+    print(f"{'case':>24} {'days':>9} {'vectorized':>12} {'loop':>12} {'max diff':>10}")
+
+    for label, (flows, daily_rates) in cases.items():
+        balances = accrueBalances(flows, daily_rates)
+        expected = loopBalances(flows, daily_rates)
+
+        # the closed form is exact up to floating point, well below a cent
+        max_diff = np.abs(balances - expected).max()
+        assert max_diff < 0.005, f"{label}: balances differ by {max_diff}"
+
+        vectorized_time = timeIt(accrueBalances, flows, daily_rates, repeat=args.repeat)
+        loop_time = timeIt(loopBalances, flows, daily_rates, repeat=1)
+
+        print(f"{label:>24} {flows.size:>9} {vectorized_time * 1000:>9.2f} ms {loop_time * 1000:>9.2f} ms {max_diff:>10.2e}")
+
+    transactions = makeMortgageTransactions()
+    until_date = pd.Timestamp("1995-01-01") + pd.Timedelta(days=MORTGAGE_YEARS * 365 - 1)
+    debt_time = timeIt(calculateAccruedInterestDebt, transactions, until_date, repeat=args.repeat)
+
+    print(f"calculateAccruedInterestDebt on {len(transactions)} mortgage transactions: {debt_time * 1000:.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+# Benchmark suite of the valuation pipeline on synthetic portfolios, with a fake offline price source
+# run from the backend folder: python -m benchmarks.suite --output results.json [--compare previous.json]
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from sqlmodel import SQLModel, Session, create_engine
+from app import models, yfinance_utils
+from app.migrations import createMissingIndexes
+from app.ledger import rebuildLedger
+from app.price_store import PriceStore
+from app.utils import (getHistoricalStocks, getHistoricalCash, getHistoricalAssets, loadPortfolioTransactions,
+                       calculateAccruedInterestCash, calculateAccruedInterestDebt)
+from app.yfinance_utils import insertWeekends
+
+# every series ends on the same day, so the results don't depend on when the suite is run
+UNTIL_DATE = datetime(2025, 1, 1)
+
+@dataclass
+class PortfolioSpec:
+    tickers: int
+    years: int
+    # transactions per ticker (or account) per year
+    density: float
+    cash_accounts: int
+    debt_accounts: int
+    seed: int = 0
+
+SCENARIOS = {
+    "small": PortfolioSpec(tickers=5, years=2, density=4, cash_accounts=1, debt_accounts=0),
+    "medium": PortfolioSpec(tickers=20, years=10, density=12, cash_accounts=3, debt_accounts=1),
+    "large": PortfolioSpec(tickers=50, years=20, density=24, cash_accounts=5, debt_accounts=2),
+}
+
+class FakePriceSource:
+    """Deterministic random walk per ticker on business days, with a quarterly dividend."""
+
+    def fetch(self, ticker: str, start, end) -> pd.DataFrame:
+        # the walk starts on a fixed day, so any range of a ticker reads the same prices
+        all_dates = pd.bdate_range("1990-01-01", UNTIL_DATE + timedelta(days=365))
+        rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+        # an exchange rate (e.g. CADUSD=X) moves around 0.75
+        start_close = 0.75 if ticker.endswith("=X") else rng.uniform(10, 500)
+        closes = start_close * np.cumprod(1 + rng.normal(0.0003, 0.015, len(all_dates)))
+        opens = np.concatenate(([closes[0]], closes[:-1])) * (1 + rng.normal(0, 0.002, len(all_dates)))
+        dividends = np.where((all_dates.month % 3 == 0) & (all_dates.day <= 7) & (all_dates.dayofweek == 0) & (not ticker.endswith("=X")), closes * 0.005, 0.0)
+
+        in_range = (all_dates >= pd.Timestamp(start)) & (all_dates < pd.Timestamp(end))
+
+        return pd.DataFrame({
+            "date": all_dates[in_range],
+            "open": opens[in_range],
+            "close": closes[in_range],
+            "Dividends": dividends[in_range],
+            "Ticker": ticker,
+        })
+
+def generatePortfolio(engine, portfolio_id: int, spec: PortfolioSpec) -> dict:
+    # buys spread over the years (a sell once in a while, never more than held), deposits and withdrawals
+    # on the cash accounts and a loan with its repayments on each debt account
+    rng = random.Random(spec.seed)
+    first_day = UNTIL_DATE - timedelta(days=spec.years * 365)
+    transactions_per_asset = max(1, int(spec.years * spec.density))
+
+    def randomDate() -> datetime:
+        return first_day + timedelta(days=rng.randrange(spec.years * 365))
+
+    stock_rows = []
+    for ticker_number in range(spec.tickers):
+        # every fifth ticker trades in Toronto, in CAD
+        ticker = f"SYN{ticker_number:03d}" + (".TO" if ticker_number % 5 == 4 else "")
+        # every other ticker reinvests its dividends
+        drip = ticker_number % 2 == 0
+        held = 0
+        for transaction_date in sorted(randomDate() for _ in range(transactions_per_asset)):
+            amount = rng.randint(1, 50)
+            action = "remove" if held > amount and rng.random() < 0.2 else "add"
+            held += amount if action == "add" else -amount
+            stock_rows.append((portfolio_id, ticker, amount, rng.uniform(10, 500), 0.0, action, drip, transaction_date))
+
+    cash_rows = []
+    for account in range(spec.cash_accounts):
+        balance = 0.0
+        interest = rng.uniform(0, 5)
+        for transaction_date in sorted(randomDate() for _ in range(transactions_per_asset)):
+            amount = rng.uniform(100, 5000)
+            action = "remove" if balance > amount and rng.random() < 0.3 else "add"
+            balance += amount if action == "add" else -amount
+            cash_rows.append((portfolio_id, f"Savings {account}", amount, interest, action, transaction_date))
+
+    debt_rows = []
+    for account in range(spec.debt_accounts):
+        interest = rng.uniform(2, 7)
+        debt_rows.append((portfolio_id, f"Loan {account}", rng.uniform(50_000, 500_000), interest, "add", first_day))
+        for transaction_date in sorted(randomDate() for _ in range(transactions_per_asset)):
+            debt_rows.append((portfolio_id, f"Loan {account}", rng.uniform(500, 3000), interest, "remove", transaction_date))
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql("""
+            INSERT INTO stock_holdings (portfolio_id, ticker, amount, price, fees, action, drip, date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, stock_rows)
+        if cash_rows:
+            connection.exec_driver_sql("""
+                INSERT INTO cash (portfolio_id, name, amount, interest, action, date) VALUES (?, ?, ?, ?, ?, ?)
+            """, cash_rows)
+        if debt_rows:
+            connection.exec_driver_sql("""
+                INSERT INTO debt (portfolio_id, name, amount, interest, action, date) VALUES (?, ?, ?, ?, ?, ?)
+            """, debt_rows)
+
+    return {"stocks": len(stock_rows), "cash": len(cash_rows), "debt": len(debt_rows)}
+
+def measure(function, repeat: int, setup=None) -> dict:
+    # setup runs before each repetition and isn't timed
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return {"best": min(timings), "median": statistics.median(timings), "repeat": repeat}
+
+def runScenario(engine, portfolio_id: int, spec: PortfolioSpec, repeat: int) -> dict:
+    counts = generatePortfolio(engine, portfolio_id, spec)
+
+    def inSession(function, *args):
+        def run():
+            with Session(engine) as session:
+                function(session, *args)
+        return run
+
+    with Session(engine) as session:
+        transactions = loadPortfolioTransactions(session, portfolio_id)
+
+    history_df = FakePriceSource().fetch("SYN000", UNTIL_DATE - timedelta(days=spec.years * 365), UNTIL_DATE)
+    clearCache = yfinance_utils.history_cache.clear
+
+    results = {
+        # the first read of each ticker goes to the (fake) source and fills the price store
+        "getHistoricalAssets (empty price store)": measure(inSession(getHistoricalAssets, portfolio_id, UNTIL_DATE), 1),
+        # prices read from the price store
+        "getHistoricalStocks": measure(inSession(getHistoricalStocks, portfolio_id, UNTIL_DATE), repeat, setup=clearCache),
+        "getHistoricalCash": measure(inSession(getHistoricalCash, portfolio_id, UNTIL_DATE), repeat),
+        "getHistoricalAssets": measure(inSession(getHistoricalAssets, portfolio_id, UNTIL_DATE), repeat, setup=clearCache),
+        # histories served from the process-wide cache
+        "getHistoricalAssets (cached histories)": measure(inSession(getHistoricalAssets, portfolio_id, UNTIL_DATE), repeat),
+        "insertWeekends": measure(lambda: insertWeekends(history_df), repeat),
+        # a replay of every stock transaction in the cost basis ledger (rolled back with the session)
+        "rebuildLedger": measure(inSession(rebuildLedger, portfolio_id), repeat),
+        "calculateAccruedInterestCash": measure(lambda: calculateAccruedInterestCash(transactions["cash"], UNTIL_DATE.date()), repeat),
+        "calculateAccruedInterestDebt": measure(lambda: calculateAccruedInterestDebt(transactions["debt"], UNTIL_DATE.date()), repeat),
+    }
+
+    return {"spec": asdict(spec), "transactions": counts, "results": results}
+
+def gitCommit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def printComparison(report: dict, previous: dict):
+    print(f"\ncompared to {previous.get('commit')} ({previous.get('date')}), best times")
+    print(f"{'scenario':>8} {'benchmark':>42} {'before':>11} {'after':>11} {'ratio':>7}")
+
+    for scenario, scenario_report in report["scenarios"].items():
+        previous_results = previous.get("scenarios", {}).get(scenario, {}).get("results", {})
+        for name, timing in scenario_report["results"].items():
+            if name in previous_results:
+                before, after = previous_results[name]["best"], timing["best"]
+                print(f"{scenario:>8} {name:>42} {before * 1000:>8.2f} ms {after * 1000:>8.2f} ms {after / before:>6.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the valuation pipeline on synthetic portfolios")
+    parser.add_argument("--scenarios", nargs="+", choices=[*SCENARIOS, "custom"], default=list(SCENARIOS))
+    parser.add_argument("--tickers", type=int, default=10, help="custom scenario")
+    parser.add_argument("--years", type=int, default=5, help="custom scenario")
+    parser.add_argument("--density", type=float, default=12, help="custom scenario, transactions per ticker or account per year")
+    parser.add_argument("--cash-accounts", type=int, default=2, help="custom scenario")
+    parser.add_argument("--debt-accounts", type=int, default=1, help="custom scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="json file the results are written to")
+    parser.add_argument("--compare", help="json file of a previous run to compare with")
+    args = parser.parse_args()
+
+    specs = {name: SCENARIOS[name] for name in args.scenarios if name in SCENARIOS}
+    if "custom" in args.scenarios:
+        specs["custom"] = PortfolioSpec(args.tickers, args.years, args.density, args.cash_accounts, args.debt_accounts)
+    for spec in specs.values():
+        spec.seed = args.seed
+
+    report = {
+        "commit": gitCommit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "until_date": UNTIL_DATE.date().isoformat(),
+        "scenarios": {},
+    }
+
+    original_store = yfinance_utils.price_store
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        SQLModel.metadata.create_all(engine)
+        createMissingIndexes(engine)
+
+        # the pipeline reads its prices through the module's store, pointed at the temporary database
+        yfinance_utils.price_store = PriceStore(engine, source=FakePriceSource())
+
+        try:
+            print(f"{'scenario':>8} {'benchmark':>42} {'best':>11} {'median':>11}")
+
+            for portfolio_id, (name, spec) in enumerate(specs.items(), start=1):
+                yfinance_utils.history_cache.clear()
+                scenario_report = report["scenarios"][name] = runScenario(engine, portfolio_id, spec, args.repeat)
+
+                for benchmark, timing in scenario_report["results"].items():
+                    print(f"{name:>8} {benchmark:>42} {timing['best'] * 1000:>8.2f} ms {timing['median'] * 1000:>8.2f} ms")
+        finally:
+            yfinance_utils.price_store = original_store
+            yfinance_utils.history_cache.clear()
+            engine.dispose()
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"\nresults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            printComparison(report, json.load(previous_file))
+
+if __name__ == "__main__":
+    main()
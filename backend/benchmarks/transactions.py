@@ -0,0 +1,152 @@
+# Benchmark of the transaction queries on a synthetic database, before and after the composite indexes
+# run from the backend folder: python -m benchmarks.transactions
+import argparse
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from sqlmodel import SQLModel, Session, create_engine
+from app import models
+from app.migrations import createMissingIndexes
+from app.valuation import loadTransactions
+from benchmarks.insert_weekends import timeIt
+
+TICKERS = ["AAPL", "MSFT", "GOOG", "AMZN", "NVDA", "VFV.TO", "XEQT.TO", "SHOP.TO", "RY.TO", "TD.TO"]
+UNTIL_DATE = datetime(2025, 1, 1)
+
+def populate(engine, portfolios: int, transactions: int, seed: int = 0):
+    rng = random.Random(seed)
+    first_day = datetime(2005, 1, 1)
+
+    # nine stock transactions for each cash one, spread over 20 years
+    stock_rows, cash_rows = [], []
+    for _ in range(transactions):
+        portfolio_id = rng.randrange(portfolios)
+        transaction_date = first_day + timedelta(days=rng.randrange(20 * 365), seconds=rng.randrange(86400))
+
+        if rng.random() < 0.9:
+            stock_rows.append({
+                "portfolio_id": portfolio_id,
+                "ticker": rng.choice(TICKERS),
+                "amount": rng.randint(1, 100),
+                "price": rng.uniform(10, 500),
+                "fees": 0,
+                "action": "add" if rng.random() < 0.8 else "remove",
+                "drip": False,
+                "date": transaction_date,
+            })
+        else:
+            cash_rows.append({
+                "portfolio_id": portfolio_id,
+                "name": "Savings",
+                "amount": rng.uniform(100, 5000),
+                "interest": 2.5,
+                "action": "add",
+                "date": transaction_date,
+            })
+
+    with Session(engine) as session:
+        session.exec(text("""
+            INSERT INTO stock_holdings (portfolio_id, ticker, amount, price, fees, action, drip, date)
+            VALUES (:portfolio_id, :ticker, :amount, :price, :fees, :action, :drip, :date)
+        """), params=stock_rows)
+        session.exec(text("""
+            INSERT INTO cash (portfolio_id, name, amount, interest, action, date)
+            VALUES (:portfolio_id, :name, :amount, :interest, :action, :date)
+        """), params=cash_rows)
+        session.commit()
+
+def dropIndexes(engine):
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+
+def legacyStockTransactionsByDay(session: Session, portfolio_id: int, until_date: datetime):
+    # what getHistoricalStocks used to run: the daily aggregation, then the first transaction date in a second statement
+    results = session.exec(text("""
+        WITH calculated_basis AS (
+            SELECT ticker,
+                CASE WHEN action = 'add' THEN amount ELSE -amount END AS adjusted_amount,
+                CASE WHEN action = 'add' THEN (amount * (price + COALESCE(fees, 0) / NULLIF(amount, 0))) ELSE 0 END AS adjusted_cost,
+                date(date) AS transaction_date, drip, fees
+            FROM stock_holdings
+            WHERE portfolio_id = :portfolio_id AND date < :until_date
+        )
+        SELECT ticker, transaction_date,
+            SUM(adjusted_cost) / NULLIF(SUM(CASE WHEN adjusted_amount > 0 THEN adjusted_amount ELSE 0 END), 0) AS avg_cost_basis,
+            SUM(adjusted_amount) AS total_shares, drip, fees
+        FROM calculated_basis
+        GROUP BY ticker, transaction_date
+        HAVING SUM(adjusted_amount) > 0;
+    """).params(portfolio_id=portfolio_id, until_date=until_date)).all()
+
+    first_date = session.exec(text("""
+        SELECT MIN(date(date)) AS first_transaction_date FROM stock_holdings
+        WHERE portfolio_id = :portfolio_id AND date < :until_date
+        UNION
+        SELECT MIN(date(date)) AS first_transaction_date FROM cash
+        WHERE portfolio_id = :portfolio_id AND date < :until_date
+    """).params(portfolio_id=portfolio_id, until_date=until_date)).first()
+
+    current_stocks = [
+        {
+            "name": result.ticker,
+            "quantity": result.total_shares,
+            "price": result.avg_cost_basis,
+            "date": result.transaction_date,
+            "drip": result.drip,
+            "fees": result.fees,
+        }
+        for result in results
+    ]
+
+    return current_stocks, first_date.first_transaction_date
+
+def timePortfolios(engine, function, portfolio_ids: list, repeat: int) -> float:
+    def run():
+        with Session(engine) as session:
+            for portfolio_id in portfolio_ids:
+                function(session, portfolio_id, UNTIL_DATE)
+
+    return timeIt(run, repeat=repeat) / len(portfolio_ids)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the transaction queries with and without the composite indexes")
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument("--portfolios", type=int, default=2000)
+    parser.add_argument("--sample", type=int, default=20, help="portfolios queried per timing")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        SQLModel.metadata.create_all(engine)
+
+        # the tables as they were before the indexes were declared
+        dropIndexes(engine)
+        populate(engine, args.portfolios, args.transactions)
+
+        portfolio_ids = random.Random(1).sample(range(args.portfolios), args.sample)
+        queries = {
+            "two statements": legacyStockTransactionsByDay,
+            "single statement": lambda session, portfolio_id, until_date: loadTransactions(session, portfolio_id, until_date, ("stock",)),
+        }
+
+        print(f"{args.transactions} transactions in {args.portfolios} portfolios, mean time per portfolio")
+        print(f"{'query':>18} {'no index':>12} {'indexed':>12}")
+
+        timings = {label: [timePortfolios(engine, query, portfolio_ids, args.repeat)] for label, query in queries.items()}
+
+        # the migration path an existing database takes on startup
+        createMissingIndexes(engine)
+
+        for label, query in queries.items():
+            timings[label].append(timePortfolios(engine, query, portfolio_ids, args.repeat))
+            print(f"{label:>18} {timings[label][0] * 1000:>9.2f} ms {timings[label][1] * 1000:>9.2f} ms")
+
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,80 @@
 import os
+from sqlalchemy import event
 from sqlmodel import create_engine, Session
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-DATABASE_URL = 'sqlite:///' + os.path.join(basedir, '../database/database.db')
-engine = create_engine(DATABASE_URL, echo=True)
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, '../database/database.db'))
 
-db = Session(engine)
\ No newline at end of file
+# log every SQL statement, only useful when debugging queries
+SQL_ECHO = os.getenv('SQL_ECHO', 'false').lower() in ('1', 'true', 'yes')
+
+# connections kept open for the request sessions, and how many more can be opened under load
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+
+engine_options = {"echo": SQL_ECHO}
+
+if DATABASE_URL.startswith('sqlite'):
+    # sessions are used from worker threads, and writers wait on each other instead of failing right away
+    engine_options["connect_args"] = {"check_same_thread": False, "timeout": 30}
+
+if DATABASE_URL not in ('sqlite://', 'sqlite:///:memory:'):
+    engine_options["pool_size"] = DB_POOL_SIZE
+    engine_options["max_overflow"] = DB_MAX_OVERFLOW
+    engine_options["pool_pre_ping"] = True
+
+engine = create_engine(DATABASE_URL, **engine_options)
+
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine, "connect")
+    def setSqlitePragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers keep going while one request writes
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.execute("PRAGMA cache_size=-64000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+def getSession() -> Session:
+    # one session (and one pooled connection) per request or job, never shared between threads
+    return Session(engine)
+
+# number of tickers whose price history is downloaded at the same time
+PRICE_FETCH_WORKERS = int(os.getenv('PRICE_FETCH_WORKERS', 8))
+
+# number of portfolio valuations computed at the same time, outside of the event loop
+VALUATION_WORKERS = int(os.getenv('VALUATION_WORKERS', 4))
+
+# memory kept by the process-wide cache of price histories, the least recently used ones are dropped past it
+HISTORY_CACHE_MAX_BYTES = int(os.getenv('HISTORY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# memory kept by the cache of rendered series, one per request at the portfolio's current version
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+# currency the series are converted to for a portfolio whose owner has no country (see app/currency.py)
+BASE_CURRENCY = os.getenv('BASE_CURRENCY', 'USD')
+
+# background refresh of the held tickers' prices, requests then read today's bar as last refreshed
+PRICE_REFRESHER = os.getenv('PRICE_REFRESHER', 'true').lower() in ('1', 'true', 'yes')
+# minutes between refreshes during the session (0 to only refresh after the close), and after the close
+PRICE_REFRESH_INTERVAL_MINUTES = int(os.getenv('PRICE_REFRESH_INTERVAL_MINUTES', 15))
+PRICE_REFRESH_DELAY_MINUTES = int(os.getenv('PRICE_REFRESH_DELAY_MINUTES', 30))
+# seconds between two downloads, and the longest wait once rate limited
+PRICE_REFRESH_REQUEST_INTERVAL = float(os.getenv('PRICE_REFRESH_REQUEST_INTERVAL', 0.5))
+PRICE_REFRESH_MAX_BACKOFF = float(os.getenv('PRICE_REFRESH_MAX_BACKOFF', 900))
+PRICE_REFRESH_MAX_RETRIES = int(os.getenv('PRICE_REFRESH_MAX_RETRIES', 5))
+
+# listing of the symbols searched by /tickers and used to validate new transactions, downloaded again once older than this
+TICKER_LISTING_PATH = os.getenv('TICKER_LISTING_PATH', os.path.join(basedir, '../database/tickers.csv'))
+TICKER_LISTING_MAX_AGE_DAYS = int(os.getenv('TICKER_LISTING_MAX_AGE_DAYS', 7))
+# how long Yahoo's "no such symbol" is trusted for a symbol missing from the listing (a throttled request looks the same)
+TICKER_UNKNOWN_TTL_MINUTES = int(os.getenv('TICKER_UNKNOWN_TTL_MINUTES', 60))
+
+# Server-Timing header with the time spent per stage (sql, fetch, fill, valuate, serialize), shown in the browser's network tab
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes')
+# lets a request add ?profile=true to have its valuation profiled with cProfile, the dump is written to PROFILE_DIR
+PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', 'false').lower() in ('1', 'true', 'yes')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(basedir, '../profiles'))
@@ -1,11 +1,35 @@
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from app.migrations import migrate
 from app.routes import app
+from app.refresher import market_data_refresher
+from app.ticker_index import loadTickerIndexInBackground
+from app.instrumentation import TimingMiddleware, instrumentEngine
+from instance.config import engine, PRICE_REFRESHER
 
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 
 
-mainApp = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # creates the tables that don't exist yet (e.g. the snapshot tables on an existing database)
+    # and the indexes added to the existing ones
+    migrate(engine)
+    
+    # the listing may have to be downloaded, /tickers returns nothing until it is loaded
+    loadTickerIndexInBackground()
+    
+    # keeps the held tickers' prices warm, so requests don't wait on Yahoo Finance
+    if PRICE_REFRESHER:
+        market_data_refresher.start()
+    
+    yield
+    
+    await market_data_refresher.stop()
+
+mainApp = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5000",
@@ -19,6 +43,13 @@ mainApp.add_middleware(
     allow_headers=["*"],
 )
 
+# the historical series compress very well (repeated keys, names and dates)
+mainApp.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# times every request and its stages for /metrics, added last so it wraps the others
+instrumentEngine(engine)
+mainApp.add_middleware(TimingMiddleware)
+
 # Mount your app under the "/" path
 mainApp.mount("/", app)
 
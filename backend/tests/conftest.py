@@ -0,0 +1,69 @@
+from datetime import date, timedelta
+import pandas as pd
+import pytest
+from sqlmodel import SQLModel, Session, create_engine
+from app import models
+from app.price_store import PriceStore, emptyHistory
+
+class StubSource:
+    """Offline price source: a bar every weekday, with every download it was asked for recorded."""
+
+    def __init__(self):
+        self.calls = []
+        # the ranges to answer with nothing, like a failed or throttled download
+        self.empty_ranges = set()
+        # (ticker, day) -> dividend per share paid on that day
+        self.dividends = {}
+        # the tickers without a single quote, and the currency of the ones that don't trade in USD
+        self.unquoted = set()
+        self.currencies = {}
+        # the tickers whose currency request fails, like a throttled one
+        self.currency_errors = set()
+
+    def fetch(self, ticker: str, start: date, end: date) -> pd.DataFrame:
+        self.calls.append((ticker, start, end))
+
+        days = pd.bdate_range(start, end - timedelta(days=1))
+        if (start, end) in self.empty_ranges or ticker in self.unquoted or days.empty:
+            return emptyHistory(ticker)
+
+        history_df = pd.DataFrame({"date": days, "open": 10.0, "close": 10.0 + days.day / 100,
+                                   "Dividends": [self.dividends.get((ticker, day.date()), 0.0) for day in days]})
+        history_df["Ticker"] = ticker
+        return history_df
+
+    def fetchCurrency(self, ticker: str) -> str:
+        self.calls.append((ticker, "currency"))
+        if ticker in self.currency_errors:
+            raise ConnectionError("throttled")
+        return self.currencies.get(ticker, "USD")
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def session(engine):
+    with Session(engine) as session:
+        yield session
+
+@pytest.fixture
+def source():
+    return StubSource()
+
+@pytest.fixture
+def price_store(engine, source):
+    return PriceStore(engine, source=source)
+
+@pytest.fixture
+def market(monkeypatch, price_store):
+    # the valuations read their prices from the stub source, through an empty history cache
+    from app import yfinance_utils
+    from app.history_cache import HistoryCache
+
+    monkeypatch.setattr(yfinance_utils, "price_store", price_store)
+    monkeypatch.setattr(yfinance_utils, "history_cache", HistoryCache(64 * 1024 * 1024))
+    return price_store
@@ -0,0 +1,39 @@
+from datetime import datetime
+from instance import config
+from app.conditional import todaysBarPeriod
+from app.market_hours import MARKET_TIMEZONE
+
+def test_without_the_refresher_a_response_lasts_one_interval_of_the_session(monkeypatch):
+    monkeypatch.setattr(config, "PRICE_REFRESHER", False)
+    monkeypatch.setattr(config, "PRICE_REFRESH_INTERVAL_MINUTES", 15)
+
+    assert todaysBarPeriod(datetime(2026, 10, 15, 9, 40, tzinfo=MARKET_TIMEZONE)) == 0
+    assert todaysBarPeriod(datetime(2026, 10, 15, 9, 50, tzinfo=MARKET_TIMEZONE)) == 1
+    assert todaysBarPeriod(datetime(2026, 10, 15, 15, 59, tzinfo=MARKET_TIMEZONE)) == 25
+    # outside of the session today's bar doesn't move
+    assert todaysBarPeriod(datetime(2026, 10, 15, 8, 0, tzinfo=MARKET_TIMEZONE)) is None
+    assert todaysBarPeriod(datetime(2026, 10, 15, 17, 0, tzinfo=MARKET_TIMEZONE)) is None
+    assert todaysBarPeriod(datetime(2026, 10, 17, 12, 0, tzinfo=MARKET_TIMEZONE)) is None
+
+def test_with_the_refresher_the_price_version_moves_instead(monkeypatch):
+    monkeypatch.setattr(config, "PRICE_REFRESHER", True)
+
+    assert todaysBarPeriod(datetime(2026, 10, 15, 9, 50, tzinfo=MARKET_TIMEZONE)) is None
+
+def test_the_etag_rolls_over_at_midnight_in_new_york(monkeypatch):
+    from starlette.requests import Request
+    from app import conditional, market_hours
+    from app.conditional import makeETag
+
+    monkeypatch.setattr(config, "PRICE_REFRESHER", True)
+    request = Request({"type": "http", "method": "GET", "path": "/assets/1", "query_string": b"", "headers": []})
+
+    def etagAt(now: datetime) -> str:
+        monkeypatch.setattr(conditional, "marketNow", lambda: now)
+        monkeypatch.setattr(market_hours, "marketNow", lambda: now)
+        return makeETag(request, "1.0")
+
+    # already the 16th in UTC, still the 15th in New York
+    evening = etagAt(datetime(2026, 10, 15, 20, 0, tzinfo=MARKET_TIMEZONE))
+    assert etagAt(datetime(2026, 10, 15, 23, 30, tzinfo=MARKET_TIMEZONE)) == evening
+    assert etagAt(datetime(2026, 10, 16, 0, 30, tzinfo=MARKET_TIMEZONE)) != evening
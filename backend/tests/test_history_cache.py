@@ -0,0 +1,158 @@
+import threading
+import time
+from datetime import date, datetime, timedelta
+import pandas as pd
+import pytest
+from app import history_cache as history_cache_module
+from app.history_cache import HistoryCache, historySize
+from app.market_hours import MARKET_TIMEZONE
+
+# a Thursday during the session, the market closes at 16:00
+NOW = datetime(2026, 10, 15, 11, 0, tzinfo=MARKET_TIMEZONE)
+
+def history(days: int = 5) -> pd.DataFrame:
+    return pd.DataFrame({"date": pd.date_range("2026-10-01", periods=days), "close": 10.0})
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [NOW]
+    monkeypatch.setattr(history_cache_module, "marketNow", lambda: now[0])
+    return now
+
+class Loads:
+    """A load function that counts its calls."""
+
+    def __init__(self, history_df=None):
+        self.history_df = history_df if history_df is not None else history()
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.history_df
+
+def test_concurrent_misses_load_once(clock):
+    cache = HistoryCache(1024 * 1024)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slowLoad():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return history()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("AAA", date(2026, 10, 1), date(2026, 10, 6), slowLoad))) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+
+    # the others wait on the first load
+    deadline = time.monotonic() + 5
+    while cache.stats()["coalesced"] < 3 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert len(results) == 4 and all(result.equals(history()) for result in results)
+    assert (cache.stats()["misses"], cache.stats()["coalesced"]) == (1, 3)
+
+def test_a_failed_load_is_raised_and_not_kept(clock):
+    cache = HistoryCache(1024 * 1024)
+
+    def failingLoad():
+        raise ConnectionError("no network")
+
+    with pytest.raises(ConnectionError):
+        cache.get("AAA", date(2026, 10, 1), date(2026, 10, 6), failingLoad)
+
+    load = Loads()
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 6), load)
+    assert load.calls == 1
+
+def test_the_least_recently_used_entries_are_evicted_past_max_bytes(clock):
+    size = historySize(history())
+    cache = HistoryCache(size * 2)
+    loads = {ticker: Loads() for ticker in ["AAA", "BBB", "CCC"]}
+
+    def get(ticker):
+        return cache.get(ticker, date(2026, 10, 1), date(2026, 10, 6), loads[ticker])
+
+    get("AAA")
+    get("BBB")
+    # AAA is now the most recently used
+    get("AAA")
+    get("CCC")
+
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == size * 2
+    get("AAA")
+    get("BBB")
+    assert (loads["AAA"].calls, loads["BBB"].calls) == (1, 2)
+
+def test_an_entry_bigger_than_the_cache_is_returned_but_not_kept(clock):
+    cache = HistoryCache(historySize(history()) - 1)
+    load = Loads()
+
+    assert cache.get("AAA", date(2026, 10, 1), date(2026, 10, 6), load).equals(history())
+    assert cache.stats()["entries"] == 0
+
+def test_a_closed_range_never_expires(clock):
+    cache = HistoryCache(1024 * 1024, today_ttl=timedelta(minutes=15))
+    load = Loads()
+
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 15), load)
+    clock[0] += timedelta(days=30)
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 15), load)
+
+    assert load.calls == 1
+
+def test_a_range_with_today_expires_at_the_close(clock):
+    cache = HistoryCache(1024 * 1024)
+    load = Loads()
+
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 16), load)
+    clock[0] = NOW.replace(hour=15, minute=59)
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 16), load)
+    assert load.calls == 1
+
+    clock[0] = NOW.replace(hour=16, minute=0)
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 16), load)
+    assert load.calls == 2
+    assert cache.stats()["expirations"] == 1
+
+def test_a_range_with_today_expires_after_today_ttl(clock):
+    cache = HistoryCache(1024 * 1024, today_ttl=timedelta(minutes=15))
+    load = Loads()
+
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 16), load)
+    clock[0] = NOW + timedelta(minutes=14)
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 16), load)
+    assert load.calls == 1
+
+    clock[0] = NOW + timedelta(minutes=15)
+    cache.get("AAA", date(2026, 10, 1), date(2026, 10, 16), load)
+    assert load.calls == 2
+
+def test_invalidate_drops_the_ranges_including_the_saved_days(clock):
+    cache = HistoryCache(1024 * 1024)
+    ranges = [("AAA", date(2026, 10, 1), date(2026, 10, 6)), ("AAA", date(2026, 10, 1), date(2026, 10, 12)),
+              ("AAA", date(2026, 10, 1), date(2026, 10, 16)), ("BBB", date(2026, 10, 1), date(2026, 10, 12))]
+    loads = {key: Loads() for key in ranges}
+    for key in ranges:
+        cache.get(*key, loads[key])
+
+    # prices saved from the 8th on: only the AAA ranges ending after it are read again
+    cache.invalidate("AAA", date(2026, 10, 8))
+    for key in ranges:
+        cache.get(*key, loads[key])
+    assert [loads[key].calls for key in ranges] == [1, 2, 2, 1]
+
+    # without a day, the ranges that include today (a refresh of today's bar)
+    cache.invalidate("AAA")
+    for key in ranges:
+        cache.get(*key, loads[key])
+    assert [loads[key].calls for key in ranges] == [1, 2, 3, 1]
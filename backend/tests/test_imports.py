@@ -0,0 +1,50 @@
+from datetime import date
+import pytest
+from sqlalchemy import text
+from app import imports
+from app.imports import InvalidImportError, importTransactions
+from tests.test_ledger import transact
+
+HEADER = "type,action,date,ticker,name,quantity,amount,price\n"
+
+@pytest.fixture(autouse=True)
+def known_tickers(monkeypatch):
+    monkeypatch.setattr(imports, "isUnknownTicker", lambda ticker: False)
+
+def importErrors(session, *lines) -> list[dict]:
+    with pytest.raises(InvalidImportError) as error:
+        importTransactions(session, 1, (HEADER + "".join(line + "\n" for line in lines)).encode(), "csv")
+    return error.value.errors
+
+def storedRows(session, table: str) -> int:
+    return session.exec(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+
+def test_a_backdated_remove_is_checked_against_what_was_held_then(session):
+    transact(session, "add", date(2024, 3, 1), 10, 10)
+
+    # 10 shares are held today, none on the 1st of February
+    assert importErrors(session, "stock,remove,2024-02-01,AAA,,5,,10") == [{"line": 2, "error": "removes more AAA shares than held"}]
+    assert storedRows(session, "stock_holdings") == 1
+
+    assert importTransactions(session, 1, (HEADER + "stock,remove,2024-03-01,AAA,,5,,10\n").encode(), "csv") == {"stocks": 1, "cash": 0}
+
+def test_a_remove_that_empties_a_later_stored_remove_is_rejected(session):
+    transact(session, "add", date(2024, 1, 1), 10, 10)
+    transact(session, "remove", date(2024, 3, 1), 10, 10)
+
+    # enough shares on its own day, but the stored sale of March then sells more than what is left
+    assert importErrors(session, "stock,add,2024-01-15,AAA,,2,,10", "stock,remove,2024-02-01,AAA,,5,,10") == \
+        [{"line": 3, "error": "removes more AAA shares than held"}]
+
+def test_imported_rows_are_replayed_in_date_order(session):
+    transact(session, "add", date(2024, 1, 1), 10, 10)
+
+    # the remove comes first in the file, but after the add in time
+    body = HEADER + "stock,remove,2024-02-01,AAA,,15,,10\nstock,add,2024-01-15,AAA,,5,,10\n"
+    assert importTransactions(session, 1, body.encode(), "csv") == {"stocks": 2, "cash": 0}
+
+def test_a_backdated_cash_remove_is_checked_against_the_balance_then(session):
+    importTransactions(session, 1, (HEADER + "cash,add,2024-03-01,,Savings,,100,\n").encode(), "csv")
+
+    assert importErrors(session, "cash,remove,2024-02-01,,Savings,,50,") == [{"line": 2, "error": "removes more cash than the portfolio holds"}]
+    assert storedRows(session, "cash") == 1
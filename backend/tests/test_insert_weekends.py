@@ -0,0 +1,47 @@
+import pandas as pd
+from benchmarks.insert_weekends import legacyInsertWeekends, makeTradingHistory
+from app.yfinance_utils import insertWeekends
+
+def test_the_fill_matches_the_row_by_row_one():
+    # a year of business days, with a holiday (a day without a bar inside the week) and a dividend paid on a Friday
+    history_df = makeTradingHistory(365)
+    history_df = history_df[history_df["date"] != pd.Timestamp("2024-07-04")].reset_index(drop=True)
+    history_df.loc[history_df["date"] == pd.Timestamp("2024-06-14"), "Dividends"] = 0.5
+
+    filled_df = insertWeekends(history_df)
+    legacy_df = legacyInsertWeekends(history_df)
+
+    assert filled_df["date"].tolist() == legacy_df["date"].tolist()
+    assert filled_df["date"].diff().dropna().dt.days.eq(1).all()
+    for column in ["open", "close", "Ticker"]:
+        assert filled_df[column].tolist() == legacy_df[column].tolist()
+
+    # a filled day opens at the close before it, and the dividend is only paid on its trading day
+    is_filled = ~filled_df["date"].isin(history_df["date"])
+    assert (filled_df.loc[is_filled, "open"].to_numpy() == filled_df["close"].shift().loc[is_filled].to_numpy()).all()
+    assert filled_df.loc[is_filled, "Dividends"].eq(0).all()
+    assert filled_df["Dividends"].sum() == 0.5
+    assert filled_df.loc[~is_filled, "Dividends"].tolist() == legacy_df.loc[~is_filled, "Dividends"].tolist()
+
+def test_duplicate_dates_keep_the_last_bar():
+    history_df = pd.DataFrame({
+        "date": pd.to_datetime(["2024-01-05", "2024-01-08", "2024-01-05"]),
+        "open": [1.0, 2.0, 3.0],
+        "close": [1.5, 2.5, 3.5],
+        "Dividends": 0.0,
+    })
+
+    filled_df = insertWeekends(history_df)
+
+    assert filled_df["date"].dt.strftime("%Y-%m-%d").tolist() == ["2024-01-05", "2024-01-06", "2024-01-07", "2024-01-08"]
+    assert filled_df["close"].tolist() == [3.5, 3.5, 3.5, 2.5]
+    assert filled_df["open"].tolist() == [3.0, 3.5, 3.5, 2.0]
+
+def test_an_empty_history_passes_through():
+    history_df = pd.DataFrame({"date": pd.Series(dtype="datetime64[ns]"), "open": pd.Series(dtype=float),
+                               "close": pd.Series(dtype=float), "Dividends": pd.Series(dtype=float)})
+
+    filled_df = insertWeekends(history_df)
+
+    assert filled_df.empty
+    assert list(filled_df.columns) == list(history_df.columns)
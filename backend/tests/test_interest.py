@@ -0,0 +1,96 @@
+from datetime import date, timedelta
+import numpy as np
+import pytest
+from app.interest import accrueBalances, toDailyRate
+from app.utils import getDailyBalances
+
+def naiveBalances(flows, daily_rates, resets=None) -> np.ndarray:
+    # the recurrence accrueBalances solves, one account and one day at a time
+    flows = np.atleast_2d(flows)
+    daily_rates = np.broadcast_to(daily_rates, flows.shape)
+    resets = np.zeros(flows.shape, dtype=bool) if resets is None else np.broadcast_to(resets, flows.shape)
+    balances = np.zeros(flows.shape)
+
+    for account in range(flows.shape[0]):
+        balance = 0.0
+        for day in range(flows.shape[1]):
+            balance = flows[account, day] if resets[account, day] else balance * (1 + daily_rates[account, day]) + flows[account, day]
+            balances[account, day] = balance
+
+    return balances
+
+def test_several_accounts_with_rate_changes_match_the_recurrence():
+    days = 3 * 365
+    flows = np.zeros((3, days))
+    flows[0, 0], flows[0, 400], flows[0, 700] = 10000, 2500, -4000
+    flows[1, 30::30] = 150
+    # borrowed, then paid back in full
+    flows[2, 10], flows[2, 500] = -50000, 0
+
+    rates = np.zeros((3, days))
+    rates[0, :200], rates[0, 200:] = 2.5, 4.0
+    rates[1] = 1.0
+    rates[2, :365], rates[2, 365:] = 6.0, 5.0
+    daily_rates = toDailyRate(rates)
+
+    expected = naiveBalances(flows, daily_rates)
+    flows[2, 500] = -expected[2, 499] * (1 + daily_rates[2, 500])
+    expected = naiveBalances(flows, daily_rates)
+
+    balances = accrueBalances(flows, daily_rates)
+
+    assert balances == pytest.approx(expected, rel=1e-9, abs=1e-6)
+    # the loan paid back stays at 0, without the rounding of the discounted sums growing with the rate
+    assert np.abs(balances[2, 500:]).max() < 1e-6
+
+def test_a_reset_restarts_the_balance_from_that_day():
+    days = 365
+    flows = np.zeros((2, days))
+    flows[:, 0] = 1000
+    flows[0, 100], flows[0, 250] = 500, 0
+    flows[1, 50] = 300
+
+    resets = np.zeros((2, days), dtype=bool)
+    resets[:, 0] = True
+    # the first account is set to 500, then emptied (a withdrawal of everything)
+    resets[0, 100] = resets[0, 250] = True
+
+    daily_rates = toDailyRate(np.array([[3.0], [5.0]]))
+
+    balances = accrueBalances(flows, daily_rates, resets)
+
+    assert balances == pytest.approx(naiveBalances(flows, daily_rates, resets), rel=1e-9, abs=1e-6)
+    assert balances[0, 249] > 500
+    assert np.all(balances[0, 250:] == 0)
+
+def test_daily_balances_sum_the_accounts_day_by_day():
+    first_day = date(2024, 1, 1)
+    transactions = [
+        ("Savings", 1000.0, 3.0, "2024-01-01 00:00:00.000000", "add"),
+        ("Savings", 200.0, 4.5, "2024-02-15 00:00:00.000000", "add"),
+        ("Savings", 1000.0, 4.5, "2024-03-10 00:00:00.000000", "remove"),
+        ("Checking", 500.0, 0.5, "2024-01-20 00:00:00.000000", "add"),
+        ("Checking", 100.0, 0.5, "2024-04-01 00:00:00.000000", "remove"),
+    ]
+    until_date = date(2024, 6, 30)
+
+    daily_balances = getDailyBalances(transactions, until_date, 1)
+
+    # each account on its own: the rate of its latest transaction from that day on
+    expected = {}
+    for name in ("Savings", "Checking"):
+        balance, rate = 0.0, 0.0
+        day = first_day
+        while day <= until_date:
+            for transaction_name, amount, interest, transaction_date, action in transactions:
+                if transaction_name == name and transaction_date[:10] == day.isoformat():
+                    rate = interest
+                    balance = balance * (1 + toDailyRate(rate)) + (amount if action == "add" else -amount)
+                    break
+            else:
+                balance *= 1 + toDailyRate(rate)
+            expected[day.isoformat()] = expected.get(day.isoformat(), 0) + balance
+            day += timedelta(days=1)
+
+    assert list(daily_balances) == list(expected)
+    assert list(daily_balances.values()) == pytest.approx([round(value, 2) for value in expected.values()], abs=0.011)
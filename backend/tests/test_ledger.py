@@ -0,0 +1,135 @@
+from datetime import date, datetime
+import pytest
+from sqlalchemy import text
+from app import imports
+from app.imports import importTransactions
+from app.ledger import buildMissingLedgers, rebuildLedger, recordStockTransaction
+from app.models import Portfolio, StockHoldings
+
+def transact(session, action, day, amount, price, fees=0, ticker="AAA", record=True):
+    holding = StockHoldings(portfolio_id=1, ticker=ticker, amount=amount, price=price, fees=fees, action=action, drip=False,
+                            date=datetime.combine(day, datetime.min.time()))
+    session.add(holding)
+    session.flush()
+    if record:
+        recordStockTransaction(session, holding)
+    session.commit()
+    return holding.transaction_id
+
+def ledger(session) -> tuple[list, list]:
+    positions = session.exec(text("""
+        SELECT ticker, shares, cost, realized_gain, last_date, last_transaction_id FROM stock_positions ORDER BY ticker
+    """)).all()
+    lots = session.exec(text("""
+        SELECT transaction_id, ticker, date, quantity, remaining, cost_per_share FROM stock_lots ORDER BY transaction_id
+    """)).all()
+    return [tuple(row) for row in positions], [tuple(row) for row in lots]
+
+def assertMatchesReplay(session) -> tuple[list, list]:
+    # what the transactions wrote one at a time is what a replay of all of them writes
+    recorded = ledger(session)
+    rebuildLedger(session, 1)
+    session.commit()
+    replayed = ledger(session)
+
+    for recorded_rows, replayed_rows in zip(recorded, replayed):
+        assert len(recorded_rows) == len(replayed_rows)
+        for recorded_row, replayed_row in zip(recorded_rows, replayed_rows):
+            assert recorded_row == pytest.approx(replayed_row)
+
+    return replayed
+
+def lotsRemaining(lots) -> dict:
+    return {transaction_id: remaining for transaction_id, _, _, _, remaining, _ in lots}
+
+def test_a_fifo_sale_sells_the_oldest_lots_first(session):
+    first = transact(session, "add", date(2024, 1, 1), 10, 10)
+    second = transact(session, "add", date(2024, 1, 2), 10, 19, fees=10)
+    transact(session, "remove", date(2024, 1, 3), 15, 30, fees=5)
+
+    positions, lots = assertMatchesReplay(session)
+
+    # the first lot is sold out, half of the second one is left (its fees are part of its cost)
+    assert lotsRemaining(lots) == {first: 0, second: 5}
+    _, shares, cost, realized_gain, last_date, _ = positions[0]
+    assert shares == 5
+    assert cost == pytest.approx(100)
+    assert realized_gain == pytest.approx(445 - 200)
+    assert last_date == "2024-01-03"
+
+def test_an_average_sale_costs_the_average_of_the_shares_held(session):
+    session.add(Portfolio(portfolio_id=1, user_id="user", cost_basis_method="average"))
+    session.commit()
+
+    first = transact(session, "add", date(2024, 1, 1), 10, 10)
+    second = transact(session, "add", date(2024, 1, 2), 10, 20)
+    transact(session, "remove", date(2024, 1, 3), 15, 30)
+    transact(session, "remove", date(2024, 1, 4), 2, 30)
+
+    positions, lots = assertMatchesReplay(session)
+
+    # the lots are still sold oldest first, only the cost is the average one
+    assert lotsRemaining(lots) == {first: 0, second: 3}
+    _, shares, cost, realized_gain, _, _ = positions[0]
+    assert shares == 3
+    assert cost == pytest.approx(45)
+    assert realized_gain == pytest.approx(510 - 255)
+
+def test_a_backdated_sale_replays_the_ticker(session):
+    first = transact(session, "add", date(2024, 1, 1), 10, 10)
+    second = transact(session, "add", date(2024, 1, 10), 10, 20)
+    other = transact(session, "add", date(2024, 1, 1), 5, 10, ticker="BBB")
+
+    # dated before the second buy: it only sells from the first lot
+    transact(session, "remove", date(2024, 1, 5), 6, 30)
+
+    positions, lots = assertMatchesReplay(session)
+
+    assert lotsRemaining(lots) == {first: 4, second: 10, other: 5}
+    assert positions[0] == pytest.approx(("AAA", 14, 240, 180 - 60, "2024-01-10", second))
+    # the other ticker is left alone
+    assert positions[1][:3] == ("BBB", 5, 50)
+
+    # a later sale reads the replayed lots
+    transact(session, "remove", date(2024, 1, 20), 14, 25)
+
+    positions, lots = assertMatchesReplay(session)
+    assert lotsRemaining(lots) == {first: 0, second: 0, other: 5}
+    assert positions[0][1:4] == pytest.approx((0, 0, 120 + 350 - 240))
+
+def test_an_import_then_a_sale(session, monkeypatch):
+    monkeypatch.setattr(imports, "isUnknownTicker", lambda ticker: False)
+
+    body = (
+        "type,action,date,ticker,quantity,price,fees\n"
+        "stock,add,2024-01-02,AAA,10,20,0\n"
+        "stock,add,2024-01-01,AAA,10,10,0\n"
+        "stock,remove,2024-01-03,AAA,5,30,0\n"
+        "stock,add,2024-01-01,BBB,4,50,2\n"
+    ).encode()
+    assert importTransactions(session, 1, body, "csv") == {"stocks": 4, "cash": 0}
+
+    # the import is replayed in date order, whatever the order of the file
+    positions, _ = assertMatchesReplay(session)
+    assert positions[0][1:4] == pytest.approx((15, 250, 150 - 50))
+    assert positions[1][1:4] == pytest.approx((4, 202, 0))
+
+    transact(session, "remove", date(2024, 1, 4), 10, 30)
+
+    positions, lots = assertMatchesReplay(session)
+    assert positions[0][1:4] == pytest.approx((5, 100, 100 + 300 - 150))
+    assert sorted(remaining for _, ticker, _, _, remaining, _ in lots if ticker == "AAA") == [0, 5]
+
+def test_missing_ledgers_are_built_from_the_transactions(session):
+    # written before the ledger existed
+    transact(session, "add", date(2024, 1, 1), 10, 10, record=False)
+    transact(session, "add", date(2024, 1, 2), 10, 20, record=False)
+    transact(session, "remove", date(2024, 1, 3), 15, 30, record=False)
+    assert ledger(session) == ([], [])
+
+    assert buildMissingLedgers(session) == [1]
+
+    positions, _ = assertMatchesReplay(session)
+    assert positions[0][1:4] == pytest.approx((5, 100, 450 - 200))
+    # nothing is missing anymore
+    assert buildMissingLedgers(session) == []
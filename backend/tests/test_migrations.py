@@ -0,0 +1,25 @@
+from sqlalchemy import text
+from app.migrations import migrate
+from app.models import SnapshotState
+
+def test_snapshots_from_before_the_currency_conversion_are_rebuilt(engine, session):
+    session.add(SnapshotState(portfolio_id=1, first_date="2024-01-01", valid_until="2024-01-31", version=3))
+    session.exec(text("""
+        INSERT INTO daily_snapshots (portfolio_id, asset_type, name, date, value) VALUES (1, 'stock', 'AAA.TO', '2024-01-02', 100)
+    """))
+    session.commit()
+    # a database from before the currencies were saved
+    session.exec(text("DROP TABLE ticker_currencies"))
+    session.commit()
+
+    migrate(engine)
+    session.expire_all()
+
+    assert session.exec(text("SELECT COUNT(*) FROM daily_snapshots")).scalar() == 0
+    state = session.get(SnapshotState, 1)
+    assert (state.valid_until, state.version) == (None, 4)
+
+    # only once
+    migrate(engine)
+    session.expire_all()
+    assert session.get(SnapshotState, 1).version == 4
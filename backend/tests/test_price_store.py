@@ -0,0 +1,104 @@
+from datetime import date
+from sqlmodel import Session
+from app.yfinance_utils import getCurrencies
+
+def coverage(price_store, ticker):
+    with Session(price_store.engine) as session:
+        return price_store.getCoverage(session, ticker)
+
+def test_only_the_days_after_the_coverage_are_downloaded(price_store, source):
+    price_store.getHistory("AAA", date(2023, 1, 2), date(2023, 2, 1))
+    history_df = price_store.getHistory("AAA", date(2023, 1, 2), date(2023, 3, 1))
+
+    assert source.calls == [("AAA", date(2023, 1, 2), date(2023, 2, 1)), ("AAA", date(2023, 2, 1), date(2023, 3, 1))]
+    assert len(history_df) == 42
+    assert coverage(price_store, "AAA") == [(date(2023, 1, 2), date(2023, 3, 1))]
+
+def test_a_covered_range_is_read_without_downloading(price_store, source):
+    price_store.getHistory("AAA", date(2023, 1, 2), date(2023, 3, 1))
+    history_df = price_store.getHistory("AAA", date(2023, 1, 15), date(2023, 2, 15))
+
+    assert len(source.calls) == 1
+    assert history_df["date"].min().date() == date(2023, 1, 16)
+
+def test_the_days_between_two_ranges_are_not_covered(price_store, source):
+    price_store.getHistory("AAA", date(2024, 6, 1), date(2024, 7, 1))
+    price_store.getHistory("AAA", date(2023, 1, 1), date(2023, 2, 1))
+
+    assert coverage(price_store, "AAA") == [(date(2023, 1, 1), date(2023, 2, 1)), (date(2024, 6, 1), date(2024, 7, 1))]
+
+    history_df = price_store.getHistory("AAA", date(2023, 6, 1), date(2023, 7, 1))
+
+    assert source.calls[-1] == ("AAA", date(2023, 6, 1), date(2023, 7, 1))
+    assert len(history_df) == 22
+
+def test_a_read_over_a_gap_only_downloads_the_gap(price_store, source):
+    price_store.getHistory("AAA", date(2023, 1, 1), date(2023, 2, 1))
+    price_store.getHistory("AAA", date(2023, 6, 1), date(2023, 7, 1))
+    source.calls.clear()
+
+    history_df = price_store.getHistory("AAA", date(2023, 1, 1), date(2023, 8, 1))
+
+    assert source.calls == [("AAA", date(2023, 2, 1), date(2023, 6, 1)), ("AAA", date(2023, 7, 1), date(2023, 8, 1))]
+    assert coverage(price_store, "AAA") == [(date(2023, 1, 1), date(2023, 8, 1))]
+    assert history_df["date"].is_monotonic_increasing and not history_df["date"].duplicated().any()
+    assert len(history_df) == 151
+
+def test_an_empty_download_is_not_covered(price_store, source):
+    source.empty_ranges.add((date(2023, 1, 1), date(2023, 2, 1)))
+
+    history_df = price_store.getHistory("AAA", date(2023, 1, 1), date(2023, 2, 1))
+
+    assert history_df.empty
+    assert coverage(price_store, "AAA") == []
+
+    # the source answers this time, the days are downloaded again
+    source.empty_ranges.clear()
+    history_df = price_store.getHistory("AAA", date(2023, 1, 1), date(2023, 2, 1))
+
+    assert len(source.calls) == 2
+    assert len(history_df) == 22
+    assert coverage(price_store, "AAA") == [(date(2023, 1, 1), date(2023, 2, 1))]
+
+def test_an_empty_range_next_to_a_downloaded_one_is_not_covered(price_store, source):
+    price_store.getHistory("AAA", date(2023, 1, 1), date(2023, 2, 1))
+    source.empty_ranges.add((date(2023, 2, 1), date(2023, 3, 1)))
+
+    price_store.getHistory("AAA", date(2022, 12, 1), date(2023, 3, 1))
+
+    assert coverage(price_store, "AAA") == [(date(2022, 12, 1), date(2023, 2, 1))]
+
+def test_tickers_have_their_own_coverage(price_store, source):
+    price_store.getHistory("AAA", date(2023, 1, 1), date(2023, 2, 1))
+    price_store.getHistory("BBB", date(2023, 1, 1), date(2023, 2, 1))
+
+    assert len(source.calls) == 2
+    assert coverage(price_store, "BBB") == [(date(2023, 1, 1), date(2023, 2, 1))]
+
+def test_the_day_still_traded_in_new_york_is_not_covered(price_store, source, monkeypatch):
+    # e.g. 21:00 in New York, already the 17th on a UTC server
+    monkeypatch.setattr("app.price_store.marketToday", lambda: date(2023, 1, 16))
+
+    price_store.getHistory("AAA", date(2023, 1, 2), date(2023, 1, 18))
+
+    assert coverage(price_store, "AAA") == [(date(2023, 1, 2), date(2023, 1, 16))]
+    assert source.calls[-1] == ("AAA", date(2023, 1, 16), date(2023, 1, 18))
+
+def test_currencies_are_asked_once(market, source):
+    source.currencies["AAA.TO"] = "CAD"
+
+    assert getCurrencies(["AAA.TO", "BBB"]) == {"AAA.TO": "CAD", "BBB": "USD"}
+    assert getCurrencies(["BBB", "AAA.TO"]) == {"AAA.TO": "CAD", "BBB": "USD"}
+    assert sorted(call for call in source.calls if call[1] == "currency") == [("AAA.TO", "currency"), ("BBB", "currency")]
+
+def test_a_failed_currency_request_is_guessed_but_not_saved(market, source):
+    source.currencies["AAA.TO"] = "USD"
+    source.currency_errors.add("AAA.TO")
+
+    # guessed from the exchange suffix meanwhile
+    assert getCurrencies(["AAA.TO"]) == {"AAA.TO": "CAD"}
+    assert market.readCurrencies(["AAA.TO"]) == {}
+
+    source.currency_errors.clear()
+    assert getCurrencies(["AAA.TO"]) == {"AAA.TO": "USD"}
+    assert market.readCurrencies(["AAA.TO"]) == {"AAA.TO": "USD"}
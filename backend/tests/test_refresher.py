@@ -0,0 +1,39 @@
+from datetime import date
+from sqlmodel import Session
+from app import refresher
+from app.refresher import MarketDataRefresher, getHeldTickers
+from app.snapshots import getPortfolioVersion
+from tests.test_ledger import transact
+
+def marketDataRefresher() -> MarketDataRefresher:
+    return MarketDataRefresher(interval=None, delay=None, request_interval=0, max_backoff=0, max_retries=0)
+
+def test_only_the_tickers_still_held_are_refreshed(session, monkeypatch):
+    monkeypatch.setattr(refresher.config, "getSession", lambda: Session(session.get_bind()))
+
+    transact(session, "add", date(2024, 1, 3), 10, 10)
+    transact(session, "add", date(2024, 1, 2), 5, 10, ticker="BBB")
+    transact(session, "add", date(2024, 2, 1), 5, 10, ticker="BBB")
+    transact(session, "remove", date(2024, 3, 1), 10, 10)
+
+    assert getHeldTickers() == {"BBB": date(2024, 1, 2)}
+
+def test_a_refresh_that_saves_nothing_new_keeps_the_etag(session, market, source, monkeypatch):
+    monkeypatch.setattr(refresher.config, "getSession", lambda: Session(session.get_bind()))
+    monkeypatch.setattr(refresher, "marketToday", lambda: date(2024, 1, 31))
+    monkeypatch.setattr("app.price_store.marketToday", lambda: date(2024, 1, 31))
+    transact(session, "add", date(2024, 1, 2), 10, 10)
+
+    marketDataRefresher().refreshTicker("AAA", date(2024, 1, 2))
+    assert getPortfolioVersion(session, 1) == "0.1"
+
+    # only today's bar is asked again, and it didn't move
+    calls = len(source.calls)
+    marketDataRefresher().refreshTicker("AAA", date(2024, 1, 2))
+    assert source.calls[calls:] == [("AAA", date(2024, 1, 31), date(2024, 2, 1))]
+    assert getPortfolioVersion(session, 1) == "0.1"
+
+    # it moved
+    source.dividends[("AAA", date(2024, 1, 31))] = 0.5
+    marketDataRefresher().refreshTicker("AAA", date(2024, 1, 2))
+    assert getPortfolioVersion(session, 1) == "0.2"
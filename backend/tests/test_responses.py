@@ -0,0 +1,71 @@
+import asyncio
+import json
+from datetime import date, timedelta
+import pandas as pd
+import pytest
+from app.responses import SERIES_FIELDS, netWorthResponse, ndjsonAssets, seriesResponse
+
+# days in order, with gaps like the weekly and monthly resolutions have
+DAYS = ["2024-01-01", "2024-01-02", "2024-01-08", "2024-02-01", "2024-03-01"]
+
+RECORDS = [
+    *({"name": "AAA", "date": day, "price": 10.0, "quantity": 5.0, "value": 50.0 + number, "shares": 5.0, "dividends": 0.5,
+       "total_return": 51.0 + number} for number, day in enumerate(DAYS)),
+    *({"name": "Savings", "value": 100.0 + number, "interest": 2.5, "date": day} for number, day in enumerate(DAYS[1:])),
+    *({"name": "Mortgage", "value": -1000.0 + number, "interest": 5.0, "date": day, "type": "debt"} for number, day in enumerate(DAYS)),
+    {"name": "House", "value": 300000.0, "date": DAYS[-1], "type": "real_estate"},
+]
+
+def decodeDates(asset: dict) -> list[str]:
+    # what a client does with either date encoding
+    if "dates" in asset:
+        return asset["dates"]
+
+    dates = [date.fromisoformat(asset["start"])]
+    for delta in asset["date_deltas"]:
+        dates.append(dates[-1] + timedelta(days=delta))
+    return [day.isoformat() for day in dates]
+
+def decodeAsset(asset: dict) -> list[dict]:
+    # back to the rows form: one object per asset per day, only debt and real estate carry their type
+    records = []
+    for number, day in enumerate(decodeDates(asset)):
+        record = {"name": asset["name"], "date": day}
+        record.update({field: asset[field][number] for field in SERIES_FIELDS if field in asset})
+        if asset["type"] in ("debt", "real_estate"):
+            record["type"] = asset["type"]
+        records.append(record)
+    return records
+
+@pytest.mark.parametrize("dates", ["full", "delta"])
+def test_the_columnar_series_decodes_back_to_the_rows(dates):
+    rows = json.loads(seriesResponse(RECORDS, "rows", dates).body)
+    columnar = json.loads(seriesResponse(RECORDS, "columnar", dates).body)
+
+    assert columnar["format"] == "columnar"
+    assert [asset["type"] for asset in columnar["assets"]] == ["stock", "cash", "debt", "real_estate"]
+    assert [record for asset in columnar["assets"] for record in decodeAsset(asset)] == rows == RECORDS
+
+@pytest.mark.parametrize("dates", ["full", "delta"])
+def test_the_ndjson_series_decodes_back_to_the_rows(dates):
+    async def lines() -> list[str]:
+        async def assets():
+            for name in dict.fromkeys(record["name"] for record in RECORDS):
+                yield [record for record in RECORDS if record["name"] == name]
+
+        return [line async for line in ndjsonAssets(assets(), delta_dates=dates == "delta")]
+
+    assets = [json.loads(line) for line in asyncio.run(lines())]
+
+    assert [record for asset in assets for record in decodeAsset(asset)] == RECORDS
+
+def test_the_net_worth_delta_dates_decode_back_to_the_days():
+    net_worth_df = pd.DataFrame({"stock": [50.0, 51.0, 52.0, 53.0, 54.0], "cash": [0.0, 100.0, 101.0, 102.0, 103.0]}, index=DAYS)
+
+    full = json.loads(netWorthResponse(net_worth_df, breakdown=True).body)
+    delta = json.loads(netWorthResponse(net_worth_df, breakdown=True, dates="delta").body)
+
+    assert full["dates"] == DAYS
+    assert decodeDates(delta) == DAYS
+    assert delta["total"] == full["total"] == [50.0, 151.0, 153.0, 155.0, 157.0]
+    assert delta["breakdown"] == full["breakdown"]
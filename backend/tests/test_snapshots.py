@@ -0,0 +1,206 @@
+from datetime import date, datetime
+import pytest
+from sqlalchemy import text
+from sqlmodel import Session
+from app import snapshots
+from app.models import StockHoldings
+from app.snapshots import getSnapshotSeries, getNetWorthSeries, getSnapshotState, invalidateSnapshots, iterValuatedAssets, \
+    bumpTickerVersions, getPortfolioVersion
+from app.models import Cash
+from app.currency import MissingExchangeRateError
+
+UNTIL_DATE = datetime(2024, 1, 31, 23, 59)
+
+def buy(session, ticker="AAA", day=date(2024, 1, 1), amount=10, portfolio_id=1, drip=False):
+    session.add(StockHoldings(portfolio_id=portfolio_id, ticker=ticker, amount=amount, price=10, fees=0, action="add",
+                              drip=drip, date=datetime.combine(day, datetime.min.time())))
+    session.commit()
+
+def savedDays(session, portfolio_id=1):
+    return session.exec(text("SELECT COUNT(*) FROM daily_snapshots WHERE portfolio_id = :portfolio_id").params(portfolio_id=portfolio_id)).scalar()
+
+def test_the_series_is_materialized_up_to_the_last_final_day(session, market):
+    buy(session)
+
+    series = getSnapshotSeries(session, 1, UNTIL_DATE)
+
+    assert len(series) == 31
+    assert savedDays(session) == 31
+    assert getSnapshotState(session, 1).valid_until == "2024-01-31"
+
+def test_a_write_during_the_computation_still_returns_the_series(session, market, monkeypatch):
+    buy(session)
+    compute = snapshots.computeSnapshotRows
+
+    def computeWithWrite(*args):
+        # another request writes to the portfolio while this one computes
+        with Session(session.get_bind()) as other_session:
+            invalidateSnapshots(other_session, 1, date(2024, 1, 20))
+            other_session.commit()
+        monkeypatch.setattr(snapshots, "computeSnapshotRows", compute)
+        return compute(*args)
+
+    monkeypatch.setattr(snapshots, "computeSnapshotRows", computeWithWrite)
+
+    series = getSnapshotSeries(session, 1, UNTIL_DATE)
+
+    assert len(series) == 31
+    assert all(record["value"] > 0 for record in series)
+    # nothing was saved, the next read computes the series again
+    assert savedDays(session) == 0
+    assert getSnapshotState(session, 1).valid_until is None
+
+def test_a_price_refresh_during_the_computation_does_not_prevent_the_save(session, market, monkeypatch):
+    buy(session)
+    compute = snapshots.computeSnapshotRows
+
+    def computeWithRefresh(*args):
+        # the refresher saves today's bar of the ticker while the series is computed
+        with Session(session.get_bind()) as other_session:
+            bumpTickerVersions(other_session, "AAA")
+            other_session.commit()
+        return compute(*args)
+
+    monkeypatch.setattr(snapshots, "computeSnapshotRows", computeWithRefresh)
+
+    assert getPortfolioVersion(session, 1) == "0.0"
+    assert len(getSnapshotSeries(session, 1, UNTIL_DATE)) == 31
+    assert savedDays(session) == 31
+    assert getSnapshotState(session, 1).valid_until == "2024-01-31"
+    # the ETag still changes
+    assert getPortfolioVersion(session, 1) == "0.1"
+
+def test_a_failed_incremental_save_returns_the_whole_series(session, market, monkeypatch):
+    buy(session)
+    getSnapshotSeries(session, 1, datetime(2024, 1, 15, 23, 59))
+    compute = snapshots.computeSnapshotRows
+
+    def computeWithWrite(*args):
+        with Session(session.get_bind()) as other_session:
+            invalidateSnapshots(other_session, 1, date(2024, 1, 5))
+            other_session.commit()
+        monkeypatch.setattr(snapshots, "computeSnapshotRows", compute)
+        return compute(*args)
+
+    monkeypatch.setattr(snapshots, "computeSnapshotRows", computeWithWrite)
+
+    series = getSnapshotSeries(session, 1, UNTIL_DATE, resolution="weekly")
+    net_worth_df = getNetWorthSeries(session, 1, UNTIL_DATE)
+
+    assert [record["date"] for record in series] == ["2024-01-07", "2024-01-14", "2024-01-21", "2024-01-28", "2024-01-31"]
+    assert len(net_worth_df) == 31
+
+def test_days_without_prices_are_not_final(session, market, source):
+    buy(session)
+    buy(session, ticker="BBB")
+    source.empty_ranges.add((date(2024, 1, 1), date(2024, 2, 1)))
+
+    series = getSnapshotSeries(session, 1, UNTIL_DATE, "stock")
+
+    # BBB's download failed, nothing is final
+    assert len(series) == 62
+    assert getSnapshotState(session, 1).valid_until is None
+
+    source.empty_ranges.clear()
+    series = getSnapshotSeries(session, 1, UNTIL_DATE, "stock")
+
+    assert all(record["total_return"] > 0 for record in series)
+    assert getSnapshotState(session, 1).valid_until == "2024-01-31"
+
+def test_prices_saved_for_final_days_invalidate_them(session, market, source):
+    buy(session)
+    buy(session, portfolio_id=2, ticker="BBB")
+    getSnapshotSeries(session, 1, UNTIL_DATE)
+    getSnapshotSeries(session, 2, UNTIL_DATE)
+    version = getSnapshotState(session, 1).version
+
+    # the days from the 10th are downloaded again, e.g. after a gap in the coverage: the same prices change nothing
+    session.exec(text("UPDATE price_coverage SET \"end\" = '2024-01-10' WHERE ticker = 'AAA'"))
+    session.commit()
+    market.getHistory("AAA", date(2024, 1, 10), date(2024, 2, 1))
+    assert getSnapshotState(session, 1).version == version
+
+    # but a dividend Yahoo only reported since does
+    source.dividends[("AAA", date(2024, 1, 12))] = 0.1
+    session.exec(text("UPDATE price_coverage SET \"end\" = '2024-01-10' WHERE ticker = 'AAA'"))
+    session.commit()
+    market.getHistory("AAA", date(2024, 1, 10), date(2024, 2, 1))
+
+    state = getSnapshotState(session, 1)
+    assert state.valid_until == "2024-01-09"
+    assert state.version == version + 1
+    assert savedDays(session) == 9
+
+    # the portfolio without the ticker keeps its days
+    assert getSnapshotState(session, 2).valid_until == "2024-01-31"
+
+    assert len(getSnapshotSeries(session, 1, UNTIL_DATE)) == 31
+    assert savedDays(session) == 31
+
+def test_valuated_assets_are_the_materialized_ones(session, market, monkeypatch):
+    buy(session)
+    buy(session, ticker="BBB", day=date(2024, 1, 10))
+    session.add(Cash(portfolio_id=1, name="Savings", amount=100, interest=5, action="add", date=datetime(2024, 1, 5)))
+    session.commit()
+    monkeypatch.setattr(snapshots, "getSession", lambda: Session(session.get_bind()))
+
+    for asset_type, start_date, resolution in [(None, None, "daily"), ("stock", date(2024, 1, 8), "weekly"), ("cash", None, "monthly")]:
+        streamed = list(iterValuatedAssets(1, UNTIL_DATE, asset_type, start_date, resolution))
+        series = getSnapshotSeries(session, 1, UNTIL_DATE, asset_type, start_date, resolution)
+
+        assert [record for asset_records in streamed for record in asset_records] == series
+        assert len({asset_records[0]["name"] for asset_records in streamed}) == len(streamed)
+
+def forgetPricesBefore(session, day: date):
+    # a store that was never filled that far back (or lost those days)
+    session.exec(text("DELETE FROM stock_prices WHERE date < :day").params(day=day.isoformat()))
+    session.exec(text("UPDATE price_coverage SET start = :day").params(day=day.isoformat()))
+    session.commit()
+
+def test_dividends_before_the_price_window_are_downloaded(session, market, source):
+    source.dividends[("AAA", date(2024, 1, 3))] = 1.0
+    buy(session, drip=True)
+    shares = [record["shares"] for record in getSnapshotSeries(session, 1, UNTIL_DATE)]
+
+    forgetPricesBefore(session, date(2024, 1, 15))
+    invalidateSnapshots(session, 1, date(2024, 1, 25))
+    session.commit()
+
+    series = getSnapshotSeries(session, 1, UNTIL_DATE)
+
+    assert [record["shares"] for record in series] == shares
+    assert shares[-1] > 10
+    assert ("AAA", date(2024, 1, 1), date(2024, 1, 15)) in source.calls
+
+def test_days_missing_earlier_dividends_are_not_final(session, market, source):
+    source.dividends[("AAA", date(2024, 1, 3))] = 1.0
+    buy(session, drip=True)
+    getSnapshotSeries(session, 1, UNTIL_DATE)
+
+    forgetPricesBefore(session, date(2024, 1, 15))
+    invalidateSnapshots(session, 1, date(2024, 1, 25))
+    session.commit()
+    source.empty_ranges.add((date(2024, 1, 1), date(2024, 1, 15)))
+
+    getSnapshotSeries(session, 1, UNTIL_DATE)
+
+    # the days from the 25th are computed without the dividend, they are computed again next time
+    assert getSnapshotState(session, 1).valid_until == "2024-01-24"
+
+def test_a_stock_without_an_exchange_rate_is_not_summed_unconverted(session, market, source, monkeypatch):
+    source.currencies["AAA.TO"] = "CAD"
+    source.unquoted.add("CADUSD=X")
+    buy(session)
+    buy(session, ticker="AAA.TO")
+    monkeypatch.setattr(snapshots, "getSession", lambda: Session(session.get_bind()))
+
+    with pytest.raises(MissingExchangeRateError):
+        getSnapshotSeries(session, 1, UNTIL_DATE)
+    assert savedDays(session) == 0
+
+    # the stream fails before its first ticker (AAA, in USD) is sent
+    with pytest.raises(MissingExchangeRateError):
+        next(iterValuatedAssets(1, UNTIL_DATE))
+
+    source.unquoted.clear()
+    assert len(getSnapshotSeries(session, 1, UNTIL_DATE)) == 62
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+import pytest
+from yfinance.exceptions import YFTzMissingError
+from app import ticker_index
+from app.ticker_index import TickerIndex, TickerLookupError, isUnknownTicker
+
+class StubTicker:
+    """yf.Ticker with the symbols Yahoo knows, and the ones it can't be asked about."""
+
+    quoted = {"OTCM"}
+    unreachable = {"DOWN"}
+    lookups = []
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+
+    def history(self, **kwargs):
+        StubTicker.lookups.append(self.symbol)
+        if self.symbol in self.unreachable:
+            raise ConnectionError("no network")
+        if self.symbol not in self.quoted:
+            raise YFTzMissingError(self.symbol)
+
+@pytest.fixture(autouse=True)
+def listing(monkeypatch):
+    StubTicker.lookups = []
+    monkeypatch.setattr(ticker_index, "ticker_index", TickerIndex({"AAPL": "Apple Inc.", "BRK-B": "Berkshire Hathaway Inc.", "VFV.TO": "Vanguard S&P 500"}))
+    monkeypatch.setattr(ticker_index.yf, "Ticker", StubTicker)
+    monkeypatch.setattr(ticker_index, "_quoted_on_yahoo", OrderedDict())
+
+def test_listed_symbols_are_known():
+    assert not isUnknownTicker("AAPL")
+    assert not isUnknownTicker("BRK-B")
+    assert not isUnknownTicker("VFV.TO")
+    assert StubTicker.lookups == []
+
+@pytest.mark.parametrize("symbol", ["VFIAX", "BTC-USD", "^GSPC", "CADUSD=X", "GC=F", "NSRGY", "NSRGF", "SHOP.NE"])
+def test_symbols_the_listing_does_not_cover_go_through(symbol):
+    assert not isUnknownTicker(symbol)
+    assert StubTicker.lookups == []
+
+def test_a_symbol_missing_from_the_listing_is_asked_to_yahoo():
+    assert not isUnknownTicker("OTCM")
+    assert isUnknownTicker("NOPE")
+    assert isUnknownTicker("NOPE")
+    assert StubTicker.lookups == ["OTCM", "NOPE"]
+
+def test_a_symbol_yahoo_cannot_be_asked_about_is_asked_again():
+    for _ in range(2):
+        with pytest.raises(TickerLookupError):
+            isUnknownTicker("DOWN")
+    assert StubTicker.lookups == ["DOWN", "DOWN"]
+
+def test_an_unknown_symbol_is_asked_again_once_expired(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ticker_index.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(ticker_index.config, "TICKER_UNKNOWN_TTL_MINUTES", 10)
+
+    assert isUnknownTicker("NOPE")
+    now[0] += 9 * 60
+    assert isUnknownTicker("NOPE")
+    assert StubTicker.lookups == ["NOPE"]
+
+    # e.g. it was only throttled
+    now[0] += 2 * 60
+    monkeypatch.setattr(StubTicker, "quoted", StubTicker.quoted | {"NOPE"})
+    assert not isUnknownTicker("NOPE")
+    assert StubTicker.lookups == ["NOPE", "NOPE"]
+
+def test_the_answers_kept_are_bounded(monkeypatch):
+    monkeypatch.setattr(ticker_index, "MAX_YAHOO_ANSWERS", 2)
+
+    for symbol in ["OTCM", "NOPE", "ZZZZ"]:
+        isUnknownTicker(symbol)
+
+    assert list(ticker_index._quoted_on_yahoo) == ["NOPE", "ZZZZ"]